@@ -0,0 +1,105 @@
+import threading
+import time
+
+from protocol import AGGREGATE_LEN
+from logger import LOGGER
+
+DEFAULT_AGGREGATE_WINDOW = 0.001
+# packets above this go out alone, they gain little from sharing a datagram
+AGGREGATE_MAX_PACKET = 256
+
+
+class PacketAggregator:
+    '''
+    bundles small packets of a shard arriving within window seconds into one
+    payload of at most limit bytes, length prefixes included. send_callback
+    gets (shard, packets) and always runs under lock, from the caller or the
+    window timer thread, flush_callback runs after the timer sent something.
+    '''
+
+    def __init__(self, shards, limit, window, send_callback, flush_callback=None):
+        self.limit = limit
+        self.window = window
+        self.send_callback = send_callback
+        self.flush_callback = flush_callback
+        self.lock = threading.Condition(threading.RLock())
+        self.pending = [[] for _ in range(shards)]
+        self.pending_size = [0] * shards
+        self.deadline = [None] * shards
+        self.running = False
+        self.timer_thread = None
+        # stats
+        self.aggregated = 0
+        self.datagrams = 0
+
+    def run(self):
+        LOGGER.debug("PacketAggregator run")
+        self.running = True
+        self.timer_thread = threading.Thread(target=self.handle_timer)
+        self.timer_thread.start()
+
+    def stop(self):
+        LOGGER.info("PacketAggregator stop")
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.timer_thread is not None:
+            self.timer_thread.join()
+            self.timer_thread = None
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = limit
+
+    def send(self, shard, data):
+        with self.lock:
+            size = AGGREGATE_LEN.size + len(data)
+            if len(data) > AGGREGATE_MAX_PACKET or size > self.limit:
+                # keep the flow in order, what is pending goes first
+                self.flush_shard(shard)
+                self.send_callback(shard, [data])
+                return
+            if self.pending_size[shard] + size > self.limit:
+                self.flush_shard(shard)
+            pending = self.pending[shard]
+            if not pending:
+                self.deadline[shard] = time.monotonic() + self.window
+                self.lock.notify()
+            # the caller may reuse its buffer once we return
+            pending.append(bytes(data))
+            self.pending_size[shard] += size
+
+    def flush(self):
+        with self.lock:
+            for shard in range(len(self.pending)):
+                self.flush_shard(shard)
+
+    def flush_shard(self, shard):
+        pending = self.pending[shard]
+        if not pending:
+            return
+        self.pending[shard] = []
+        self.pending_size[shard] = 0
+        self.deadline[shard] = None
+        self.aggregated += len(pending)
+        self.datagrams += 1
+        self.send_callback(shard, pending)
+
+    def handle_timer(self):
+        LOGGER.debug("PacketAggregator handle_timer")
+        with self.lock:
+            while self.running:
+                deadlines = [deadline for deadline in self.deadline if deadline is not None]
+                if not deadlines:
+                    self.lock.wait(0.1)
+                    continue
+                wait = min(deadlines) - time.monotonic()
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+                now = time.monotonic()
+                for shard, deadline in enumerate(self.deadline):
+                    if deadline is not None and deadline <= now:
+                        self.flush_shard(shard)
+                if self.flush_callback:
+                    self.flush_callback()
@@ -0,0 +1,296 @@
+import asyncio
+import threading
+import time
+
+from client import Client, flow_shard, TX_ENCRYPT_SECONDS, TX_SEND_SECONDS
+from dns_utils import parse_dns_packet, build_dns_reply
+from dns_cache import DNSCache
+from dns_upstream import UpstreamResolver
+from packet_trace import TRACER, STAGE_CLIENT_SEND
+from protocol import Protocol, CMD_SERVER_HANDSHAKE
+from logger import LOGGER
+
+ENGINE_THREAD = 'thread'
+ENGINE_ASYNCIO = 'asyncio'
+
+HANDSHAKE_RETRY = 5
+HANDSHAKE_TIMEOUT = 2
+
+
+class EventLoopThread:
+    '''owns an asyncio event loop running on its own thread'''
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+    def run(self):
+        LOGGER.debug("EventLoopThread run")
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.handle_loop, args=(ready,))
+        self.thread.start()
+        ready.wait()
+
+    def handle_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def call(self, callback, *args):
+        '''schedule a plain callback on the loop from any thread'''
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def submit(self, coro):
+        '''schedule a coroutine on the loop from any thread'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        LOGGER.info("EventLoopThread stop")
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+
+class DeviceAdapter:
+    '''
+    bridges a thread based PacketDevice onto the event loop,
+    packets read from the device are copied and handed over to the loop.
+    writes go straight to the device from any thread, as with the thread engine
+    '''
+
+    def __init__(self, loop_thread, device, read_callback):
+        self.loop_thread = loop_thread
+        self.device = device
+        self.read_callback = read_callback
+        self.device.read_callback = self.on_device_read
+
+    def on_device_read(self, data):
+        self.loop_thread.call(self.read_callback, bytes(data))
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.handle_loop_datagram(data)
+
+    def error_received(self, exc):
+        LOGGER.warning("AsyncClient socket error: %s" % exc)
+
+
+class AsyncClient(Client):
+    '''
+    Client running handshake, receiving and traffic accounting as tasks on
+    one event loop instead of one thread each. send() must be called on
+    the loop, which DeviceAdapter takes care of.
+    '''
+
+    def __init__(self, loop_thread, host, port, identification, secret, recv_callback, handshake_callback, **kwargs):
+        super().__init__(host, port, identification, secret, recv_callback, handshake_callback, **kwargs)
+        self.loop_thread = loop_thread
+        self.transport = None
+        self.transports = []
+        self.handshake_future = None
+        self.main_future = None
+        self.traffic_task = None
+
+    def run(self):
+        LOGGER.debug("AsyncClient run")
+        self.running = True
+        self.main_future = self.loop_thread.submit(self.handle_main())
+
+    def stop(self):
+        LOGGER.info("AsyncClient stop")
+        self.running = False
+        if self.pmtu_prober is not None:
+            self.pmtu_prober.stop()
+        self.loop_thread.submit(self.handle_stop()).result()
+
+    async def handle_stop(self):
+        if self.traffic_task is not None:
+            self.traffic_task.cancel()
+            self.traffic_task = None
+            self.save_traffic_totals()
+        if self.transports:
+            for transport in self.transports:
+                transport.close()
+            self.transports = []
+            self.transport = None
+        else:
+            for sock in self.socks:
+                sock.close()
+
+    async def handle_main(self):
+        LOGGER.debug("AsyncClient handle_main")
+        loop = asyncio.get_running_loop()
+        for sock in self.socks:
+            sock.setblocking(False)
+            transport, _ = await loop.create_datagram_endpoint(lambda: ClientProtocol(self), sock=sock)
+            self.transports.append(transport)
+        self.transport = self.transports[0]
+
+        # handshake
+        send_data = self.cipher.encrypt_handshake(self.make_handshake())
+        protocol = None
+        for _ in range(HANDSHAKE_RETRY):
+            if not self.running:
+                return
+            self.handshake_future = loop.create_future()
+            self.tx_bytes.inc(len(send_data))
+            self.tx_packets.inc()
+            self.transport.sendto(send_data, self.server_addr)
+            try:
+                protocol = await asyncio.wait_for(self.handshake_future, HANDSHAKE_TIMEOUT)
+                break
+            except asyncio.TimeoutError:
+                LOGGER.warning("AsyncClient handshake timeout")
+        self.handshake_future = None
+        if protocol is None:
+            await loop.run_in_executor(None, self.handshake_cb, None, None)
+            return
+        LOGGER.debug("AsyncClient handshake recved")
+        self.accept_handshake(protocol)
+        # network setup blocks, keep it off the loop
+        await loop.run_in_executor(None, self.handshake_cb, protocol.tun_ip_raw, protocol.dst_ip_raw)
+        self.traffic_task = loop.create_task(self.handle_traffic_task())
+        if self.pmtu_prober is not None:
+            # probing blocks on its own socket and thread
+            self.pmtu_prober.run()
+
+    def handle_loop_datagram(self, datagram):
+        if self.handshake_future is None:
+            self.handle_datagram(datagram)
+            return
+        self.rx_bytes.inc(len(datagram))
+        self.rx_packets.inc()
+        data = self.cipher.decrypt_handshake(datagram)
+        if data is None:
+            return
+        protocol = Protocol()
+        if protocol.parse(data) <= 1 or protocol.cmd != CMD_SERVER_HANDSHAKE:
+            return
+        if not self.handshake_future.done():
+            self.handshake_future.set_result(protocol)
+
+    async def handle_traffic_task(self):
+        LOGGER.debug("AsyncClient handle_traffic_task")
+        tick = 0
+        while self.running:
+            self.update_traffic(tick)
+            await asyncio.sleep(1)
+            tick += 1
+
+    def send(self, data):
+        if TRACER.enabled:
+            TRACER.record(STAGE_CLIENT_SEND, data)
+        if self.transport is None:
+            return
+        shard = flow_shard(data, len(self.transports))
+        length = self.pack_packet(data)
+        start = time.perf_counter()
+        send_data = self.wrap_data(self.send_view[:length])
+        encrypted = time.perf_counter()
+        self.tx_bytes.inc(len(send_data))
+        self.tx_packets.inc()
+        self.transports[shard].sendto(send_data, self.server_addr)
+        TX_ENCRYPT_SECONDS.observe(encrypted - start)
+        TX_SEND_SECONDS.observe(time.perf_counter() - encrypted)
+
+    def flush(self):
+        pass
+
+
+class AsyncDNSServer:
+    '''DNSServer counterpart resolving on the event loop'''
+
+    def __init__(self, loop_thread, filter_rule, packet_callback, upstream_servers=None):
+        LOGGER.debug("AsyncDNSServer init")
+        self.loop_thread = loop_thread
+        self.filter = filter_rule
+        self.callback = packet_callback
+        self.cache = DNSCache()
+        # qname -> (future, qtype) of the query being made for it
+        self.inflight = {}
+        self.upstream_servers = upstream_servers
+        self.upstream = None
+        self.running = False
+
+    def run(self):
+        LOGGER.debug("AsyncDNSServer run")
+        self.running = True
+        self.upstream = UpstreamResolver(self.upstream_servers or [self.filter.default_dns_server])
+        # upstream sockets are datagram endpoints on the loop
+        self.loop_thread.submit(self.upstream.run_async()).result()
+
+    def stop(self):
+        LOGGER.info("AsyncDNSServer stop")
+        self.running = False
+        if self.upstream is not None:
+            self.loop_thread.submit(self.upstream.stop_async()).result()
+            self.upstream = None
+
+    def resolve(self, packet, context=None):
+        LOGGER.debug("AsyncDNSServer resolve")
+        self.loop_thread.call(self.start_resolve, bytes(packet), context)
+
+    def start_resolve(self, packet, context):
+        if not self.running:
+            return
+        if context is None:
+            context = parse_dns_packet(packet)
+            if context is None:
+                return
+        asyncio.get_running_loop().create_task(self.handle_packet(packet, context))
+
+    async def handle_packet(self, packet, context):
+        loop = asyncio.get_running_loop()
+        questions = context.questions
+        results = await asyncio.gather(*[self.cached_query(qname, qtype) for qname, qtype, _ in questions])
+        answers = {qname: addresses for (qname, _, _), (addresses, _) in zip(questions, results)}
+        ttls = {qname: ttl or 0 for (qname, _, _), (_, ttl) in zip(questions, results)}
+        packet, answers = build_dns_reply(packet, answers, True, ttls, context)
+
+        # adding routes runs system commands
+        hits = [item + '/32' for value in answers.values() for item in value]
+        if hits:
+            await loop.run_in_executor(None, self.hit_ips, hits)
+
+        if self.running:
+            self.callback(packet)
+
+    def hit_ips(self, hits):
+        for hit in hits:
+            self.filter.hit_ip(hit)
+
+    async def cached_query(self, qname, qtype):
+        cached = self.cache.get(qname, qtype)
+        if cached is not None:
+            return cached
+        # only a records are queried, so every qtype of a name shares one query
+        joined = self.inflight.get(qname)
+        if joined is not None:
+            # another packet is resolving the name already
+            future, joined_qtype = joined
+            result = await asyncio.shield(future)
+            if joined_qtype != qtype:
+                self.cache.put(qname, qtype, *result)
+            return result
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[qname] = (future, qtype)
+        result = ([], None)
+        try:
+            result = await self.query(qname)
+            self.cache.put(qname, qtype, *result)
+        finally:
+            del self.inflight[qname]
+            future.set_result(result)
+        return result
+
+    async def query(self, qname):
+        '''(ipv4 addresses, ttl) over the upstream endpoints on the loop'''
+        return await self.upstream.query_async(qname)
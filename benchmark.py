@@ -0,0 +1,308 @@
+'''
+end to end throughput and latency benchmark
+
+packets are injected through a loopback device into MainControl.tap_read_cb,
+go out through Client to a LocalServer process which echoes them, and come back
+through client_recv_cb. results are printed and written as json so runs can
+be compared between versions.
+
+    python benchmark.py --mix imix --packets 20000 --output bench.json
+    python benchmark.py --pcap capture.pcap --cipher chacha20-poly1305
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import deque
+from cipher import CIPHER_CHACHA20
+from local_server import run_local_server
+from packet_device import DEVICE_LOOPBACK
+from async_engine import ENGINE_THREAD, ENGINE_ASYNCIO
+from main import MainControl
+from metrics import REGISTRY
+from client import STAGE_SECONDS
+from packet_trace import TRACER
+from compression import COMPRESSION_NAMES
+
+BENCH_SECRET = 'benchmark'
+BENCH_USER = 'benchmark'
+CONNECT_TIMEOUT = 10
+DRAIN_TIMEOUT = 2
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+ETHERTYPE_IPV4 = 0x0800
+
+# size, weight
+PACKET_MIXES = {
+    'small': [(64, 1)],
+    'bulk': [(1300, 1)],
+    'imix': [(64, 7), (594, 4), (1300, 1)],
+}
+
+
+def read_pcap(path):
+    '''returns the ipv4 packets of a classic pcap file'''
+    packets = []
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError('not a pcap file: %s' % path)
+        for endian in ('<', '>'):
+            magic, = struct.unpack(endian + 'I', header[:4])
+            if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                break
+        else:
+            raise ValueError('not a pcap file: %s' % path)
+        linktype, = struct.unpack(endian + 'I', header[20:24])
+        record = struct.Struct(endian + 'IIII')
+        while True:
+            data = f.read(record.size)
+            if len(data) < record.size:
+                break
+            _, _, caplen, origlen = record.unpack(data)
+            frame = f.read(caplen)
+            if len(frame) < caplen or caplen < origlen:
+                continue
+            if linktype == LINKTYPE_ETHERNET:
+                if len(frame) < 14 or struct.unpack('!H', frame[12:14])[0] != ETHERTYPE_IPV4:
+                    continue
+                frame = frame[14:]
+            elif linktype not in (LINKTYPE_RAW, LINKTYPE_IPV4):
+                raise ValueError('unsupported pcap link type: %d' % linktype)
+            if frame and frame[0] & 0xf0 == 0x40:
+                packets.append(frame)
+    return packets
+
+
+# repeated in text payloads, like http headers, logs or telemetry
+TEXT_PAYLOAD = (b'GET /api/v1/metrics?host=node-17&window=60 HTTP/1.1\r\nHost: telemetry.example.com\r\n'
+                b'User-Agent: outernet-bench\r\nAccept: application/json\r\n\r\n')
+PAYLOAD_RANDOM = 'random'
+PAYLOAD_TEXT = 'text'
+
+
+def make_udp_packet(seq, size, payload_type=PAYLOAD_RANDOM):
+    '''ipv4/udp packet of the given total size, the sequence makes it unique'''
+    size = max(size, 32)
+    if payload_type == PAYLOAD_TEXT:
+        filler = (TEXT_PAYLOAD * (size // len(TEXT_PAYLOAD) + 1))[:size - 32]
+    else:
+        filler = os.urandom(size - 32)
+    payload = struct.pack('!I', seq) + filler
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, size, seq & 0xffff, 0, 64, 17, 0,
+                         bytes([10, 0, 0, 2]), bytes([198, 18, 0, 1]))
+    udp = struct.pack('!HHHH', 40000 + seq % 1000, 9, size - 20, 0)
+    return header + udp + payload
+
+
+def synthetic_packets(mix, count, payload_type=PAYLOAD_RANDOM):
+    sizes = [size for size, _ in PACKET_MIXES[mix]]
+    weights = [weight for _, weight in PACKET_MIXES[mix]]
+    rand = random.Random(0)
+    return [make_udp_packet(seq, rand.choices(sizes, weights)[0], payload_type) for seq in range(count)]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+class Benchmark:
+    def __init__(self, packets, window, cipher_mode, engine, batch_io, sockets, aggregate_window, compression, metrics_port,
+                 port):
+        self.packets = packets
+        self.window = window
+        self.cipher_mode = cipher_mode
+        self.engine = engine
+        self.batch_io = batch_io
+        self.sockets = sockets
+        self.aggregate_window = aggregate_window
+        self.compression = compression
+        self.metrics_port = metrics_port
+        self.port = port
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.inflight = 0
+        self.latencies = []
+        self.received = 0
+        self.received_bytes = 0
+
+    def on_device_write(self, data):
+        now = time.perf_counter()
+        data = bytes(data)
+        with self.lock:
+            sent = self.pending.get(data)
+            if not sent:
+                return
+            self.latencies.append(now - sent.popleft())
+            self.received += 1
+            self.received_bytes += len(data)
+            self.inflight -= 1
+            self.lock.notify()
+
+    def run(self):
+        main_control = MainControl(DEVICE_LOOPBACK)
+        device = main_control.device
+        device.write_callback = self.on_device_write
+        main_control.run('127.0.0.1', self.port, BENCH_USER, BENCH_SECRET, cipher_mode=self.cipher_mode,
+                         batch_io=self.batch_io, engine=self.engine, sockets=self.sockets,
+                         aggregate_window=self.aggregate_window, compression=self.compression,
+                         metrics_port=self.metrics_port)
+        deadline = time.time() + CONNECT_TIMEOUT
+        while not device.running:
+            if time.time() > deadline:
+                raise RuntimeError('benchmark client could not connect to the local server')
+            time.sleep(0.05)
+
+        burst = max(1, self.window // 4)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        for i in range(0, len(self.packets), burst):
+            batch = self.packets[i:i + burst]
+            with self.lock:
+                while self.inflight + len(batch) > self.window:
+                    if not self.lock.wait(DRAIN_TIMEOUT):
+                        # lost packets, stop waiting for them
+                        self.inflight = 0
+                now = time.perf_counter()
+                for data in batch:
+                    self.pending.setdefault(data, deque()).append(now)
+                self.inflight += len(batch)
+            device.inject(batch)
+        with self.lock:
+            while self.inflight > 0:
+                if not self.lock.wait(DRAIN_TIMEOUT):
+                    break
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        # tunnel bytes on the wire, handshake included
+        wire_bytes = (main_control.client.tx_bytes.value(), main_control.client.rx_bytes.value())
+
+        main_control.stop()
+        main_control.stop_thread.join()
+        return self.report(elapsed, cpu, wire_bytes)
+
+    def report(self, elapsed, cpu, wire_bytes):
+        latencies = sorted(self.latencies)
+        sent = len(self.packets)
+        return {
+            'packets_sent': sent,
+            'packets_received': self.received,
+            'loss': (sent - self.received) / sent if sent else 0,
+            'elapsed_s': elapsed,
+            'packets_per_s': self.received / elapsed if elapsed else 0,
+            'mbit_per_s': self.received_bytes * 8 / elapsed / 1e6 if elapsed else 0,
+            'latency_p50_us': percentile(latencies, 50) * 1e6 if latencies else None,
+            'latency_p99_us': percentile(latencies, 99) * 1e6 if latencies else None,
+            'cpu_per_packet_us': cpu / self.received * 1e6 if self.received else None,
+            'wire_tx_bytes': wire_bytes[0],
+            'wire_rx_bytes': wire_bytes[1],
+            'stage_mean_us': stage_means(),
+        }
+
+
+def stage_means():
+    '''mean of every data path stage histogram'''
+    means = {}
+    for metric in list(REGISTRY.metrics.values()):
+        if metric.name != STAGE_SECONDS:
+            continue
+        _, total, count = metric.value()
+        if count:
+            means[dict(metric.labels)['stage']] = total / count * 1e6
+    return means
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Outernet data path benchmark')
+    parser.add_argument('--pcap', help='replay the ipv4 packets of this pcap file')
+    parser.add_argument('--mix', choices=sorted(PACKET_MIXES), default='imix', help='synthetic packet size mix')
+    parser.add_argument('--packets', type=int, default=20000, help='number of synthetic packets')
+    parser.add_argument('--payload', choices=[PAYLOAD_RANDOM, PAYLOAD_TEXT], default=PAYLOAD_RANDOM,
+                        help='synthetic payload content')
+    parser.add_argument('--window', type=int, default=256, help='max packets in flight')
+    parser.add_argument('--cipher', default=CIPHER_CHACHA20)
+    parser.add_argument('--engine', default=ENGINE_THREAD)
+    parser.add_argument('--batch-io', action='store_true')
+    parser.add_argument('--sockets', type=int, default=1, help='udp sockets to shard flows over')
+    parser.add_argument('--aggregate-window', type=float, default=0, help='bundle small packets sent within this many seconds')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION_NAMES), help='offer this compression to the server')
+    parser.add_argument('--trace-sample', type=int, default=0, help='trace one packet of every n, 0 disables tracing')
+    parser.add_argument('--metrics-port', type=int, help='serve metrics on this localhost port while running')
+    parser.add_argument('--output', help='write results as json to this file')
+    args = parser.parse_args()
+    if args.engine == ENGINE_ASYNCIO and (args.batch_io or args.aggregate_window):
+        parser.error('--batch-io and --aggregate-window need the %s engine' % ENGINE_THREAD)
+
+    if args.pcap:
+        packets = read_pcap(args.pcap)
+    else:
+        packets = synthetic_packets(args.mix, args.packets, args.payload)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # keep the client's traffic file away from the real one
+    os.chdir(tempfile.mkdtemp(prefix='outernet-bench-'))
+
+    if args.trace_sample > 0:
+        TRACER.enable(args.trace_sample)
+
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    server = ctx.Process(target=run_local_server, args=(port_queue, BENCH_SECRET.encode('utf-8'), args.cipher), daemon=True)
+    server.start()
+    try:
+        port = port_queue.get(timeout=CONNECT_TIMEOUT)
+        benchmark = Benchmark(packets, args.window, args.cipher, args.engine, args.batch_io, args.sockets, args.aggregate_window,
+                              args.compression, args.metrics_port, port)
+        results = benchmark.run()
+    finally:
+        server.terminate()
+
+    report = {
+        'version': get_version(),
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'params': {
+            'source': args.pcap or '%s/%s' % (args.mix, args.payload),
+            'packets': len(packets),
+            'window': args.window,
+            'cipher': args.cipher,
+            'engine': args.engine,
+            'batch_io': args.batch_io,
+            'sockets': args.sockets,
+            'aggregate_window': args.aggregate_window,
+            'compression': args.compression,
+            'trace_sample': args.trace_sample,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,35 @@ import base64
 import hashlib
 import os
 import struct
+import threading
+import time
 from Crypto import Random
-from Crypto.Cipher import AES, ChaCha20
+from Crypto.Cipher import AES, ChaCha20, ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
 from Crypto.Util import Padding
 
+CIPHER_CHACHA20 = 'chacha20'
+CIPHER_CHACHA20_POLY1305 = 'chacha20-poly1305'
+
+REPLAY_WINDOW_SIZE = 1024
+FRAME_HEADER = struct.Struct('!H')
+
+# chacha20-poly1305 handshake, data datagrams never use this key id
+HANDSHAKE_KEY_ID = b'\x00\x00\x00\x00'
+HANDSHAKE_SALT_LEN = 16
+SESSION_NONCE_LEN = 32
+# session nonce, receive key id, then the handshake time in ns from the
+# initiator and the echoed initiator nonce from the responder
+INITIATOR_ENVELOPE = struct.Struct('!%ds%dsQ' % (SESSION_NONCE_LEN, len(HANDSHAKE_KEY_ID)))
+RESPONDER_ENVELOPE = struct.Struct('!%ds%ds%ds' % (SESSION_NONCE_LEN, len(HANDSHAKE_KEY_ID), SESSION_NONCE_LEN))
+# contexts per role, so a handshake reflected back never opens
+INITIATOR_HANDSHAKE_CONTEXT = b'outernet client handshake'
+RESPONDER_HANDSHAKE_CONTEXT = b'outernet server handshake'
+INITIATOR_CONTEXT = b'outernet client to server'
+RESPONDER_CONTEXT = b'outernet server to client'
+
+
 class AESCipher:
 
     def __init__(self, secret):
@@ -29,28 +54,80 @@ class AESCipher:
         '''length of data must be under 65536'''
         enc = self.encrypt(raw)
         elen = len(enc)
-        return struct.pack('!H', elen) + enc
+        return FRAME_HEADER.pack(elen) + enc
 
     def decrypt_all(self, enc):
         '''returns decrypted data and length of decrypted ciphertext'''
-        result = b''
-        dlen = 0
-        while enc:
-            if len(enc) < 2:
-                return result, dlen
-            elen, = struct.unpack('!H', enc[:2])
-            if len(enc) < 2 + elen:
-                return result, dlen
-            result += self.decrypt(enc[2:2 + elen])
-            dlen += 2 + elen
-            enc = enc[2 + elen:]
-        return result, dlen
+        decoder = AESFrameDecoder(self)
+        decoder.feed(enc)
+        result = b''.join(decoder.frames())
+        return result, decoder.consumed
+
+
+class AESFrameEncoder:
+    '''writes length prefixed AES frames into one output buffer'''
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self.buffer = bytearray()
+
+    def encode(self, raw):
+        '''length of data must be under 65536'''
+        enc = self.cipher.encrypt(raw)
+        self.buffer += FRAME_HEADER.pack(len(enc))
+        self.buffer += enc
+
+    def take(self):
+        '''returns all encoded bytes and empties the buffer'''
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+
+class AESFrameDecoder:
+    '''
+    incremental decoder for AES frames read from a stream, feed it chunks
+    as they arrive and iterate frames() for the complete ones
+    '''
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self.buffer = bytearray()
+        self.cursor = 0
+        self.consumed = 0
+
+    def feed(self, data):
+        # drop consumed bytes once they are the larger part of the buffer
+        if self.cursor and self.cursor >= len(self.buffer) // 2:
+            del self.buffer[:self.cursor]
+            self.cursor = 0
+        self.buffer += data
+
+    def pending(self):
+        return len(self.buffer) - self.cursor
+
+    def frames(self):
+        '''generator of decrypted frames, stops when a frame is incomplete'''
+        while True:
+            end = len(self.buffer)
+            if end - self.cursor < FRAME_HEADER.size:
+                return
+            elen, = FRAME_HEADER.unpack_from(self.buffer, self.cursor)
+            start = self.cursor + FRAME_HEADER.size
+            if end - start < elen:
+                return
+            with memoryview(self.buffer) as view:
+                raw = self.cipher.decrypt(view[start:start + elen])
+            self.cursor = start + elen
+            self.consumed += FRAME_HEADER.size + elen
+            yield raw
 
 
 class Chacha20Cipher:
 
     def __init__(self, secret):
         self.nonce_len = 8
+        self.overhead = self.nonce_len
         self.key = hashlib.sha256(secret).digest()
 
     def encrypt(self, raw):
@@ -63,6 +140,234 @@ class Chacha20Cipher:
         cipher = ChaCha20.new(key=self.key, nonce=nonce)
         return cipher.decrypt(enc[self.nonce_len:])
 
+    def encrypt_handshake(self, raw):
+        return self.encrypt(raw)
+
+    def decrypt_handshake(self, enc):
+        return self.decrypt(enc)
+
+
+class ReplayWindow:
+    '''sliding window of accepted nonce counters, bit i of mask is top - i'''
+
+    def __init__(self, size=REPLAY_WINDOW_SIZE):
+        self.size = size
+        self.top = -1
+        self.mask = 0
+
+    def check(self, counter):
+        if counter > self.top:
+            return True
+        offset = self.top - counter
+        if offset >= self.size:
+            return False
+        return not (self.mask >> offset) & 1
+
+    def update(self, counter):
+        if counter > self.top:
+            shift = counter - self.top
+            if shift >= self.size:
+                self.mask = 1
+            else:
+                self.mask = ((self.mask << shift) | 1) & ((1 << self.size) - 1)
+            self.top = counter
+        else:
+            self.mask |= 1 << (self.top - counter)
+
+
+class Chacha20Poly1305Cipher:
+    '''
+    authenticated data channel with keys of its own per session and
+    direction. the client handshake carries the client's session nonce,
+    receive key id and a timestamp, the server's answer its own nonce and
+    key id and the echoed client nonce. both are sealed under a key of
+    their own, derived from the secret and a random handshake salt sent in
+    front. the session keys are derived from the secret and both nonces.
+
+    data datagrams are nonce + ciphertext + tag, the 12 bytes nonce is the
+    receiver's key id followed by a 8 bytes packet counter, so no
+    randomness is needed per packet and the receiver finds the key without
+    trying. each receive key has a sliding replay window of its own.
+    handshake datagrams start with HANDSHAKE_KEY_ID instead.
+    '''
+
+    def __init__(self, secret, responder=False):
+        self.key_id_len = 4
+        self.nonce_len = 12
+        self.tag_len = 16
+        self.overhead = self.nonce_len + self.tag_len
+        self.secret = hashlib.sha256(secret).digest()
+        self.responder = responder
+        self.nonce_struct = struct.Struct('!%dsQ' % self.key_id_len)
+        # our half of the session, the key id is what the peer puts in
+        # front of the nonces of datagrams to us
+        self.session_nonce = Random.new().read(SESSION_NONCE_LEN)
+        self.key_id = new_key_id()
+        self.handshake_time = time.time_ns()
+        # the peer's half, known once its handshake was opened
+        self.peer_nonce = None
+        self.peer_key_id = None
+        self.peer_time = None
+        self.send_key = None
+        self.recv_key = None
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+        self.replay_window = ReplayWindow()
+        self.replay_lock = threading.Lock()
+
+    def established(self):
+        return self.send_key is not None
+
+    def encrypt_handshake(self, raw):
+        '''handshake datagram carrying raw and our half of the session'''
+        if self.responder:
+            envelope = RESPONDER_ENVELOPE.pack(self.session_nonce, self.key_id, self.peer_nonce)
+            context = RESPONDER_HANDSHAKE_CONTEXT
+        else:
+            envelope = INITIATOR_ENVELOPE.pack(self.session_nonce, self.key_id, self.handshake_time)
+            context = INITIATOR_HANDSHAKE_CONTEXT
+        salt = Random.new().read(HANDSHAKE_SALT_LEN)
+        # the key is used for this one datagram only
+        cipher = ChaCha20_Poly1305.new(key=derive_key(self.secret, salt, context), nonce=bytes(self.nonce_len))
+        enc, tag = cipher.encrypt_and_digest(envelope + bytes(raw))
+        return HANDSHAKE_KEY_ID + salt + enc + tag
+
+    def decrypt_handshake(self, enc):
+        '''
+        returns raw of the peer's handshake datagram and sets up the session
+        keys, None if it is forged or not an answer to our handshake
+        '''
+        if self.responder:
+            envelope, context = INITIATOR_ENVELOPE, INITIATOR_HANDSHAKE_CONTEXT
+        else:
+            envelope, context = RESPONDER_ENVELOPE, RESPONDER_HANDSHAKE_CONTEXT
+        start = len(HANDSHAKE_KEY_ID) + HANDSHAKE_SALT_LEN
+        if len(enc) < start + envelope.size + self.tag_len or bytes(enc[:len(HANDSHAKE_KEY_ID)]) != HANDSHAKE_KEY_ID:
+            return None
+        salt = bytes(enc[len(HANDSHAKE_KEY_ID):start])
+        cipher = ChaCha20_Poly1305.new(key=derive_key(self.secret, salt, context), nonce=bytes(self.nonce_len))
+        try:
+            plain = cipher.decrypt_and_verify(enc[start:-self.tag_len], enc[-self.tag_len:])
+        except ValueError:
+            return None
+        peer_nonce, peer_key_id, extra = envelope.unpack_from(plain)
+        if not self.responder and extra != self.session_nonce:
+            # an answer to another handshake
+            return None
+        if self.established():
+            # a retransmit or a replay, the keys and the replay window of a
+            # session never change, a new session needs a new cipher
+            if peer_nonce != self.peer_nonce or peer_key_id != self.peer_key_id:
+                return None
+            return plain[envelope.size:]
+        if self.responder:
+            self.peer_time = extra
+        self.peer_nonce = peer_nonce
+        self.peer_key_id = peer_key_id
+        if self.responder:
+            initiator_nonce, responder_nonce = peer_nonce, self.session_nonce
+        else:
+            initiator_nonce, responder_nonce = self.session_nonce, peer_nonce
+        salt = initiator_nonce + responder_nonce
+        initiator_key = derive_key(self.secret, salt, INITIATOR_CONTEXT)
+        responder_key = derive_key(self.secret, salt, RESPONDER_CONTEXT)
+        if self.responder:
+            self.send_key, self.recv_key = responder_key, initiator_key
+        else:
+            self.send_key, self.recv_key = initiator_key, responder_key
+        return plain[envelope.size:]
+
+    def session_keys(self):
+        '''(send key, receive key, peer key id, key id) for another instance'''
+        return self.send_key, self.recv_key, self.peer_key_id, self.key_id
+
+    def set_session_keys(self, send_key, recv_key, peer_key_id, key_id):
+        self.send_key = send_key
+        self.recv_key = recv_key
+        self.peer_key_id = peer_key_id
+        self.key_id = key_id
+
+    def reserve(self, count=1):
+        '''reserve count nonce counters, returns the first one'''
+        with self.counter_lock:
+            counter = self.counter
+            self.counter += count
+        return counter
+
+    def seal(self, raw, counter):
+        '''only once the handshake set up the session keys'''
+        nonce = self.nonce_struct.pack(self.peer_key_id, counter)
+        cipher = ChaCha20_Poly1305.new(key=self.send_key, nonce=nonce)
+        enc, tag = cipher.encrypt_and_digest(raw)
+        return nonce + enc + tag
+
+    def open(self, enc):
+        '''returns (nonce, raw) or None if authentication fails'''
+        if len(enc) < self.overhead or self.recv_key is None:
+            return None
+        nonce = bytes(enc[:self.nonce_len])
+        if nonce[:self.key_id_len] != self.key_id:
+            return None
+        cipher = ChaCha20_Poly1305.new(key=self.recv_key, nonce=nonce)
+        try:
+            raw = cipher.decrypt_and_verify(enc[self.nonce_len:-self.tag_len], enc[-self.tag_len:])
+        except ValueError:
+            return None
+        return nonce, raw
+
+    def check_replay(self, nonce):
+        '''returns True and records the nonce if it was not seen before'''
+        counter = self.nonce_struct.unpack(nonce)[1]
+        with self.replay_lock:
+            if not self.replay_window.check(counter):
+                return False
+            self.replay_window.update(counter)
+        return True
+
+    def encrypt(self, raw):
+        return self.seal(raw, self.reserve())
+
+    def decrypt(self, enc):
+        '''returns None for forged or replayed datagrams'''
+        opened = self.open(enc)
+        if opened is None:
+            return None
+        nonce, raw = opened
+        if not self.check_replay(nonce):
+            return None
+        return raw
+
+
+def new_key_id():
+    '''random receive key id, never the one of handshake datagrams'''
+    while True:
+        key_id = Random.new().read(len(HANDSHAKE_KEY_ID))
+        if key_id != HANDSHAKE_KEY_ID:
+            return key_id
+
+
+def derive_key(secret, salt, context):
+    return HKDF(secret, 32, salt, SHA256, context=context)
+
+
+def is_handshake(enc):
+    '''True for chacha20-poly1305 handshake datagrams'''
+    return bytes(enc[:len(HANDSHAKE_KEY_ID)]) == HANDSHAKE_KEY_ID
+
+
+def datagram_key_id(enc):
+    '''the receive key id a chacha20-poly1305 datagram was sealed for'''
+    return bytes(enc[:len(HANDSHAKE_KEY_ID)])
+
+
+def new_cipher(mode, secret, responder=False):
+    '''responder only applies to chacha20-poly1305, for the server side of the handshake'''
+    if mode == CIPHER_CHACHA20:
+        return Chacha20Cipher(secret)
+    elif mode == CIPHER_CHACHA20_POLY1305:
+        return Chacha20Poly1305Cipher(secret, responder)
+    raise ValueError('unknown cipher mode: %s' % mode)
+
 
 if __name__ == "__main__":
     # AES
@@ -73,6 +378,20 @@ if __name__ == "__main__":
     assert data == ddata
     assert dlen == len(edata)
 
+    # AES stream
+    encoder = AESFrameEncoder(cipher)
+    datas = [os.urandom(i * 100) for i in range(1, 20)]
+    for data in datas:
+        encoder.encode(data)
+    edata = encoder.take()
+    decoder = AESFrameDecoder(cipher)
+    ddatas = []
+    for i in range(0, len(edata), 333):
+        decoder.feed(edata[i:i + 333])
+        ddatas.extend(decoder.frames())
+    assert ddatas == datas
+    assert decoder.pending() == 0
+
     # Chacha20
     cipher = Chacha20Cipher(b'test')
     data = b'haha'
@@ -80,4 +399,38 @@ if __name__ == "__main__":
     ddata = cipher.decrypt(edata)
     assert data == ddata
 
+    # Chacha20-Poly1305
+    def handshake(secret):
+        client = Chacha20Poly1305Cipher(secret)
+        server = Chacha20Poly1305Cipher(secret, True)
+        request = client.encrypt_handshake(b'hello')
+        assert server.decrypt_handshake(request) == b'hello'
+        reply = server.encrypt_handshake(b'welcome')
+        assert client.decrypt_handshake(reply) == b'welcome'
+        return client, server, request, reply
+
+    cipher, peer, request, reply = handshake(b'test')
+    edatas = [cipher.encrypt(os.urandom(100)) for _ in range(3)]
+    assert peer.decrypt(edatas[1]) is not None
+    assert peer.decrypt(edatas[0]) is not None
+    assert peer.decrypt(edatas[0]) is None  # replay
+    assert peer.decrypt(edatas[2][:-1] + bytes([edatas[2][-1] ^ 1])) is None  # forged
+    assert peer.decrypt(edatas[2]) is not None
+    # each direction has a key of its own
+    assert cipher.decrypt(edatas[0]) is None
+    assert cipher.decrypt(peer.encrypt(b'back')) == b'back'
+    # a replayed handshake keeps the session and its replay window
+    assert cipher.decrypt_handshake(reply) == b'welcome'
+    assert peer.decrypt_handshake(request) == b'hello'
+    assert peer.decrypt(edatas[1]) is None
+    # datagrams and handshakes of another session never get in
+    old, old_peer, old_request, old_reply = handshake(b'test')
+    assert peer.decrypt(old.encrypt(b'old')) is None
+    assert cipher.decrypt_handshake(old_reply) is None
+    assert peer.decrypt(edatas[0]) is None
+    assert Chacha20Poly1305Cipher(b'other', True).decrypt_handshake(request) is None
+    assert Chacha20Poly1305Cipher(b'test', True).decrypt_handshake(reply) is None
+    assert Chacha20Poly1305Cipher(b'test').decrypt_handshake(request) is None
+    assert cipher.send_key != old.send_key and cipher.send_key != peer.send_key
+
     print('test ok')
\ No newline at end of file
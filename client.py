@@ -2,43 +2,134 @@ import threading
 import socket
 import select
 import time
+import zlib
 
-from cipher import Chacha20Cipher
-from config_helper import load_traffic, save_traffic
-from protocol import (Protocol, CMD_CLIENT_HANDSHAKE, CMD_SERVER_HANDSHAKE,
-                      CMD_CLIENT_DATA, CMD_SERVER_DATA)
+from cipher import new_cipher, CIPHER_CHACHA20
+from traffic_store import open_traffic_store
+from protocol import (Protocol, PacketHeader, pack_client_data, pack_client_aggregate, split_aggregate,
+                      CMD_CLIENT_HANDSHAKE, CMD_SERVER_HANDSHAKE, CMD_SERVER_DATA, CMD_SERVER_AGGREGATE_DATA,
+                      CMD_CLIENT_COMPRESSED_DATA, CMD_SERVER_COMPRESSED_DATA)
+from compression import Compressor, offer_algorithms
+from udp_batch import recv_batch, UDPBatchSender
+from crypto_offload import CryptoOffload
+from pmtu import PMTUProber
+from aggregator import PacketAggregator
+from packet_device import DEFAULT_MTU
+from packet_trace import TRACER, STAGE_CLIENT_SEND, STAGE_CLIENT_RECV
+from metrics import REGISTRY, Counter
 from logger import LOGGER
 
-TRAFFIC_SAVE_INTERVAL = 60
+TRAFFIC_FLUSH_INTERVAL = 10
+PACKET_BUFFER_SIZE = 2048
+RECV_BATCH_SIZE = 64
+SEND_BATCH_SIZE = 32
+
+STAGE_SECONDS = 'outernet_stage_seconds'
+STAGE_SECONDS_HELP = 'time spent per data path stage'
+TX_ENCRYPT_SECONDS = REGISTRY.histogram(STAGE_SECONDS, STAGE_SECONDS_HELP, {'stage': 'tx_encrypt'})
+TX_SEND_SECONDS = REGISTRY.histogram(STAGE_SECONDS, STAGE_SECONDS_HELP, {'stage': 'tx_send'})
+RX_DECRYPT_SECONDS = REGISTRY.histogram(STAGE_SECONDS, STAGE_SECONDS_HELP, {'stage': 'rx_decrypt'})
+
+
+def flow_shard(data, count):
+    '''
+    pick a socket for an ip packet by hashing its 5-tuple, so one flow
+    always leaves through the same socket and stays in order
+    '''
+    if count <= 1:
+        return 0
+    return flow_hash(data) % count
+
+
+def flow_hash(data):
+    '''crc32 of the 5-tuple of an ipv4 packet, 0 for anything else'''
+    if len(data) < 20 or data[0] & 0xf0 != 0x40:
+        return 0
+    # addresses and protocol
+    value = zlib.crc32(data[9:10])
+    value = zlib.crc32(data[12:20], value)
+    header_len = (data[0] & 0x0f) * 4
+    # ports, unless this is a fragment which carries none or may lack them
+    fragment = (data[6] & 0x3f) or data[7]
+    if data[9] in (6, 17) and not fragment and len(data) >= header_len + 4:
+        value = zlib.crc32(data[header_len:header_len + 4], value)
+    return value
 
 
 class Client:
 
-    def __init__(self, host, port, identification, secret, recv_callback, handshake_callback):
+    def __init__(self, host, port, identification, secret, recv_callback, handshake_callback, cipher_mode=CIPHER_CHACHA20,
+                 batch_io=False, crypto_workers=0, sockets=1, mtu_callback=None, aggregate_window=0, compression=None):
         LOGGER.debug("Client init")
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(('', 0))
+        # flows are sharded over several source ports so the server side can
+        # spread them across cores, the handshake uses the first socket
+        self.socks = []
+        for _ in range(max(1, sockets)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', 0))
+            self.socks.append(sock)
+        self.sock = self.socks[0]
         self.server_addr = (host, port)
         self.recv_cb = recv_callback
         self.handshake_cb = handshake_callback
-        self.cipher = Chacha20Cipher(secret)
+        self.cipher = new_cipher(cipher_mode, secret)
         self.identification = identification
+        # path mtu probing once connected, mtu_callback gets the tunnel mtu
+        self.mtu_cb = mtu_callback
+        self.pmtu_prober = None
+        if mtu_callback is not None:
+            self.pmtu_prober = PMTUProber(self.server_addr, identification, self.cipher, self.handle_mtu)
         self.running = False
         self.handshake_thread = None
         self.recv_thread = None
         self.traffic_thread = None
+        # packet buffers, send buffer is only used by the device read thread
+        self.send_buf = bytearray(PACKET_BUFFER_SIZE)
+        self.send_view = memoryview(self.send_buf)
+        self.recv_buf = bytearray(PACKET_BUFFER_SIZE)
+        self.recv_view = memoryview(self.recv_buf)
+        self.recv_header = PacketHeader()
+        # counted from several threads, each increments its own cell
+        self.rx_bytes = Counter()
+        self.tx_bytes = Counter()
+        self.rx_packets = Counter()
+        self.tx_packets = Counter()
+        self.tx_dropped = Counter()
+        # batched io, drains every ready datagram per wakeup and sends in bursts
+        self.batch_io = batch_io
+        self.recv_bufs = []
+        self.recv_views = []
+        self.batch_senders = []
+        if batch_io:
+            self.recv_bufs = [bytearray(PACKET_BUFFER_SIZE) for _ in range(RECV_BATCH_SIZE)]
+            self.recv_views = [memoryview(buf) for buf in self.recv_bufs]
+            # the senders count what reached the kernel and what they dropped
+            self.batch_senders = [UDPBatchSender(sock, self.server_addr, SEND_BATCH_SIZE,
+                                                 self.tx_bytes, self.tx_packets, self.tx_dropped)
+                                  for sock in self.socks]
+        # crypto offload to worker processes, pending packets per socket
+        self.crypto_offload = None
+        self.offload_pending = [[] for _ in self.socks]
+        self.offload_count = 0
+        if crypto_workers > 0:
+            self.crypto_offload = CryptoOffload(self.cipher, cipher_mode, secret, crypto_workers,
+                                                self.handle_encrypted, self.handle_decrypted)
+        # small packets of a flow sent within the window share one datagram
+        self.aggregator = None
+        if aggregate_window > 0:
+            self.aggregator = PacketAggregator(len(self.socks), DEFAULT_MTU, aggregate_window,
+                                               self.send_packets, self.flush_io)
+        # compression name to offer at handshake, the compressor exists once
+        # the server agreed to one
+        self.compression = compression
+        self.compressor = None
         # traffic
-        traffic = load_traffic()
+        self.traffic_store = open_traffic_store()
         self.rx_rate = 0
         self.tx_rate = 0
-        self.rx_tmp = 0
-        self.tx_tmp = 0
-        if traffic:
-            self.rx_total = traffic.get('rx', 0)
-            self.tx_total = traffic.get('tx', 0)
-        else:
-            self.rx_total = 0
-            self.tx_total = 0
+        self.rx_last = 0
+        self.tx_last = 0
+        self.rx_total, self.tx_total = self.traffic_store.totals()
 
     def run(self):
         LOGGER.debug("Client run")
@@ -49,10 +140,21 @@ class Client:
     def start_vpn(self):
         LOGGER.debug("Client start_vpn")
         self.running = True
-        self.recv_thread = threading.Thread(target=self.handle_recv)
+        if self.crypto_offload is not None:
+            self.crypto_offload.run()
+        if self.batch_io:
+            for sock in self.socks:
+                sock.setblocking(False)
+            self.recv_thread = threading.Thread(target=self.handle_recv_batch)
+        else:
+            self.recv_thread = threading.Thread(target=self.handle_recv)
         self.recv_thread.start()
         self.traffic_thread = threading.Thread(target=self.handle_traffic)
         self.traffic_thread.start()
+        if self.pmtu_prober is not None:
+            self.pmtu_prober.run()
+        if self.aggregator is not None:
+            self.aggregator.run()
 
     def stop(self):
         LOGGER.info("Client stop")
@@ -66,31 +168,105 @@ class Client:
         if self.traffic_thread is not None:
             while self.traffic_thread.is_alive():
                 time.sleep(0.1)
-        self.sock.close()
+        if self.crypto_offload is not None:
+            self.crypto_offload.stop()
+        if self.pmtu_prober is not None:
+            self.pmtu_prober.stop()
+        if self.aggregator is not None:
+            self.aggregator.stop()
+        for sock in self.socks:
+            sock.close()
 
     def send(self, data):
-        LOGGER.debug("Client send data: %s" % data)
-        protocol = Protocol()
-        protocol.cmd = CMD_CLIENT_DATA
-        protocol.identification = self.identification
-        protocol.data = data
-        send_data = self.wrap_data(protocol.get_bytes())
-        self.tx_tmp += len(send_data)
-        self.sock.sendto(send_data, self.server_addr)
+        if TRACER.enabled:
+            TRACER.record(STAGE_CLIENT_SEND, data)
+        shard = flow_shard(data, len(self.socks))
+        if self.aggregator is not None:
+            self.aggregator.send(shard, data)
+            return
+        self.send_plain(shard, self.pack_packet(data))
+
+    def send_packets(self, shard, packets):
+        if len(packets) == 1:
+            length = self.pack_packet(packets[0])
+        else:
+            length = pack_client_aggregate(self.send_buf, self.identification, packets)
+        self.send_plain(shard, length)
+
+    def pack_packet(self, data):
+        '''pack one ip packet into the send buffer, compressed where it pays off'''
+        if self.compressor is not None:
+            compressed = self.compressor.compress(data, flow_hash(data))
+            if compressed is not None:
+                return pack_client_data(self.send_buf, self.identification, compressed, CMD_CLIENT_COMPRESSED_DATA)
+        return pack_client_data(self.send_buf, self.identification, data)
+
+    def send_plain(self, shard, length):
+        '''encrypt and send the first length bytes of the send buffer'''
+        if self.crypto_offload is not None:
+            self.offload_pending[shard].append(bytes(self.send_view[:length]))
+            self.offload_count += 1
+            if self.offload_count >= SEND_BATCH_SIZE:
+                self.flush_io()
+            return
+        start = time.perf_counter()
+        send_data = self.wrap_data(self.send_view[:length])
+        encrypted = time.perf_counter()
+        self.send_datagram(send_data, shard)
+        TX_ENCRYPT_SECONDS.observe(encrypted - start)
+        TX_SEND_SECONDS.observe(time.perf_counter() - encrypted)
+
+    def send_datagram(self, send_data, shard=0):
+        if self.batch_senders:
+            self.batch_senders[shard].send(send_data)
+        else:
+            self.tx_bytes.inc(len(send_data))
+            self.tx_packets.inc()
+            self.socks[shard].sendto(send_data, self.server_addr)
+
+    def flush(self):
+        '''send out batched datagrams, called by the device when it goes idle.
+        packets held by the aggregator wait for its window or mtu limit'''
+        if self.aggregator is not None:
+            # the aggregator timer sends on its own thread under this lock
+            with self.aggregator.lock:
+                self.flush_io()
+        else:
+            self.flush_io()
+
+    def flush_io(self):
+        if self.crypto_offload is not None:
+            # the batch senders belong to the offload collector thread, it
+            # flushes them after every batch
+            if self.offload_count:
+                for shard, pending in enumerate(self.offload_pending):
+                    if pending:
+                        self.crypto_offload.encrypt(pending, shard)
+                self.offload_pending = [[] for _ in self.socks]
+                self.offload_count = 0
+        else:
+            for batch_sender in self.batch_senders:
+                batch_sender.flush()
+
+    def handle_encrypted(self, datagrams, shard):
+        # called in order by the offload collector thread, the only one
+        # sending through the batch senders then
+        for send_data in datagrams:
+            self.send_datagram(send_data, shard)
+        if self.batch_senders:
+            self.batch_senders[shard].flush()
 
     def handle_handshake(self):
         LOGGER.debug("Client handle_handshake")
-        protocol = Protocol()
-        protocol.cmd = CMD_CLIENT_HANDSHAKE
-        protocol.identification = self.identification
-        send_data = self.wrap_data(protocol.get_bytes())
+        send_data = self.cipher.encrypt_handshake(self.make_handshake())
         handshake_retry_cnt = 5
         while self.running:
             if handshake_retry_cnt <= 0:
                 self.handshake_cb(None, None)
                 break
             handshake_retry_cnt -= 1
-            self.tx_tmp += len(send_data)
+            self.tx_bytes.inc(len(send_data))
+            self.tx_packets.inc()
             self.sock.sendto(send_data, self.server_addr)
             try:
                 self.sock.settimeout(2)
@@ -99,69 +275,143 @@ class Client:
             except socket.timeout:
                 LOGGER.warning("Client handshake timeout")
                 continue
-            self.rx_tmp += len(data)
-            data = self.unwrap_data(data)
+            self.rx_bytes.inc(len(data))
+            self.rx_packets.inc()
+            data = self.cipher.decrypt_handshake(data)
+            if data is None:
+                continue
             protocol = Protocol()
             if protocol.parse(data) <= 1 or protocol.cmd != CMD_SERVER_HANDSHAKE:
                 continue
             LOGGER.debug("Client handshake recved")
+            self.accept_handshake(protocol)
             self.handshake_cb(protocol.tun_ip_raw, protocol.dst_ip_raw)
             self.start_vpn()
             break
 
+    def make_handshake(self):
+        protocol = Protocol()
+        protocol.cmd = CMD_CLIENT_HANDSHAKE
+        protocol.identification = self.identification
+        protocol.capabilities = offer_algorithms(self.compression)
+        return protocol.get_bytes()
+
+    def accept_handshake(self, protocol):
+        '''set up what the server picked from the offered capabilities'''
+        algorithm = protocol.capabilities
+        if algorithm and algorithm & offer_algorithms(self.compression) == algorithm:
+            LOGGER.info("Client compression %d enabled" % algorithm)
+            self.compressor = Compressor(algorithm)
+        else:
+            self.compressor = None
+
     def handle_recv(self):
         LOGGER.debug("Client handle_recv")
         while self.running:
-            readable, _, _ = select.select([self.sock, ], [], [], 1)
-            if not readable:
-                continue
-            data, _ = self.sock.recvfrom(2048)
-            self.rx_tmp += len(data)
-            data = self.unwrap_data(data)
-            protocol = Protocol()
-            if protocol.parse(data) <= 1 or protocol.cmd != CMD_SERVER_DATA:
-                continue
-            LOGGER.debug("Client recv data: %s" % protocol.data)
-            self.recv_cb(protocol.data)
+            readable, _, _ = select.select(self.socks, [], [], 1)
+            for sock in readable:
+                length, _ = sock.recvfrom_into(self.recv_buf)
+                if self.crypto_offload is not None:
+                    self.rx_bytes.inc(length)
+                    self.rx_packets.inc()
+                    self.crypto_offload.decrypt([self.recv_view[:length]])
+                    continue
+                self.handle_datagram(self.recv_view[:length])
+
+    def handle_recv_batch(self):
+        LOGGER.debug("Client handle_recv_batch")
+        while self.running:
+            readable, _, _ = select.select(self.socks, [], [], 1)
+            for sock in readable:
+                lengths = recv_batch(sock, self.recv_bufs)
+                if self.crypto_offload is not None:
+                    self.rx_bytes.inc(sum(lengths))
+                    self.rx_packets.inc(len(lengths))
+                    self.crypto_offload.decrypt([self.recv_views[i][:length] for i, length in enumerate(lengths)])
+                    continue
+                for i, length in enumerate(lengths):
+                    self.handle_datagram(self.recv_views[i][:length])
+
+    def handle_datagram(self, datagram):
+        self.rx_bytes.inc(len(datagram))
+        self.rx_packets.inc()
+        start = time.perf_counter()
+        data = self.unwrap_data(datagram)
+        RX_DECRYPT_SECONDS.observe(time.perf_counter() - start)
+        if data is None:
+            return
+        self.handle_plain(data)
+
+    def handle_decrypted(self, datas, tag):
+        # called in order by the offload collector thread
+        for data in datas:
+            self.handle_plain(data)
+
+    def handle_plain(self, data):
+        header = self.recv_header
+        if header.parse(data) <= 1:
+            return
+        if header.cmd == CMD_SERVER_DATA:
+            if TRACER.enabled:
+                TRACER.record(STAGE_CLIENT_RECV, header.data)
+            self.recv_cb(header.data)
+        elif header.cmd == CMD_SERVER_AGGREGATE_DATA:
+            for packet in split_aggregate(header.data):
+                if TRACER.enabled:
+                    TRACER.record(STAGE_CLIENT_RECV, packet)
+                self.recv_cb(packet)
+        elif header.cmd == CMD_SERVER_COMPRESSED_DATA:
+            if self.compressor is None:
+                return
+            packet = self.compressor.decompress(header.data)
+            if packet is None:
+                return
+            if TRACER.enabled:
+                TRACER.record(STAGE_CLIENT_RECV, packet)
+            self.recv_cb(packet)
+
+    def handle_mtu(self, mtu):
+        if self.aggregator is not None:
+            self.aggregator.set_limit(mtu)
+        self.mtu_cb(mtu)
 
     def handle_traffic(self):
         LOGGER.debug("Client handle_traffic")
         tick = 0
         while self.running:
-            self.rx_rate = self.rx_tmp
-            self.tx_rate = self.tx_tmp
-            self.rx_total += self.rx_tmp
-            self.tx_total += self.tx_tmp
-            self.rx_tmp = 0
-            self.tx_tmp = 0
-
-            if tick % TRAFFIC_SAVE_INTERVAL == 0:
-                traffic = {}
-                traffic['rx'] = self.rx_total
-                traffic['tx'] = self.tx_total
-                LOGGER.info("Client saving traffic rx: %d, tx: %d" % (self.rx_total, self.tx_total))
-                save_traffic(traffic)
-
+            self.update_traffic(tick)
             time.sleep(1)
             tick += 1
 
         # save on stop
-        traffic = {}
-        traffic['rx'] = self.rx_total
-        traffic['tx'] = self.tx_total
-        save_traffic(traffic)
+        self.save_traffic_totals()
+
+    def update_traffic(self, tick):
+        '''called once a second by the traffic loop'''
+        # counters only grow, rates are the difference to the last tick
+        rx = self.rx_bytes.value()
+        tx = self.tx_bytes.value()
+        self.rx_rate = rx - self.rx_last
+        self.tx_rate = tx - self.tx_last
+        self.rx_last = rx
+        self.tx_last = tx
+        self.traffic_store.add(self.rx_rate, self.tx_rate)
+        self.rx_total, self.tx_total = self.traffic_store.totals()
+
+        if tick % TRAFFIC_FLUSH_INTERVAL == 0:
+            self.save_traffic_totals()
+
+    def save_traffic_totals(self):
+        self.traffic_store.flush()
 
     def clear_traffic(self):
         LOGGER.debug("Client clear_traffic")
-        self.rx_total = 0
-        self.tx_total = 0
-        traffic = {}
-        traffic['rx'] = self.rx_total
-        traffic['tx'] = self.tx_total
-        save_traffic(traffic)
+        self.traffic_store.clear()
+        self.rx_total, self.tx_total = self.traffic_store.totals()
 
     def wrap_data(self, data):
         return self.cipher.encrypt(data)
 
     def unwrap_data(self, data):
+        '''returns None if the datagram is rejected by the cipher'''
         return self.cipher.decrypt(data)
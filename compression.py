@@ -0,0 +1,220 @@
+'''
+per packet compression of tunnel payloads
+
+every ip packet is compressed on its own, so a lost or reordered datagram
+never affects another one. the client offers the algorithms it has in a
+capability byte after the handshake identification, the server answers
+with the one it picked after the handshake addresses, servers that do not
+know the byte leave it out and compression stays off. compressed packets
+travel as CMD_CLIENT_COMPRESSED_DATA / CMD_SERVER_COMPRESSED_DATA.
+
+most tunneled bytes are tls or otherwise already compressed, so each flow
+is checked before spending cpu on it: tls ports and records are never
+compressed, payloads whose sample looks random are skipped, and a flow
+that did not shrink is skipped for a growing number of packets.
+'''
+import zlib
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# algorithm ids double as capability bits
+COMPRESS_NONE = 0x00
+COMPRESS_ZLIB = 0x01
+COMPRESS_LZ4 = 0x02
+
+COMPRESSION_NAMES = {
+    'zlib': COMPRESS_ZLIB,
+    'lz4': COMPRESS_LZ4,
+}
+
+ZLIB_LEVEL = 1
+ZLIB_WBITS = -15
+MAX_PACKET_SIZE = 65535
+# below this the saved bytes do not pay for the cpu
+MIN_COMPRESS_SIZE = 128
+# a packet has to shrink at least this much to go out compressed
+MAX_COMPRESS_RATIO = 0.9
+# 128 random bytes have about 100 distinct values, text rarely 60
+ENTROPY_SAMPLE_SIZE = 128
+ENTROPY_DISTINCT_LIMIT = 88
+# packets skipped after an incompressible one, doubled while it stays so
+MIN_BACKOFF = 16
+MAX_BACKOFF = 1024
+MAX_FLOWS = 4096
+FLOW_OFF = -1
+
+TLS_PORTS = frozenset((443, 465, 563, 853, 993, 995, 5223, 8443))
+# change cipher spec, alert, handshake, application data
+TLS_RECORD_TYPES = frozenset((0x14, 0x15, 0x16, 0x17))
+
+
+def available_algorithms():
+    '''capability bits of the algorithms usable in this process'''
+    return COMPRESS_ZLIB | (COMPRESS_LZ4 if lz4 is not None else 0)
+
+
+def offer_algorithms(name):
+    '''capability bits a client asking for name offers, zlib is always a fallback'''
+    algorithm = COMPRESSION_NAMES.get(name, COMPRESS_NONE)
+    if algorithm == COMPRESS_NONE:
+        return COMPRESS_NONE
+    return (algorithm | COMPRESS_ZLIB) & available_algorithms()
+
+
+def choose_algorithm(offered):
+    '''server side pick from the client's capability bits'''
+    offered &= available_algorithms()
+    if offered & COMPRESS_LZ4:
+        return COMPRESS_LZ4
+    if offered & COMPRESS_ZLIB:
+        return COMPRESS_ZLIB
+    return COMPRESS_NONE
+
+
+def payload_offset(data):
+    '''offset of the tcp/udp payload of an ipv4 packet, None for anything else'''
+    if len(data) < 20 or data[0] & 0xf0 != 0x40:
+        return None
+    # later fragments carry no transport header
+    if (data[6] & 0x1f) or data[7]:
+        return None
+    header_len = (data[0] & 0x0f) * 4
+    proto = data[9]
+    if proto == 6 and len(data) >= header_len + 20:
+        return header_len + (data[header_len + 12] >> 4) * 4
+    if proto == 17 and len(data) >= header_len + 8:
+        return header_len + 8
+    return None
+
+
+def is_tls(data, offset):
+    header_len = (data[0] & 0x0f) * 4
+    sport = (data[header_len] << 8) | data[header_len + 1]
+    dport = (data[header_len + 2] << 8) | data[header_len + 3]
+    if sport in TLS_PORTS or dport in TLS_PORTS:
+        return True
+    return len(data) >= offset + 3 and data[offset] in TLS_RECORD_TYPES and data[offset + 1] == 0x03
+
+
+class Compressor:
+    '''
+    compresses packets of the negotiated algorithm and tracks per flow
+    whether it is worth it. not thread safe, compress() is meant for the
+    one thread sending and decompress() for the one receiving.
+    '''
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.flows = {}
+        # stats, compressed bytes in and out, received bytes inflated
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped = 0
+        self.inflated = 0
+
+    def compress(self, data, flow):
+        '''compressed packet, or None when data should go out as it is'''
+        length = len(data)
+        if length < MIN_COMPRESS_SIZE:
+            return None
+        state = self.flows.get(flow)
+        if state is None:
+            if len(self.flows) >= MAX_FLOWS:
+                self.flows.clear()
+            # skip count, backoff
+            state = [0, 0]
+            self.flows[flow] = state
+            offset = payload_offset(data)
+            if offset is not None and is_tls(data, offset):
+                state[0] = FLOW_OFF
+        skip = state[0]
+        if skip:
+            if skip > 0:
+                state[0] = skip - 1
+            self.skipped += 1
+            return None
+        offset = payload_offset(data)
+        if offset is not None:
+            sample = data[offset:offset + ENTROPY_SAMPLE_SIZE]
+            if len(sample) == ENTROPY_SAMPLE_SIZE and len(set(sample)) >= ENTROPY_DISTINCT_LIMIT:
+                self.back_off(state)
+                return None
+        compressed = self.pack(data)
+        if len(compressed) > length * MAX_COMPRESS_RATIO:
+            self.back_off(state)
+            return None
+        state[1] = 0
+        self.bytes_in += length
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def back_off(self, state):
+        state[1] = min(MAX_BACKOFF, max(MIN_BACKOFF, state[1] * 2))
+        state[0] = state[1]
+        self.skipped += 1
+
+    def pack(self, data):
+        if self.algorithm == COMPRESS_LZ4:
+            return lz4.block.compress(data, mode='fast', store_size=True)
+        compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, ZLIB_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        '''None for a corrupt payload or one inflating beyond MAX_PACKET_SIZE'''
+        try:
+            if self.algorithm == COMPRESS_LZ4:
+                if len(data) < 4 or int.from_bytes(data[:4], 'little') > MAX_PACKET_SIZE:
+                    return None
+                packet = lz4.block.decompress(data)
+            else:
+                decompressor = zlib.decompressobj(ZLIB_WBITS)
+                packet = decompressor.decompress(data, MAX_PACKET_SIZE)
+                if decompressor.unconsumed_tail or not decompressor.eof:
+                    return None
+        except Exception:
+            return None
+        self.inflated += len(packet) - len(data)
+        return packet
+
+    def saved(self):
+        return self.bytes_in - self.bytes_out
+
+
+if __name__ == "__main__":
+    import os
+    import struct
+
+    def udp_packet(sport, dport, payload):
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(payload), 0, 0, 64, 17, 0,
+                             bytes([10, 0, 0, 2]), bytes([10, 0, 0, 1]))
+        return header + struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload
+
+    assert choose_algorithm(offer_algorithms('zlib')) == COMPRESS_ZLIB
+    assert choose_algorithm(offer_algorithms('lz4')) in (COMPRESS_ZLIB, COMPRESS_LZ4)
+    assert choose_algorithm(0) == COMPRESS_NONE
+
+    compressor = Compressor(COMPRESS_ZLIB)
+    text = udp_packet(40000, 80, b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n' * 20)
+    compressed = compressor.compress(text, 1)
+    assert compressed is not None and len(compressed) < len(text) / 4
+    assert compressor.decompress(compressed) == text
+    assert compressor.decompress(b'\xff' + compressed) is None
+
+    # tls flows are never tried, random payloads back off
+    assert compressor.compress(udp_packet(40001, 443, b'a' * 500), 2) is None
+    assert compressor.flows[2][0] == FLOW_OFF
+    assert compressor.compress(udp_packet(40002, 9, os.urandom(500)), 3) is None
+    assert compressor.flows[3] == [MIN_BACKOFF, MIN_BACKOFF]
+    for _ in range(MIN_BACKOFF):
+        assert compressor.compress(text, 3) is None
+    assert compressor.compress(text, 3) is not None
+    assert compressor.flows[3] == [0, 0]
+
+    # inflating beyond a packet is refused
+    bomb = zlib.compressobj(9, zlib.DEFLATED, ZLIB_WBITS)
+    assert compressor.decompress(bomb.compress(bytes(200000)) + bomb.flush()) is None
+    print('saved %d bytes, skipped %d packets' % (compressor.saved(), compressor.skipped))
+    print('test ok')
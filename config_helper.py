@@ -25,25 +25,6 @@ def save_config(config):
         LOGGER.warning('error writing configuration')
         return False
 
-def load_traffic():
-    try:
-        traffic = yaml.load(open(TRAFFIC_FILE))
-        return traffic
-    except Exception:
-        LOGGER.warning('missing traffic file or format incorrect')
-        return None
-
-
-def save_traffic(traffic):
-    try:
-        f = open(TRAFFIC_FILE, 'w+')
-        yaml.dump(traffic, f)
-        return True
-    except Exception:
-        LOGGER.warning('error writing traffic')
-        return False
-
-
 def load_filter():
     try:
         ffilter = yaml.load(open(FILTER_FILE))
@@ -0,0 +1,288 @@
+import multiprocessing
+import struct
+import threading
+
+from multiprocessing import shared_memory
+from queue import Queue
+from cipher import new_cipher, Chacha20Poly1305Cipher
+from logger import LOGGER
+
+DIRECTION_ENCRYPT = 0
+DIRECTION_DECRYPT = 1
+
+RING_SLOTS = 256
+# a full 2048 bytes datagram with the slot header and the aead overhead
+SLOT_SIZE = 2112
+# payload length and the nonce of an opened aead datagram
+SLOT_HEADER = struct.Struct('!I12s')
+SLOT_DROPPED = 0xffffffff
+
+
+class ShmRing:
+    '''fixed size packet slots in a shared memory block'''
+
+    def __init__(self, slots=RING_SLOTS, slot_size=SLOT_SIZE, name=None):
+        self.slots = slots
+        self.slot_size = slot_size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+
+    def fits(self, data):
+        return len(data) <= self.slot_size - SLOT_HEADER.size
+
+    def write(self, index, data, nonce=b''):
+        '''False if data does not fit a slot'''
+        offset = index * self.slot_size
+        length = len(data)
+        if length > self.slot_size - SLOT_HEADER.size:
+            return False
+        SLOT_HEADER.pack_into(self.buf, offset, length, nonce)
+        start = offset + SLOT_HEADER.size
+        self.buf[start:start + length] = data
+        return True
+
+    def write_dropped(self, index):
+        SLOT_HEADER.pack_into(self.buf, index * self.slot_size, SLOT_DROPPED, b'')
+
+    def read(self, index):
+        '''returns (data, nonce), data is None for dropped packets'''
+        offset = index * self.slot_size
+        length, nonce = SLOT_HEADER.unpack_from(self.buf, offset)
+        if length == SLOT_DROPPED:
+            return None, nonce
+        start = offset + SLOT_HEADER.size
+        return bytes(self.buf[start:start + length]), nonce
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def crypto_worker(direction, cipher_mode, secret, session_keys, in_name, out_name, slots, slot_size, task_conn, done_conn):
+    '''worker process entry, handles batches of ring slots until told to stop'''
+    cipher = new_cipher(cipher_mode, secret)
+    aead = isinstance(cipher, Chacha20Poly1305Cipher)
+    if aead:
+        cipher.set_session_keys(*session_keys)
+    in_ring = ShmRing(slots, slot_size, in_name)
+    out_ring = ShmRing(slots, slot_size, out_name)
+    try:
+        while True:
+            task = task_conn.recv()
+            if task is None:
+                break
+            start, count, counter = task
+            for i in range(count):
+                index = (start + i) % slots
+                data, _ = in_ring.read(index)
+                if direction == DIRECTION_ENCRYPT:
+                    if aead:
+                        written = out_ring.write(index, cipher.seal(data, counter + i))
+                    else:
+                        written = out_ring.write(index, cipher.encrypt(data))
+                elif aead:
+                    opened = cipher.open(data)
+                    written = opened is not None and out_ring.write(index, opened[1], opened[0])
+                else:
+                    written = out_ring.write(index, cipher.decrypt(data))
+                if not written:
+                    out_ring.write_dropped(index)
+            done_conn.send(task)
+    finally:
+        in_ring.close()
+        out_ring.close()
+
+
+class CryptoWorker:
+    '''a worker process with its input and output rings'''
+
+    def __init__(self, ctx, direction, cipher_mode, secret):
+        self.ctx = ctx
+        self.direction = direction
+        self.cipher_mode = cipher_mode
+        self.secret = secret
+        self.in_ring = ShmRing()
+        self.out_ring = ShmRing()
+        self.task_recv, self.task_send = ctx.Pipe(duplex=False)
+        self.done_recv, self.done_send = ctx.Pipe(duplex=False)
+        self.free_slots = threading.Semaphore(RING_SLOTS)
+        self.write_pos = 0
+        self.process = None
+
+    def start(self, session_keys):
+        '''session_keys of an aead cipher, known once the handshake is done'''
+        self.process = self.ctx.Process(target=crypto_worker, daemon=True,
+                                        args=(self.direction, self.cipher_mode, self.secret, session_keys,
+                                              self.in_ring.name, self.out_ring.name, RING_SLOTS, SLOT_SIZE,
+                                              self.task_recv, self.done_send))
+        self.process.start()
+        # the worker has its own copies, with ours closed the pipes report
+        # eof once it exits
+        self.task_recv.close()
+        self.done_send.close()
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.task_send.send(None)
+            except Exception:
+                pass
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.in_ring.close()
+        self.in_ring.unlink()
+        self.out_ring.close()
+        self.out_ring.unlink()
+
+
+class CryptoStage:
+    '''
+    one direction of the offload. batches go round robin to the workers and
+    are collected in dispatch order, so packets leave in the order they came.
+    once a worker dies the stage runs the cipher inline on the submitting
+    thread instead
+    '''
+
+    def __init__(self, ctx, direction, cipher, cipher_mode, secret, workers, callback):
+        self.direction = direction
+        self.cipher = cipher
+        self.aead = isinstance(cipher, Chacha20Poly1305Cipher)
+        self.workers = [CryptoWorker(ctx, direction, cipher_mode, secret) for _ in range(workers)]
+        self.callback = callback
+        self.next_worker = 0
+        self.dispatched = Queue()
+        self.collect_thread = None
+        self.failed = False
+        # stats, packets too large for a ring slot
+        self.dropped = 0
+
+    def start(self):
+        session_keys = self.cipher.session_keys() if self.aead else None
+        for worker in self.workers:
+            worker.start(session_keys)
+        self.collect_thread = threading.Thread(target=self.handle_collect)
+        self.collect_thread.start()
+
+    def stop(self):
+        self.dispatched.put(None)
+        if self.collect_thread is not None:
+            self.collect_thread.join()
+        for worker in self.workers:
+            worker.stop()
+
+    def submit(self, packets, tag=None):
+        '''only one thread may submit to a stage, tag is handed back to the callback'''
+        if not all(self.workers[0].in_ring.fits(data) for data in packets):
+            fitting = [data for data in packets if self.workers[0].in_ring.fits(data)]
+            self.dropped += len(packets) - len(fitting)
+            packets = fitting
+        while packets and not self.failed:
+            batch = packets[:RING_SLOTS]
+            worker = self.workers[self.next_worker]
+            self.next_worker = (self.next_worker + 1) % len(self.workers)
+            count = len(batch)
+            for _ in range(count):
+                worker.free_slots.acquire()
+            if self.failed:
+                break
+            start = worker.write_pos
+            for i, data in enumerate(batch):
+                worker.in_ring.write((start + i) % RING_SLOTS, data)
+            worker.write_pos = (start + count) % RING_SLOTS
+            counter = 0
+            if self.aead and self.direction == DIRECTION_ENCRYPT:
+                counter = self.cipher.reserve(count)
+            try:
+                worker.task_send.send((start, count, counter))
+            except OSError:
+                self.fail()
+                break
+            self.dispatched.put((worker, tag))
+            packets = packets[RING_SLOTS:]
+        if packets and self.failed:
+            self.run_inline(packets, tag)
+
+    def run_inline(self, packets, tag):
+        results = []
+        for data in packets:
+            if self.direction == DIRECTION_ENCRYPT:
+                results.append(self.cipher.encrypt(data))
+            else:
+                data = self.cipher.decrypt(data)
+                if data is not None:
+                    results.append(data)
+        if results:
+            self.callback(results, tag)
+
+    def fail(self):
+        '''switch to inline crypto and wake a submit waiting for slots'''
+        if not self.failed:
+            LOGGER.error("CryptoStage worker exited, running crypto inline")
+        self.failed = True
+        for worker in self.workers:
+            worker.free_slots.release(RING_SLOTS)
+
+    def handle_collect(self):
+        while True:
+            item = self.dispatched.get()
+            if item is None:
+                return
+            worker, tag = item
+            try:
+                start, count, _ = worker.done_recv.recv()
+            except (EOFError, OSError):
+                # batches still in flight are lost
+                self.fail()
+                return
+            results = []
+            for i in range(count):
+                data, nonce = worker.out_ring.read((start + i) % RING_SLOTS)
+                worker.free_slots.release()
+                if data is None:
+                    continue
+                if self.aead and self.direction == DIRECTION_DECRYPT and not self.cipher.check_replay(nonce):
+                    continue
+                results.append(data)
+            if results:
+                self.callback(results, tag)
+
+
+class CryptoOffload:
+    '''
+    moves encryption and decryption into worker processes, packets are
+    passed through shared memory rings and results come back in order
+    through encrypt_callback and decrypt_callback
+    '''
+
+    def __init__(self, cipher, cipher_mode, secret, workers, encrypt_callback, decrypt_callback):
+        LOGGER.debug("CryptoOffload init")
+        ctx = multiprocessing.get_context('spawn')
+        self.encrypt_stage = CryptoStage(ctx, DIRECTION_ENCRYPT, cipher, cipher_mode, secret, workers, encrypt_callback)
+        self.decrypt_stage = CryptoStage(ctx, DIRECTION_DECRYPT, cipher, cipher_mode, secret, workers, decrypt_callback)
+
+    def run(self):
+        LOGGER.debug("CryptoOffload run")
+        self.encrypt_stage.start()
+        self.decrypt_stage.start()
+
+    def stop(self):
+        LOGGER.info("CryptoOffload stop")
+        self.encrypt_stage.stop()
+        self.decrypt_stage.stop()
+
+    def encrypt(self, packets, tag=None):
+        self.encrypt_stage.submit(packets, tag)
+
+    def decrypt(self, datagrams, tag=None):
+        self.decrypt_stage.submit(datagrams, tag)
+
+    def dropped(self):
+        return self.encrypt_stage.dropped + self.decrypt_stage.dropped
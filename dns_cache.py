@@ -0,0 +1,175 @@
+'''
+answer cache for the direct dns path
+
+entries are keyed by (qname, qtype) and hold the resolved ipv4 addresses
+until the record ttl runs out, clamped so that very short ttls still
+absorb bursts and very long ones do not pin stale routes. the least
+recently used entries go first once the estimated size passes the cap.
+lookups of a key already being resolved by another thread wait for that
+one instead of querying upstream again.
+'''
+import threading
+import time
+
+from collections import OrderedDict
+from logger import LOGGER
+
+DNS_CACHE_MIN_TTL = 30
+DNS_CACHE_MAX_TTL = 3600
+# empty answers, nxdomain or no a records
+DNS_CACHE_NEGATIVE_TTL = 30
+DNS_CACHE_MAX_BYTES = 1024 * 1024
+# rough per entry cost of the dict slot, key and value objects
+ENTRY_OVERHEAD = 200
+ADDRESS_SIZE = 64
+# upper bound for waiting on another thread's lookup
+INFLIGHT_TIMEOUT = 5
+
+
+class DNSCache:
+    def __init__(self, max_bytes=DNS_CACHE_MAX_BYTES, min_ttl=DNS_CACHE_MIN_TTL, max_ttl=DNS_CACHE_MAX_TTL):
+        self.max_bytes = max_bytes
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        # (qname, qtype) -> (expires, addresses, size), oldest use first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # stats
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, qname, qtype):
+        '''(addresses, remaining ttl) or None'''
+        key = (qname, qtype)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, addresses, size = entry
+            if expires <= now:
+                del self.entries[key]
+                self.size -= size
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return addresses, int(expires - now)
+
+    def put(self, qname, qtype, addresses, ttl):
+        '''ttl of None means the lookup failed, which is not cached'''
+        if ttl is None:
+            return
+        if not addresses:
+            ttl = min(ttl, DNS_CACHE_NEGATIVE_TTL) if ttl else DNS_CACHE_NEGATIVE_TTL
+        ttl = max(self.min_ttl, min(self.max_ttl, ttl))
+        key = (qname, qtype)
+        size = ENTRY_OVERHEAD + len(qname) + ADDRESS_SIZE * len(addresses)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (time.monotonic() + ttl, list(addresses), size)
+            self.size += size
+            while self.size > self.max_bytes and self.entries:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        LOGGER.info("DNSCache clear")
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class InflightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = ([], None)
+
+
+class InflightQueries:
+    '''merges concurrent lookups of the same key into one call'''
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        # stats
+        self.coalesced = 0
+
+    def run(self, key, func):
+        '''func() in the first caller for key, later callers get its result'''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = InflightCall()
+                self.calls[key] = call
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not call.event.wait(INFLIGHT_TIMEOUT):
+                LOGGER.warning("InflightQueries %s timed out" % (key,))
+            return call.result
+        try:
+            call.result = func()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+
+if __name__ == "__main__":
+    cache = DNSCache(max_bytes=3 * (ENTRY_OVERHEAD + 20 + ADDRESS_SIZE))
+    assert cache.get(b'example.com', 1) is None
+    cache.put(b'example.com', 1, ['93.184.216.34'], 5)
+    addresses, ttl = cache.get(b'example.com', 1)
+    # short ttls are raised to the minimum
+    assert addresses == ['93.184.216.34'] and DNS_CACHE_MIN_TTL - 1 <= ttl <= DNS_CACHE_MIN_TTL
+    assert cache.get(b'example.com', 28) is None
+    cache.put(b'example.com', 28, [], 300)
+    assert cache.get(b'example.com', 28)[1] <= DNS_CACHE_NEGATIVE_TTL
+
+    # failures are not kept, expired entries go
+    cache.put(b'fail.example', 1, [], None)
+    assert cache.get(b'fail.example', 1) is None
+    cache.min_ttl = 0
+    cache.put(b'gone.example', 1, ['10.0.0.1'], 0)
+    assert cache.get(b'gone.example', 1) is None
+
+    # least recently used is evicted under the cap
+    for name in (b'a.example', b'b.example', b'c.example'):
+        cache.put(name, 1, ['10.0.0.1'], 60)
+    assert cache.get(b'example.com', 1) is None
+    assert cache.get(b'a.example', 1) is not None
+    cache.put(b'd.example', 1, ['10.0.0.2'], 60)
+    assert cache.get(b'b.example', 1) is None
+    assert cache.get(b'a.example', 1) is not None
+    assert cache.size <= cache.max_bytes
+
+    # one call for concurrent lookups of a key
+    inflight = InflightQueries()
+    calls = []
+
+    def slow_lookup():
+        calls.append(1)
+        time.sleep(0.2)
+        return ['10.0.0.3'], 60
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(inflight.run((b'e.example', 1), slow_lookup)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and results == [(['10.0.0.3'], 60)] * 8
+    assert inflight.coalesced == 7 and not inflight.calls
+    print('hits %d, misses %d' % (cache.hits, cache.misses))
+    print('test ok')
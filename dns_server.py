@@ -4,43 +4,67 @@ import time
 from queue import Queue
 from logger import LOGGER
 from dns_utils import re_resolve_dns
+from dns_cache import DNSCache, InflightQueries
+from dns_upstream import UpstreamResolver
+
+# queries resolved in parallel, one slow upstream answer only holds its worker
+DNS_WORKERS = 8
 
 
 class DNSServer:
-    def __init__(self, filter_rule, packet_callback):
+    def __init__(self, filter_rule, packet_callback, workers=DNS_WORKERS, upstream_servers=None):
+        '''upstream_servers are 'ip' or 'ip:port', the filter's direct dns server by default'''
         LOGGER.debug("DNSServer init")
         self.filter = filter_rule
         self.callback = packet_callback
         self.packet_queue = Queue()
+        self.cache = DNSCache()
+        self.inflight = InflightQueries()
+        self.upstream_servers = upstream_servers
+        self.upstream = None
+        self.workers = workers
         self.running = False
-        self.packet_thread = None
+        self.packet_threads = []
 
     def run(self):
         LOGGER.debug("DNSServer run")
         self.running = True
-        self.packet_thread = threading.Thread(target=self.handle_packet)
-        self.packet_thread.start()
+        self.upstream = UpstreamResolver(self.upstream_servers or [self.filter.default_dns_server])
+        self.upstream.run()
+        self.packet_threads = [threading.Thread(target=self.handle_packet) for _ in range(self.workers)]
+        for packet_thread in self.packet_threads:
+            packet_thread.start()
 
     def stop(self):
         LOGGER.info("DNSServer stop")
         self.running = False
-        if self.packet_thread is not None:
-            while self.packet_thread.is_alive():
+        for packet_thread in self.packet_threads:
+            while packet_thread.is_alive():
                 time.sleep(0.1)
+        self.packet_threads = []
+        if self.upstream is not None:
+            self.upstream.stop()
+            self.upstream = None
 
-    def resolve(self, packet):
+    def resolve(self, packet, context=None):
+        '''context is the DNSPacketContext of packet if the caller parsed it already'''
         LOGGER.debug("DNSServer resolve")
-        self.packet_queue.put(packet)
+        # the device may reuse the packet buffer once we return
+        self.packet_queue.put((bytes(packet), context))
 
     def handle_packet(self):
         LOGGER.debug("DNSServer handle_packet")
         while self.running:
             try:
-                packet = self.packet_queue.get(timeout=0.1)
+                packet, context = self.packet_queue.get(timeout=0.1)
             except Exception:
                 continue
 
-            packet, answers = re_resolve_dns(packet, [self.filter.default_dns_server], True)
+            try:
+                packet, answers = re_resolve_dns(packet, None, True, self.cache, self.inflight, context, self.upstream)
+            except Exception as err:
+                LOGGER.warning("DNSServer resolve failed: %s" % err)
+                continue
             for key, value in answers.items():
                 for item in value:
                     self.filter.hit_ip(item + '/32')
@@ -0,0 +1,512 @@
+'''
+upstream dns client for the direct dns path
+
+a few long lived udp sockets are shared by all queries, replies are
+matched to their query by socket, transaction id, server address and
+question. a truncated reply is asked again over tcp on a connection kept
+open per server. with several servers the one with the lowest smoothed
+rtt is asked first, one that timed out moves to the back for a while.
+
+servers are 'ip' or 'ip:port', so a local stand-in resolver works too:
+
+    resolver = UpstreamResolver(['127.0.0.1:5353'])
+    resolver.run()
+    addresses, ttl = resolver.query(b'example.com')
+
+on an event loop run_async() opens datagram endpoints instead of the
+receiving thread, and query_async() waits on futures instead of blocking:
+
+    await resolver.run_async()
+    addresses, ttl = await resolver.query_async(b'example.com')
+'''
+import asyncio
+import secrets
+import select
+import socket
+import struct
+import threading
+import time
+
+import dnslib
+
+from dns_utils import DNS_PORT, DNS_HEADER
+from logger import LOGGER
+
+DNS_UPSTREAM_SOCKETS = 2
+DNS_UPSTREAM_TIMEOUT = 1.0
+# rtt assumed for a server not measured yet
+INITIAL_RTT = 0.05
+RTT_WEIGHT = 0.2
+# a server that timed out is asked last for this long
+FAILOVER_HOLD = 30
+DNS_FLAG_RD = 0x0100
+DNS_FLAG_TC = 0x0200
+DNS_RCODE_NXDOMAIN = 3
+QTYPE_A = 1
+QTYPE_CNAME = 5
+QCLASS_IN = 1
+TCP_LENGTH = struct.Struct('!H')
+MAX_UDP_REPLY = 4096
+
+
+def parse_server(server):
+    '''(ip, port) of 'ip' or 'ip:port' '''
+    host, _, port = server.partition(':')
+    return host, int(port) if port else DNS_PORT
+
+
+def pack_question(qname, qtype):
+    labels = [label for label in qname.split(b'.') if label]
+    if any(len(label) > 63 for label in labels):
+        raise ValueError('dns label too long')
+    return b''.join(bytes([len(label)]) + label for label in labels) + b'\x00' + struct.pack('!HH', qtype, QCLASS_IN)
+
+
+def reply_answers(reply, qname):
+    '''(ipv4 addresses, ttl) of qname in a parsed reply, following cnames'''
+    addresses = []
+    ttls = []
+    names = {qname.lower().rstrip(b'.')}
+    # cnames usually come first, a few rounds cover chains in any order
+    for _ in range(8):
+        grew = False
+        for rr in reply.rr:
+            rname = b'.'.join(rr.rname.label).lower()
+            if rname not in names:
+                continue
+            if rr.rtype == QTYPE_CNAME:
+                target = b'.'.join(rr.rdata.label.label).lower()
+                if target not in names:
+                    names.add(target)
+                    ttls.append(rr.ttl)
+                    grew = True
+        if not grew:
+            break
+    for rr in reply.rr:
+        if rr.rtype == QTYPE_A and b'.'.join(rr.rname.label).lower() in names:
+            addresses.append(str(rr.rdata))
+            ttls.append(rr.ttl)
+    return addresses, min(ttls) if addresses else 0
+
+
+class PendingQuery:
+    '''a query waiting for its reply, on an event or, on the loop, a future'''
+
+    def __init__(self, addr, question, future=None):
+        self.addr = addr
+        self.question = question
+        self.future = future
+        self.event = threading.Event() if future is None else None
+        self.reply = None
+
+    def answer(self, data):
+        self.reply = data
+        if self.future is None:
+            self.event.set()
+        elif not self.future.done():
+            self.future.set_result(data)
+
+
+class Upstream:
+    '''one server, its rtt estimate and its tcp connection'''
+
+    def __init__(self, server):
+        self.addr = parse_server(server)
+        self.srtt = INITIAL_RTT
+        self.down_until = 0
+        self.tcp_sock = None
+        self.tcp_lock = threading.Lock()
+        # reader and writer of the connection used on the event loop
+        self.tcp_stream = None
+        self.tcp_stream_lock = None
+
+    def rank(self, now):
+        if self.down_until and now >= self.down_until:
+            # give it another chance on equal terms
+            self.down_until = 0
+            self.srtt = INITIAL_RTT
+        return self.down_until > now, self.srtt
+
+    def answered(self, rtt):
+        self.srtt += RTT_WEIGHT * (rtt - self.srtt)
+
+    def timed_out(self, timeout):
+        LOGGER.warning("UpstreamResolver %s:%d timed out" % self.addr)
+        self.srtt = max(self.srtt * 2, timeout)
+        self.down_until = time.monotonic() + FAILOVER_HOLD
+
+    def close_tcp(self):
+        if self.tcp_sock is not None:
+            self.tcp_sock.close()
+            self.tcp_sock = None
+
+    def close_tcp_stream(self):
+        if self.tcp_stream is not None:
+            self.tcp_stream[1].close()
+            self.tcp_stream = None
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver, index):
+        self.resolver = resolver
+        self.index = index
+
+    def datagram_received(self, data, addr):
+        self.resolver.handle_reply(self.index, data, addr)
+
+    def error_received(self, exc):
+        LOGGER.warning("UpstreamResolver socket error: %s" % exc)
+
+
+class UpstreamResolver:
+    '''
+    query() is blocking and may be called from any number of threads once
+    run() was called. query_async() is for the event loop run_async() was
+    awaited on, both share the server ranking and the reply matching
+    '''
+
+    def __init__(self, servers, sockets=DNS_UPSTREAM_SOCKETS, timeout=DNS_UPSTREAM_TIMEOUT):
+        LOGGER.debug("UpstreamResolver init")
+        self.upstreams = [Upstream(server) for server in servers]
+        self.timeout = timeout
+        self.socket_count = max(1, sockets)
+        self.socks = []
+        # datagram transports instead of socks on the event loop
+        self.transports = []
+        self.next_sock = 0
+        # (socket index, txid) -> PendingQuery
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.recv_thread = None
+
+    def run(self):
+        LOGGER.debug("UpstreamResolver run")
+        for _ in range(self.socket_count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', 0))
+            sock.setblocking(False)
+            self.socks.append(sock)
+        self.running = True
+        self.recv_thread = threading.Thread(target=self.handle_recv)
+        self.recv_thread.start()
+
+    async def run_async(self):
+        LOGGER.debug("UpstreamResolver run_async")
+        loop = asyncio.get_running_loop()
+        for index in range(self.socket_count):
+            transport, _ = await loop.create_datagram_endpoint(lambda index=index: UpstreamProtocol(self, index),
+                                                               local_addr=('0.0.0.0', 0))
+            self.transports.append(transport)
+        self.running = True
+
+    def stop(self):
+        LOGGER.info("UpstreamResolver stop")
+        self.running = False
+        if self.recv_thread is not None:
+            self.recv_thread.join()
+            self.recv_thread = None
+        for sock in self.socks:
+            sock.close()
+        self.socks = []
+        for upstream in self.upstreams:
+            with upstream.tcp_lock:
+                upstream.close_tcp()
+
+    async def stop_async(self):
+        LOGGER.info("UpstreamResolver stop_async")
+        self.running = False
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+        for upstream in self.upstreams:
+            upstream.close_tcp_stream()
+
+    def ranked(self):
+        '''upstreams in the order to ask them'''
+        now = time.monotonic()
+        return sorted(self.upstreams, key=lambda upstream: upstream.rank(now))
+
+    def query(self, qname, qtype=QTYPE_A):
+        '''(ipv4 addresses, ttl) like dns_utils.query_dns_answers'''
+        try:
+            question = pack_question(qname, qtype)
+        except ValueError:
+            return [], None
+        for upstream in self.ranked():
+            data = self.query_udp(upstream, question)
+            if data is not None and DNS_HEADER.unpack_from(data)[1] & DNS_FLAG_TC:
+                data = self.query_tcp(upstream, question)
+            result = self.reply_result(upstream, data, qname)
+            if result is not None:
+                return result
+        return [], None
+
+    async def query_async(self, qname, qtype=QTYPE_A):
+        '''query() on the event loop'''
+        try:
+            question = pack_question(qname, qtype)
+        except ValueError:
+            return [], None
+        for upstream in self.ranked():
+            data = await self.query_udp_async(upstream, question)
+            if data is not None and DNS_HEADER.unpack_from(data)[1] & DNS_FLAG_TC:
+                data = await self.query_tcp_async(upstream, question)
+            result = self.reply_result(upstream, data, qname)
+            if result is not None:
+                return result
+        return [], None
+
+    def reply_result(self, upstream, data, qname):
+        '''(ipv4 addresses, ttl) of a raw reply, None to ask the next server'''
+        if data is None:
+            return None
+        try:
+            reply = dnslib.DNSRecord.parse(data)
+        except Exception as err:
+            LOGGER.warning("UpstreamResolver bad reply from %s:%d: %s" % (upstream.addr + (err,)))
+            return None
+        rcode = reply.header.rcode
+        if rcode == DNS_RCODE_NXDOMAIN:
+            return [], 0
+        if rcode != 0:
+            # servfail, refused, ask the next one
+            return None
+        return reply_answers(reply, qname)
+
+    def add_pending(self, upstream, question, future=None):
+        '''(socket index, txid, PendingQuery) of a new query, None when stopped'''
+        with self.lock:
+            count = len(self.socks) or len(self.transports)
+            if not count:
+                return None
+            index = self.next_sock % count
+            self.next_sock = (index + 1) % count
+            while True:
+                txid = secrets.randbits(16)
+                if (index, txid) not in self.pending:
+                    break
+            pending = PendingQuery(upstream.addr, question, future)
+            self.pending[(index, txid)] = pending
+        return index, txid, pending
+
+    def remove_pending(self, index, txid):
+        with self.lock:
+            del self.pending[(index, txid)]
+
+    def handle_reply(self, index, data, addr):
+        '''hands a datagram received on socket index to the query it answers'''
+        if len(data) < DNS_HEADER.size:
+            return
+        txid = (data[0] << 8) | data[1]
+        with self.lock:
+            pending = self.pending.get((index, txid))
+        # anyone can send to the socket, only the asked server's reply to
+        # the asked question counts
+        if pending is None or addr != pending.addr or pending.reply is not None:
+            return
+        if data[DNS_HEADER.size:DNS_HEADER.size + len(pending.question)].lower() != pending.question.lower():
+            return
+        pending.answer(data)
+
+    def query_udp(self, upstream, question):
+        '''raw reply or None after the timeout'''
+        added = self.add_pending(upstream, question)
+        if added is None:
+            return None
+        index, txid, pending = added
+        sock = self.socks[index]
+        start = time.monotonic()
+        try:
+            sock.sendto(DNS_HEADER.pack(txid, DNS_FLAG_RD, 1, 0, 0, 0) + question, upstream.addr)
+            if pending.event.wait(self.timeout):
+                upstream.answered(time.monotonic() - start)
+            else:
+                upstream.timed_out(self.timeout)
+        except OSError as err:
+            LOGGER.warning("UpstreamResolver send to %s:%d failed: %s" % (upstream.addr + (err,)))
+        finally:
+            self.remove_pending(index, txid)
+        return pending.reply
+
+    async def query_udp_async(self, upstream, question):
+        '''query_udp() on the event loop'''
+        added = self.add_pending(upstream, question, asyncio.get_running_loop().create_future())
+        if added is None:
+            return None
+        index, txid, pending = added
+        start = time.monotonic()
+        try:
+            self.transports[index].sendto(DNS_HEADER.pack(txid, DNS_FLAG_RD, 1, 0, 0, 0) + question, upstream.addr)
+            await asyncio.wait_for(pending.future, self.timeout)
+            upstream.answered(time.monotonic() - start)
+        except asyncio.TimeoutError:
+            upstream.timed_out(self.timeout)
+        except OSError as err:
+            LOGGER.warning("UpstreamResolver send to %s:%d failed: %s" % (upstream.addr + (err,)))
+        finally:
+            self.remove_pending(index, txid)
+        return pending.reply
+
+    def handle_recv(self):
+        LOGGER.debug("UpstreamResolver handle_recv")
+        while self.running:
+            readable, _, _ = select.select(self.socks, [], [], 0.1)
+            for sock in readable:
+                try:
+                    data, addr = sock.recvfrom(MAX_UDP_REPLY)
+                except OSError:
+                    continue
+                self.handle_reply(self.socks.index(sock), data, addr)
+
+    def query_tcp(self, upstream, question):
+        '''raw reply over the kept connection, reconnecting once if the server closed it'''
+        with upstream.tcp_lock:
+            for reuse in (upstream.tcp_sock is not None, False):
+                if not reuse:
+                    upstream.close_tcp()
+                    try:
+                        upstream.tcp_sock = socket.create_connection(upstream.addr, self.timeout)
+                    except OSError as err:
+                        LOGGER.warning("UpstreamResolver tcp connect %s:%d failed: %s" % (upstream.addr + (err,)))
+                        return None
+                txid = secrets.randbits(16)
+                message = DNS_HEADER.pack(txid, DNS_FLAG_RD, 1, 0, 0, 0) + question
+                try:
+                    upstream.tcp_sock.sendall(TCP_LENGTH.pack(len(message)) + message)
+                    length = TCP_LENGTH.unpack(self.recv_exact(upstream.tcp_sock, TCP_LENGTH.size))[0]
+                    data = self.recv_exact(upstream.tcp_sock, length)
+                except (OSError, EOFError):
+                    upstream.close_tcp()
+                    continue
+                if length >= DNS_HEADER.size and (data[0] << 8 | data[1]) == txid:
+                    return data
+                upstream.close_tcp()
+        return None
+
+    async def query_tcp_async(self, upstream, question):
+        '''query_tcp() on the event loop, over a connection of its own'''
+        if upstream.tcp_stream_lock is None:
+            upstream.tcp_stream_lock = asyncio.Lock()
+        async with upstream.tcp_stream_lock:
+            for reuse in (upstream.tcp_stream is not None, False):
+                if not reuse:
+                    upstream.close_tcp_stream()
+                    try:
+                        upstream.tcp_stream = await asyncio.wait_for(asyncio.open_connection(*upstream.addr),
+                                                                     self.timeout)
+                    except (OSError, asyncio.TimeoutError) as err:
+                        LOGGER.warning("UpstreamResolver tcp connect %s:%d failed: %s" % (upstream.addr + (err,)))
+                        return None
+                reader, writer = upstream.tcp_stream
+                txid = secrets.randbits(16)
+                message = DNS_HEADER.pack(txid, DNS_FLAG_RD, 1, 0, 0, 0) + question
+                try:
+                    writer.write(TCP_LENGTH.pack(len(message)) + message)
+                    await writer.drain()
+                    header = await asyncio.wait_for(reader.readexactly(TCP_LENGTH.size), self.timeout)
+                    length = TCP_LENGTH.unpack(header)[0]
+                    data = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+                except (OSError, EOFError, asyncio.TimeoutError):
+                    upstream.close_tcp_stream()
+                    continue
+                if length >= DNS_HEADER.size and (data[0] << 8 | data[1]) == txid:
+                    return data
+                upstream.close_tcp_stream()
+        return None
+
+    @staticmethod
+    def recv_exact(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError('connection closed')
+            data += chunk
+        return data
+
+
+if __name__ == "__main__":
+    import socketserver
+
+    # stand-in upstreams, the first one never answers, the second one
+    # truncates everything over udp
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent.bind(('127.0.0.1', 0))
+
+    def answer(data):
+        request = dnslib.DNSRecord.parse(data)
+        reply = request.reply()
+        qname = str(request.q.qname)
+        if qname.startswith('missing'):
+            reply.header.rcode = DNS_RCODE_NXDOMAIN
+        else:
+            reply.add_answer(dnslib.RR(qname, QTYPE_CNAME, rdata=dnslib.CNAME('edge.example.net'), ttl=300))
+            reply.add_answer(dnslib.RR('edge.example.net', QTYPE_A, rdata=dnslib.A('192.0.2.7'), ttl=60))
+        return reply.pack()
+
+    counts = {'udp': 0, 'tcp': 0, 'connections': 0}
+
+    class UDPHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            data, sock = self.request
+            counts['udp'] += 1
+            reply = bytearray(answer(data))
+            reply[2] |= DNS_FLAG_TC >> 8
+            sock.sendto(bytes(reply), self.client_address)
+
+    class TCPHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            counts['connections'] += 1
+            while True:
+                try:
+                    length = TCP_LENGTH.unpack(UpstreamResolver.recv_exact(self.request, 2))[0]
+                    data = UpstreamResolver.recv_exact(self.request, length)
+                except (OSError, EOFError):
+                    return
+                counts['tcp'] += 1
+                reply = answer(data)
+                self.request.sendall(TCP_LENGTH.pack(len(reply)) + reply)
+
+    udp_server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), UDPHandler)
+    port = udp_server.server_address[1]
+    tcp_server = socketserver.ThreadingTCPServer(('127.0.0.1', port), TCPHandler)
+    tcp_server.daemon_threads = True
+    for server in (udp_server, tcp_server):
+        threading.Thread(target=server.serve_forever, args=(0.1,), daemon=True).start()
+
+    resolver = UpstreamResolver(['127.0.0.1:%d' % silent.getsockname()[1], '127.0.0.1:%d' % port], timeout=0.3)
+    resolver.run()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.query(b'www.example.com'))) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [(['192.0.2.7'], 60)] * 6, results
+    # the silent server is asked last now, the tcp connection is reused
+    start = time.monotonic()
+    assert resolver.query(b'missing.example.com') == ([], 0)
+    assert time.monotonic() - start < 0.3
+    assert counts['tcp'] == 7 and counts['connections'] == 1, counts
+    resolver.stop()
+
+    # the same on an event loop, without threads
+    async def query_on_loop():
+        resolver = UpstreamResolver(['127.0.0.1:%d' % silent.getsockname()[1], '127.0.0.1:%d' % port], timeout=0.3)
+        await resolver.run_async()
+        results = await asyncio.gather(*[resolver.query_async(b'www.example.com') for _ in range(6)])
+        start = time.monotonic()
+        missing = await resolver.query_async(b'missing.example.com')
+        elapsed = time.monotonic() - start
+        await resolver.stop_async()
+        return results, missing, elapsed
+
+    results, missing, elapsed = asyncio.run(query_on_loop())
+    assert results == [(['192.0.2.7'], 60)] * 6, results
+    assert missing == ([], 0) and elapsed < 0.3
+    assert counts['tcp'] == 14 and counts['connections'] == 2, counts
+    udp_server.shutdown()
+    tcp_server.shutdown()
+    print(counts)
+    print('test ok')
@@ -1,157 +1,331 @@
-import dnslib
+import socket
+import struct
+
 import dns.resolver as dnsr
 
 from dnslib import DNSRecord
 
+DNS_PORT = 53
+DNS_HEADER = struct.Struct('!HHHHHH')
+DNS_QUESTION_TAIL = struct.Struct('!HH')
+UDP_PORTS = struct.Struct('!HH')
+# real queries carry one question, more is not dns or not worth it
+DNS_MAX_QUESTIONS = 16
+DNS_MAX_POINTERS = 16
+DNS_FLAG_QR = 0x8000
+DNS_FLAG_AA = 0x0400
+DNS_FLAG_RA = 0x0080
+QTYPE_A = 1
+QCLASS_IN = 1
+IP_TOTAL_LENGTH = struct.Struct('!H')
+UDP_LENGTH_CHECKSUM = struct.Struct('!HH')
+# a record whose name points at the question, the only kind of answer we build
+DNS_RR_A = struct.Struct('!HHHIH4s')
+DNS_NAME_POINTER = 0xc000
+
+
+def checksum(data, start=0):
+    '''
+    internet checksum (rfc 1071). 2^16 = 1 mod 0xffff, so the one's complement
+    sum of the 16 bit words is the whole buffer read as one big integer
+    modulo 0xffff, which int does in C instead of a loop over words.
+    start is added to the sum, e.g. the words of a pseudo header
+    '''
+    n = int.from_bytes(data, 'big')
+    if len(data) % 2 == 1:
+        # padded with a zero byte
+        n <<= 8
+    n += start
+    s = n % 0xffff
+    if s == 0 and n != 0:
+        # one's complement sum of non zero words is never +0
+        s = 0xffff
+    return ~s & 0xffff
+
 
-def checksum(data):
-    length = len(data)
-    if length % 2 == 1:
-        data += b'\x00'
-    s = 0
-    for i in range(0, len(data), 2):
-        s += data[i] * 256 + data[i + 1]
-        s = (s & 0xffff) + (s >> 16)
+def checksum_update16(chksum, old, new):
+    '''rfc 1624 eqn. 3, adjust a checksum for a 16 bit word changing'''
+    s = (~chksum & 0xffff) + (~old & 0xffff) + new
+    s = (s & 0xffff) + (s >> 16)
+    s = (s & 0xffff) + (s >> 16)
     return ~s & 0xffff
 
 
+def checksum_update(chksum, old, new):
+    '''adjust a checksum for an even length field changing from old to new bytes'''
+    for i in range(0, len(old), 2):
+        chksum = checksum_update16(chksum, old[i] << 8 | old[i + 1], new[i] << 8 | new[i + 1])
+    return chksum
+
+
 def query_dns_with_servers(name, servers):
+    return query_dns_answers(name, servers)[0]
+
+
+def query_dns_answers(name, servers):
+    '''
+    (ipv4 addresses, ttl), ttl is 0 when the name has no a records and
+    None when the lookup failed
+    '''
     try:
         d = dnsr.Resolver(configure=False)
         d.nameservers = servers
         d.timeout = 1
         d.lifetime = 1
         ans = d.query(name, 'A')
-        return [x.address for x in ans]
+        return [x.address for x in ans], ans.rrset.ttl
+    except (dnsr.NXDOMAIN, dnsr.NoAnswer):
+        return [], 0
     except Exception:
-        return []
-
-
-def re_resolve_dns(packet, dnsservers, is_request):
-    # get ipv4 header length
-    header_len = (packet[0] & 0x0f) * 4
-
-    # get actual data
-    data = packet[header_len + 8:]
-
-    # get dns record
-    record = DNSRecord.parse(data)
-
-    # get question
-    questions = record.questions
-
-    # remove answers
-    while record.a.rdata is not None:
-        record.rr.remove(record.a)
-
-    for question in questions:
-        name = b'.'.join(record.q.get_qname().label).decode()
-        ips = query_dns_with_servers(name, dnsservers)
-        for aip in ips:
-            record.add_answer(dnslib.RR(name, dnslib.QTYPE.A, rdata=dnslib.A(aip)))
-
-    # set response
-    record.header.set_qr(1)
-    record.header.set_aa(1)
-    record.header.set_ra(1)
-
-    # repack
-    data = record.pack()
-    packet = packet[:header_len + 8] + data
-
-    # udp length
-    length = len(packet) - header_len
-    packet = packet[:header_len + 4] + bytes([length >> 8, length % 256]) + packet[header_len + 6:]
-
-    # packet length
-    length = len(packet)
-    packet = packet[:2] + bytes([length >> 8, length % 256]) + packet[4:]
-
-    # switch addr
+        return [], None
+
+
+def re_resolve_dns(packet, dnsservers, is_request, cache=None, inflight=None, context=None, upstream=None):
+    '''
+    answers from cache where it has them, hits skip the upstream query.
+    with inflight, threads resolving the same name share one query, whatever
+    the qtype, since only a records are queried.
+    context is the DNSPacketContext of packet if the caller has it.
+    upstream is an UpstreamResolver to query instead of dnsservers, which
+    can be None then
+    '''
+    if context is None:
+        context = parse_dns_packet(packet)
+        if context is None:
+            raise ValueError('not a dns packet')
+    answers = {}
+    ttls = {}
+    for name, qtype, _ in context.questions:
+        cached = cache.get(name, qtype) if cache is not None else None
+        if cached is None:
+            resolved = []
+
+            def resolve():
+                # a records answer every question, like query_dns_answers
+                if upstream is not None:
+                    result = upstream.query(name)
+                else:
+                    result = query_dns_answers(name.decode(), dnsservers)
+                # cached before the call is released, so no later thread misses
+                if cache is not None:
+                    cache.put(name, qtype, *result)
+                resolved.append(True)
+                return result
+            addresses, ttl = inflight.run(name, resolve) if inflight is not None else resolve()
+            # joined a query made for another qtype of the name
+            if cache is not None and not resolved:
+                cache.put(name, qtype, addresses, ttl)
+        else:
+            addresses, ttl = cached
+        answers[name] = addresses
+        ttls[name] = ttl or 0
+    return build_dns_reply(packet, answers, is_request, ttls, context)
+
+
+def build_dns_reply(packet, answers, is_request, ttls=None, context=None):
+    '''
+    turn a dns packet into a reply carrying the given answers
+    answers is a dict of qname -> list of ipv4 addresses, ttls an optional
+    dict of qname -> record ttl. returns the reply and the answers it
+    carries per question
+    '''
+    if context is None:
+        context = parse_dns_packet(packet)
+        if context is None:
+            raise ValueError('not a dns packet')
+
+    header_len = context.header_len
+    dns_start = header_len + 8
+    records = []
+    for qname, qname_offset in zip(context.qnames(), context.qname_offsets):
+        ttl = ttls.get(qname, 0) if ttls else 0
+        for aip in answers.get(qname, []):
+            records.append((DNS_NAME_POINTER | qname_offset, ttl, socket.inet_aton(aip)))
+
+    # ip, udp and dns header plus questions are taken over, answers appended
+    answers_start = dns_start + context.question_end
+    length = answers_start + DNS_RR_A.size * len(records)
+    reply = bytearray(length)
+    reply[:answers_start] = packet[:answers_start]
+
+    # response header, authority and additional records are dropped
+    DNS_HEADER.pack_into(reply, dns_start, context.txid, context.flags | DNS_FLAG_QR | DNS_FLAG_AA | DNS_FLAG_RA,
+                         context.qdcount, len(records), 0, 0)
+    offset = answers_start
+    for pointer, ttl, address in records:
+        DNS_RR_A.pack_into(reply, offset, pointer, QTYPE_A, QCLASS_IN, ttl, len(address), address)
+        offset += DNS_RR_A.size
+
+    # lengths, and addresses and ports switched to answer a request
+    IP_TOTAL_LENGTH.pack_into(reply, 2, length)
     if is_request:
-        tmp = packet[12:16]
-        packet = packet[:12] + packet[16:20] + packet[16:]
-        packet = packet[:16] + tmp + packet[20:]
-        tmp = packet[header_len:header_len + 2]
-        packet = packet[:header_len] + packet[header_len + 2:header_len + 4] + packet[header_len + 2:]
-        packet = packet[:header_len + 2] + tmp + packet[header_len + 4:]
-
-    # udp checksum
-    packet = packet[:header_len + 6] + b'\x00\x00' + packet[header_len + 8:]
-    chkdata = packet[12:20] + b'\x00\x11' + packet[header_len + 4:header_len + 6] + packet[header_len:]
-    chksum = checksum(chkdata)
-    chksum_raw = bytes([chksum >> 8, chksum % 256])
-    packet = packet[:header_len + 6] + chksum_raw + packet[header_len + 8:]
-
-    # ip checksum
-    packet = packet[:10] + b'\x00\x00' + packet[12:]
-    chksum = checksum(packet[:header_len])
-    chksum_raw = bytes([chksum >> 8, chksum % 256])
-    packet = packet[:10] + chksum_raw + packet[12:]
-
-    # get ips
-    answers = detect_dns_answers(packet)
-
-    return packet, answers
-
-
-def is_dns_packet(packet):
-    try:
-        # is ipv4
-        if packet[0] & 0xf0 != 0x40:
-            return False
-
-        # ip header min length
-        if len(packet) < 20:
+        reply[12:16] = packet[16:20]
+        reply[16:20] = packet[12:16]
+        UDP_PORTS.pack_into(reply, header_len, context.dst_port, context.src_port)
+    udp_length = length - header_len
+    UDP_LENGTH_CHECKSUM.pack_into(reply, header_len + 4, udp_length, 0)
+
+    # checksums once everything else is in place, the udp pseudo header is
+    # added as a sum instead of being copied in front
+    view = memoryview(reply)
+    chksum = checksum(view[header_len:], int.from_bytes(view[12:20], 'big') + 17 + udp_length)
+    # a zero udp checksum means none was computed
+    UDP_LENGTH_CHECKSUM.pack_into(reply, header_len + 4, udp_length, chksum or 0xffff)
+    IP_TOTAL_LENGTH.pack_into(reply, 10, 0)
+    IP_TOTAL_LENGTH.pack_into(reply, 10, checksum(view[:header_len]))
+
+    # only a records of the qnames were added, no need to parse them back
+    answers = {qname: answers.get(qname, []) for qname in context.qnames()}
+
+    return reply, answers
+
+
+def read_dns_name(dns, offset):
+    '''(dotted name, offset after it) of the name at offset, following pointers'''
+    labels = []
+    end = None
+    pointers = 0
+    size = len(dns)
+    while True:
+        if offset >= size:
+            raise ValueError('dns name out of bounds')
+        length = dns[offset]
+        if length & 0xc0 == 0xc0:
+            if offset + 1 >= size:
+                raise ValueError('dns name out of bounds')
+            if end is None:
+                end = offset + 2
+            pointers += 1
+            if pointers > DNS_MAX_POINTERS:
+                raise ValueError('dns name pointer loop')
+            offset = (length & 0x3f) << 8 | dns[offset + 1]
+            continue
+        if length & 0xc0:
+            raise ValueError('dns label type %x' % (length >> 6))
+        offset += 1
+        if length == 0:
+            break
+        if offset + length > size:
+            raise ValueError('dns name out of bounds')
+        labels.append(bytes(dns[offset:offset + length]))
+        offset += length
+    return b'.'.join(labels), end if end is not None else offset
+
+
+class DNSPacketContext:
+    '''
+    ip, udp and dns header fields and the question section of a dns
+    packet, read in one pass straight from the packet. the classifier
+    parses once and every later stage takes the context instead of
+    parsing again. only the names are copied out, the packet is not kept,
+    so the context stays valid after the packet buffer is reused.
+    '''
+    __slots__ = ('header_len', 'src_port', 'dst_port', 'txid', 'flags', 'qdcount', 'ancount', 'nscount', 'arcount',
+                 'questions', 'qname_offsets', 'question_end')
+
+    def __init__(self):
+        self.header_len = 0
+        self.src_port = 0
+        self.dst_port = 0
+        self.txid = 0
+        self.flags = 0
+        self.qdcount = 0
+        self.ancount = 0
+        self.nscount = 0
+        self.arcount = 0
+        # [(qname, qtype, qclass)] and where each qname starts, from the dns header
+        self.questions = []
+        self.qname_offsets = []
+        # offset of the first record after the questions, from the dns header
+        self.question_end = 0
+
+    def parse(self, packet, header_len=0):
+        '''
+        False for anything but an ipv4/udp port 53 packet with a dns header
+        and questions, header_len skips the checks when the caller did them
+        '''
+        if not header_len:
+            header_len = dns_header_len(packet)
+            if not header_len:
+                return False
+        self.src_port, self.dst_port = UDP_PORTS.unpack_from(packet, header_len)
+        self.header_len = header_len
+        dns = packet[header_len + 8:]
+        if not isinstance(dns, memoryview):
+            dns = memoryview(dns)
+        (self.txid, self.flags, self.qdcount, self.ancount, self.nscount,
+         self.arcount) = DNS_HEADER.unpack_from(dns)
+        if not 0 < self.qdcount <= DNS_MAX_QUESTIONS:
             return False
-
-        # is udp
-        if packet[9] != 17:
+        questions = []
+        qname_offsets = []
+        offset = DNS_HEADER.size
+        try:
+            for _ in range(self.qdcount):
+                qname_offsets.append(offset)
+                qname, offset = read_dns_name(dns, offset)
+                qtype, qclass = DNS_QUESTION_TAIL.unpack_from(dns, offset)
+                offset += DNS_QUESTION_TAIL.size
+                questions.append((qname, qtype, qclass))
+        except (ValueError, struct.error):
             return False
+        self.questions = questions
+        self.qname_offsets = qname_offsets
+        self.question_end = offset
+        return True
 
-        # get ipv4 header length
-        header_len = (packet[0] & 0x0f) * 4
+    def qnames(self):
+        return [qname for qname, _, _ in self.questions]
 
-        # udp header min length
-        if len(packet) < header_len + 8:
-            return False
-
-        # is port 53
-        src_port = packet[header_len] * 256 + packet[header_len + 1]
-        dst_port = packet[header_len + 2] * 256 + packet[header_len + 3]
-        if src_port != 53 and dst_port != 53:
-            return False
+    def is_response(self):
+        return bool(self.flags & DNS_FLAG_QR)
 
-        # get actual data
-        data = packet[header_len + 8:]
 
-        # try parse
-        DNSRecord.parse(data)
-    except Exception:
-        return False
+def dns_header_len(packet):
+    '''
+    ip header length of an unfragmented ipv4/udp packet to or from port 53
+    long enough for a dns header, 0 for anything else. cheap enough to run
+    on every packet before a context is made
+    '''
+    length = len(packet)
+    if length < 28 or packet[0] & 0xf0 != 0x40 or packet[9] != 17:
+        return 0
+    # later fragments carry no udp header
+    if (packet[6] & 0x1f) or packet[7]:
+        return 0
+    header_len = (packet[0] & 0x0f) * 4
+    if header_len < 20 or length < header_len + 8 + DNS_HEADER.size:
+        return 0
+    src_port, dst_port = UDP_PORTS.unpack_from(packet, header_len)
+    if src_port != DNS_PORT and dst_port != DNS_PORT:
+        return 0
+    return header_len
 
-    return True
 
+def parse_dns_packet(packet):
+    '''DNSPacketContext of packet, None if it is not a dns packet'''
+    header_len = dns_header_len(packet)
+    if not header_len:
+        return None
+    context = DNSPacketContext()
+    return context if context.parse(packet, header_len) else None
 
-def get_dns_qnames(packet):
-    # get ipv4 header length
-    header_len = (packet[0] & 0x0f) * 4
 
-    # get actual data
-    data = packet[header_len + 8:]
+def is_dns_packet(packet):
+    return parse_dns_packet(packet) is not None
 
-    # get dns record
-    record = DNSRecord.parse(data)
 
-    # get question
-    questions = record.questions
+def get_dns_qnames(packet, context=None):
+    if context is None:
+        context = parse_dns_packet(packet)
+    return context.qnames() if context is not None else []
 
-    # qnames
-    qnames = []
-    for item in questions:
-        qnames.append(b'.'.join(item.get_qname().label))
 
-    return qnames
+def get_dns_questions(packet, context=None):
+    '''[(qname, qtype)] of a dns packet'''
+    if context is None:
+        context = parse_dns_packet(packet)
+    return [(qname, qtype) for qname, qtype, _ in context.questions] if context is not None else []
 
 
 def detect_dns_answers(packet):
@@ -200,3 +374,50 @@ if __name__ == "__main__":
     req_data = b'\x45\x00\x00\x3d\x0a\x3b\x00\x00\x80\x11\x16\x64\x0a\x00\x00\x02\x08\x08\x08\x08\xf4\x4f\x00\x35\x00\x29\xdb\xe9\xdb\xcc\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03\x70\x75\x62\x07\x69\x64\x71\x71\x69\x6d\x67\x03\x63\x6f\x6d\x00\x00\x01\x00\x01'
     rdata = re_resolve_dns(req_data, ['114.114.114.114'], True)
     print(rdata)
+
+    # the light parser agrees with dnslib and rejects other port 53 traffic
+    for packet in (data, req_data):
+        context = parse_dns_packet(memoryview(packet))
+        record = DNSRecord.parse(bytes(packet[28:]))
+        assert context.qnames() == [b'.'.join(q.get_qname().label) for q in record.questions]
+        assert context.questions[0][1:] == (record.questions[0].qtype, record.questions[0].qclass)
+        assert context.txid == record.header.id
+    assert parse_dns_packet(data).is_response() and not parse_dns_packet(req_data).is_response()
+    # a question name made of a pointer into the first one
+    pointer = bytearray(req_data)
+    pointer[32:34] = b'\x00\x02'
+    pointer += b'\xc0\x10\x00\x1c\x00\x01'
+    assert get_dns_questions(pointer) == [(b'pub.idqqimg.com', 1), (b'idqqimg.com', 28)]
+    garbage = bytearray(req_data)
+    garbage[40:] = b'\x7f' * len(garbage[40:])
+    assert not is_dns_packet(garbage)
+    assert not is_dns_packet(req_data[:30])
+    loop = bytearray(req_data)
+    loop[40:42] = b'\xc0\x0c'
+    assert not is_dns_packet(loop)
+
+    # checksum
+    assert checksum(req_data[:20]) == 0
+    header = bytearray(req_data[:20])
+    header[12:16] = b'\x0a\x00\x00\x09'
+    chksum = checksum_update(0x1664, req_data[12:16], header[12:16])
+    header[10:12] = bytes([chksum >> 8, chksum & 0xff])
+    assert checksum(header) == 0
+
+    # replies are built in one buffer, dnslib reads them back and both
+    # checksums verify
+    answers = {b'pub.idqqimg.com': ['1.2.3.4', '5.6.7.8']}
+    reply, carried = build_dns_reply(req_data, answers, True, {b'pub.idqqimg.com': 120})
+    assert carried == answers
+    assert checksum(reply[:20]) == 0
+    udp_length = len(reply) - 20
+    assert reply[24:26] == struct.pack('!H', udp_length)
+    assert checksum(reply[20:], int.from_bytes(reply[12:20], 'big') + 17 + udp_length) == 0
+    assert reply[12:20] == req_data[16:20] + req_data[12:16] and reply[20:24] == req_data[22:24] + req_data[20:22]
+    record = DNSRecord.parse(bytes(reply[28:]))
+    assert record.header.id == 0xdbcc and record.header.qr and record.header.aa and record.header.ra
+    assert [(str(rr.rdata), rr.ttl) for rr in record.rr] == [('1.2.3.4', 120), ('5.6.7.8', 120)]
+    assert str(record.rr[0].rname) == 'pub.idqqimg.com.'
+    reply, carried = build_dns_reply(req_data, {}, True)
+    assert carried == {b'pub.idqqimg.com': []} and not DNSRecord.parse(bytes(reply[28:])).rr
+    print('test ok')
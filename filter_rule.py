@@ -1,5 +1,6 @@
 from logger import LOGGER
 import re
+import threading
 
 FILTER_BLACK = 0
 FILTER_WHITE = 1
@@ -16,6 +17,8 @@ class FilterRule:
         self.match_cache = {}
         self.ips = None
         self.iptable_cache = set()
+        # dns workers hit ips concurrently
+        self.hit_lock = threading.Lock()
         self.default_dns_server = DEFAULT_DIRECT_DNS_SERVER_IP
         self.inited = False
 
@@ -73,12 +76,15 @@ class FilterRule:
             return
         if hitip in self.iptable_cache:
             return
-        if self.mode == FILTER_BLACK:
-            self.sys_helper.add_route_black(hitip)
-            self.iptable_cache.add(hitip)
-        elif self.mode == FILTER_WHITE:
-            self.sys_helper.add_route_white(hitip)
-            self.iptable_cache.add(hitip)
+        with self.hit_lock:
+            if hitip in self.iptable_cache:
+                return
+            if self.mode == FILTER_BLACK:
+                self.sys_helper.add_route_black(hitip)
+                self.iptable_cache.add(hitip)
+            elif self.mode == FILTER_WHITE:
+                self.sys_helper.add_route_white(hitip)
+                self.iptable_cache.add(hitip)
 
     def clear_iptable(self):
         if self.mode == FILTER_BLACK:
@@ -0,0 +1,432 @@
+'''
+local stand-in for the outernet server, for load and loss testing
+
+    python local_server.py serve --port 9000 --loss 0.01 --delay 0.02 --jitter 0.01 --path-mtu 1400
+    python local_server.py load --clients 50 --packets 1000 --loss 0.01
+
+serve runs a server that assigns tun ips and echoes or reflects traffic.
+load starts a server and drives many Client instances against it, and
+reports delivery, reordering and latency.
+'''
+import argparse
+import heapq
+import json
+import os
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from cipher import new_cipher, datagram_key_id, is_handshake, CIPHER_CHACHA20, CIPHER_CHACHA20_POLY1305
+from client import Client, flow_hash
+from protocol import (Protocol, pack_aggregate, split_aggregate, AGGREGATE_LEN,
+                      CMD_CLIENT_HANDSHAKE, CMD_SERVER_HANDSHAKE, CMD_CLIENT_DATA, CMD_SERVER_DATA,
+                      CMD_CLIENT_PMTU_PROBE, CMD_CLIENT_AGGREGATE_DATA, CMD_SERVER_AGGREGATE_DATA,
+                      CMD_CLIENT_COMPRESSED_DATA, CMD_SERVER_COMPRESSED_DATA)
+from compression import Compressor, choose_algorithm, COMPRESS_NONE
+from pmtu import pmtu_reply, IP_UDP_HEADER_LEN
+from logger import LOGGER
+
+MODE_ECHO = 'echo'
+MODE_REFLECT = 'reflect'
+
+TUN_NETWORK = [10, 0, 0, 0]
+TUN_GATEWAY = [10, 0, 0, 1]
+MAX_CLIENTS = 253
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def reflect_packet(data):
+    '''swap ipv4 source/destination addresses and tcp/udp ports, checksums stay valid'''
+    packet = bytearray(data)
+    if len(packet) < 20 or packet[0] & 0xf0 != 0x40:
+        return packet
+    packet[12:16], packet[16:20] = packet[16:20], packet[12:16]
+    header_len = (packet[0] & 0x0f) * 4
+    if packet[9] in (6, 17) and len(packet) >= header_len + 4:
+        sport = packet[header_len:header_len + 2]
+        packet[header_len:header_len + 2] = packet[header_len + 2:header_len + 4]
+        packet[header_len + 2:header_len + 4] = sport
+    return packet
+
+
+class ClientSession:
+    def __init__(self, identification, tun_ip_raw, cipher):
+        self.identification = identification
+        self.tun_ip_raw = tun_ip_raw
+        # replies of all the client's sockets share one cipher, an aead
+        # session has one key and nonce counter per direction
+        self.cipher = cipher
+        self.addrs = set()
+        self.compressor = None
+
+
+class LocalServer:
+    '''
+    speaks the client protocol on one udp socket. aead datagrams find their
+    session cipher by the key id in front, sessions are keyed by identification and learn
+    every address a client sends data from, replies go back to the address
+    the packet came in on. replies can be
+    dropped with probability loss and delayed by delay +- jitter seconds,
+    which also reorders them. datagrams larger than path_mtu, ip and udp
+    headers included, are dropped like on a path that does not fragment.
+    '''
+
+    def __init__(self, host, port, secret, cipher_mode=CIPHER_CHACHA20, mode=MODE_ECHO, loss=0.0, delay=0.0, jitter=0.0,
+                 path_mtu=0):
+        LOGGER.debug("LocalServer init")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        self.sock.bind((host, port))
+        self.addr = self.sock.getsockname()
+        self.secret = secret
+        self.cipher_mode = cipher_mode
+        self.mode = mode
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.path_mtu = path_mtu
+        self.random = random.Random()
+        # stateless ciphers are shared, aead ones are per session by key id
+        self.aead = cipher_mode == CIPHER_CHACHA20_POLY1305
+        self.cipher = new_cipher(cipher_mode, secret)
+        self.ciphers = {}
+        self.sessions = {}
+        self.running = False
+        self.recv_thread = None
+        self.delay_thread = None
+        self.delay_queue = []
+        self.delay_cond = threading.Condition()
+        self.delay_seq = 0
+        # stats
+        self.rx_packets = 0
+        self.tx_packets = 0
+        self.dropped = 0
+
+    def run(self):
+        LOGGER.debug("LocalServer run")
+        self.running = True
+        self.recv_thread = threading.Thread(target=self.handle_recv)
+        self.recv_thread.start()
+        if self.delay > 0 or self.jitter > 0:
+            self.delay_thread = threading.Thread(target=self.handle_delay)
+            self.delay_thread.start()
+
+    def stop(self):
+        LOGGER.info("LocalServer stop")
+        self.running = False
+        with self.delay_cond:
+            self.delay_cond.notify()
+        if self.recv_thread is not None:
+            self.recv_thread.join()
+        if self.delay_thread is not None:
+            self.delay_thread.join()
+        self.sock.close()
+
+    def handle_recv(self):
+        self.sock.settimeout(0.1)
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                continue
+            self.rx_packets += 1
+            self.handle_datagram(data, addr)
+
+    def handle_datagram(self, data, addr):
+        if self.path_mtu and len(data) + IP_UDP_HEADER_LEN > self.path_mtu:
+            self.dropped += 1
+            return
+        cipher = self.cipher
+        if not self.aead:
+            data = cipher.decrypt(data)
+        elif is_handshake(data):
+            cipher = new_cipher(self.cipher_mode, self.secret, True)
+            data = cipher.decrypt_handshake(data)
+        else:
+            cipher = self.ciphers.get(datagram_key_id(data))
+            data = cipher.decrypt(data) if cipher is not None else None
+        if data is None:
+            return
+        protocol = Protocol()
+        if protocol.parse(data) <= 1:
+            return
+        if protocol.cmd == CMD_CLIENT_HANDSHAKE:
+            session = self.get_session(protocol.identification)
+            if session is None:
+                LOGGER.warning("LocalServer no tun ip left")
+                return
+            if self.aead and not self.accept_cipher(session, cipher):
+                return
+            reply = Protocol()
+            reply.cmd = CMD_SERVER_HANDSHAKE
+            reply.tun_ip_raw = bytes(TUN_GATEWAY)
+            reply.dst_ip_raw = session.tun_ip_raw
+            algorithm = choose_algorithm(protocol.capabilities)
+            if algorithm != COMPRESS_NONE:
+                reply.capabilities = algorithm
+                if session.compressor is None or session.compressor.algorithm != algorithm:
+                    session.compressor = Compressor(algorithm)
+            else:
+                session.compressor = None
+            session.addrs.add(addr)
+            self.send(session.cipher.encrypt_handshake(reply.get_bytes()), addr, None, True)
+        elif protocol.cmd == CMD_CLIENT_DATA:
+            session = self.session_of(protocol.identification, cipher)
+            if session is None:
+                return
+            session.addrs.add(addr)
+            self.send_packet(session, self.answer_packet(protocol.data), addr)
+        elif protocol.cmd == CMD_CLIENT_COMPRESSED_DATA:
+            session = self.session_of(protocol.identification, cipher)
+            if session is None or session.compressor is None:
+                return
+            packet = session.compressor.decompress(protocol.data)
+            if packet is None:
+                return
+            session.addrs.add(addr)
+            self.send_packet(session, self.answer_packet(packet), addr)
+        elif protocol.cmd == CMD_CLIENT_AGGREGATE_DATA:
+            session = self.session_of(protocol.identification, cipher)
+            if session is None:
+                return
+            session.addrs.add(addr)
+            # answer aggregated packets in one aggregated datagram
+            packets = [self.answer_packet(packet) for packet in split_aggregate(memoryview(protocol.data))]
+            payload = bytearray(sum(AGGREGATE_LEN.size + len(packet) for packet in packets))
+            pack_aggregate(payload, 0, packets)
+            reply = Protocol()
+            reply.cmd = CMD_SERVER_AGGREGATE_DATA
+            reply.data = bytes(payload)
+            self.send(reply.get_bytes(), addr, session.cipher)
+        elif protocol.cmd == CMD_CLIENT_PMTU_PROBE:
+            session = self.session_of(protocol.identification, cipher)
+            reply = pmtu_reply(protocol)
+            if session is None or reply is None:
+                return
+            self.send(reply, addr, session.cipher)
+
+    def send_packet(self, session, packet, addr):
+        '''reply with one ip packet, compressed if the session negotiated it and it pays off'''
+        reply = Protocol()
+        reply.cmd = CMD_SERVER_DATA
+        reply.data = packet
+        if session.compressor is not None:
+            compressed = session.compressor.compress(packet, flow_hash(packet))
+            if compressed is not None:
+                reply.cmd = CMD_SERVER_COMPRESSED_DATA
+                reply.data = compressed
+        self.send(reply.get_bytes(), addr, session.cipher)
+
+    def accept_cipher(self, session, cipher):
+        '''
+        makes the cipher of an opened client handshake the session's, False
+        for a replayed older handshake. a retransmit of the current one is
+        answered from the current session
+        '''
+        current = session.cipher
+        if current is not None and current.established():
+            if cipher.peer_nonce == current.peer_nonce:
+                return True
+            if cipher.peer_time <= current.peer_time:
+                return False
+            self.ciphers.pop(current.key_id, None)
+        session.cipher = cipher
+        self.ciphers[cipher.key_id] = cipher
+        return True
+
+    def session_of(self, identification, cipher):
+        '''the session of identification, if the datagram was sealed with its keys'''
+        session = self.sessions.get(identification)
+        if session is None or (self.aead and session.cipher is not cipher):
+            return None
+        return session
+
+    def answer_packet(self, data):
+        return bytes(data) if self.mode == MODE_ECHO else bytes(reflect_packet(data))
+
+    def get_session(self, identification):
+        session = self.sessions.get(identification)
+        if session is None:
+            index = len(self.sessions)
+            if index >= MAX_CLIENTS:
+                return None
+            tun_ip_raw = bytes(TUN_NETWORK[:3] + [index + 2])
+            session = ClientSession(identification, tun_ip_raw, None if self.aead else self.cipher)
+            self.sessions[identification] = session
+        return session
+
+    def send(self, data, addr, cipher, reliable=False):
+        '''data is sent as it is without a cipher'''
+        if not reliable and self.loss > 0 and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        send_data = cipher.encrypt(data) if cipher is not None else data
+        if self.delay_thread is None:
+            self.sendto(send_data, addr)
+            return
+        due = time.monotonic() + max(0.0, self.delay + self.random.uniform(-self.jitter, self.jitter))
+        with self.delay_cond:
+            self.delay_seq += 1
+            heapq.heappush(self.delay_queue, (due, self.delay_seq, send_data, addr))
+            self.delay_cond.notify()
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+            self.tx_packets += 1
+        except OSError:
+            self.dropped += 1
+
+    def handle_delay(self):
+        while self.running:
+            with self.delay_cond:
+                if not self.delay_queue:
+                    self.delay_cond.wait(0.1)
+                    continue
+                due = self.delay_queue[0][0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.delay_cond.wait(wait)
+                    continue
+                _, _, data, addr = heapq.heappop(self.delay_queue)
+            self.sendto(data, addr)
+
+
+class SimulatedClient:
+    '''a Client sending sequence numbered packets and tracking what comes back'''
+
+    HEADER = struct.Struct('!Id')
+
+    def __init__(self, index, server_addr, secret, cipher_mode):
+        identification = ('load-client-%d' % index).encode('utf-8').ljust(32, b'\x00')
+        self.connected = threading.Event()
+        self.failed = False
+        self.tun_ip_raw = None
+        self.client = Client(server_addr[0], server_addr[1], identification, secret,
+                             self.recv_cb, self.handshake_cb, cipher_mode=cipher_mode)
+        self.sent = 0
+        self.received = 0
+        self.reordered = 0
+        self.last_seq = -1
+        self.latencies = []
+
+    def handshake_cb(self, gateway_ip, interface_ip):
+        if interface_ip is None:
+            self.failed = True
+        else:
+            self.tun_ip_raw = bytes(interface_ip)
+        self.connected.set()
+
+    def recv_cb(self, data):
+        now = time.perf_counter()
+        seq, sent_at = self.HEADER.unpack_from(data, 28)
+        self.received += 1
+        if seq < self.last_seq:
+            self.reordered += 1
+        else:
+            self.last_seq = seq
+        self.latencies.append(now - sent_at)
+
+    def send(self, size):
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, size, self.sent & 0xffff, 0, 64, 17, 0,
+                             self.tun_ip_raw, bytes([198, 18, 0, 1]))
+        udp = struct.pack('!HHHH', 40000, 9, size - 20, 0)
+        payload = self.HEADER.pack(self.sent, time.perf_counter())
+        self.client.send(header + udp + payload + bytes(size - 28 - len(payload)))
+        self.sent += 1
+
+
+def run_load(server_addr, secret, cipher_mode, clients, packets, size, rate):
+    '''drive clients against a running server, rate is packets per second per client'''
+    sims = [SimulatedClient(i, server_addr, secret, cipher_mode) for i in range(clients)]
+    for sim in sims:
+        sim.client.run()
+    for sim in sims:
+        sim.connected.wait()
+    active = [sim for sim in sims if not sim.failed]
+
+    interval = 1.0 / rate if rate > 0 else 0
+    start = time.perf_counter()
+    for i in range(packets):
+        for sim in active:
+            sim.send(size)
+        if interval:
+            delay = start + (i + 1) * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    time.sleep(1)
+    elapsed = time.perf_counter() - start
+
+    for sim in sims:
+        sim.client.stop()
+
+    latencies = sorted(latency for sim in active for latency in sim.latencies)
+    sent = sum(sim.sent for sim in active)
+    received = sum(sim.received for sim in active)
+    return {
+        'clients': clients,
+        'connected': len(active),
+        'packets_sent': sent,
+        'packets_received': received,
+        'loss': (sent - received) / sent if sent else 0,
+        'reordered': sum(sim.reordered for sim in active),
+        'elapsed_s': elapsed,
+        'latency_p50_us': latencies[len(latencies) // 2] * 1e6 if latencies else None,
+        'latency_p99_us': latencies[int(len(latencies) * 0.99)] * 1e6 if latencies else None,
+    }
+
+
+def run_local_server(port_queue, secret, cipher_mode, mode=MODE_ECHO, loss=0.0, delay=0.0, jitter=0.0, path_mtu=0):
+    '''process entry, reports the bound port through port_queue and serves forever'''
+    server = LocalServer('127.0.0.1', 0, secret, cipher_mode, mode, loss, delay, jitter, path_mtu)
+    server.run()
+    port_queue.put(server.addr[1])
+    server.recv_thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Outernet local test server')
+    parser.add_argument('command', choices=['serve', 'load'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--secret', default='local')
+    parser.add_argument('--cipher', default=CIPHER_CHACHA20)
+    parser.add_argument('--mode', choices=[MODE_ECHO, MODE_REFLECT], default=MODE_ECHO)
+    parser.add_argument('--loss', type=float, default=0.0, help='reply drop probability')
+    parser.add_argument('--delay', type=float, default=0.0, help='reply delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='reply delay jitter in seconds')
+    parser.add_argument('--path-mtu', type=int, default=0, help='drop datagrams larger than this, 0 for no limit')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--packets', type=int, default=1000, help='packets per client')
+    parser.add_argument('--size', type=int, default=512, help='packet size')
+    parser.add_argument('--rate', type=float, default=1000, help='packets per second per client, 0 for unpaced')
+    args = parser.parse_args()
+
+    secret = args.secret.encode('utf-8')
+    server = LocalServer(args.host, args.port, secret, args.cipher, args.mode, args.loss, args.delay, args.jitter,
+                         args.path_mtu)
+    server.run()
+    print('serving on %s:%d' % server.addr)
+    try:
+        if args.command == 'serve':
+            while True:
+                time.sleep(1)
+        else:
+            # keep the clients' traffic file away from the real one
+            os.chdir(tempfile.mkdtemp(prefix='outernet-load-'))
+            results = run_load(server.addr, secret, args.cipher, args.clients, args.packets, args.size, args.rate)
+            results['server_dropped'] = server.dropped
+            print(json.dumps(results, indent=2))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,35 @@
 import time
-import ctypes
 import hashlib
 import threading
 
-from sys_helper import SysHelper
-from tap_control import open_tun_tap, close_tun_tap, TAPControl
-from iface_helper import get_tap_iface
-from config_helper import load_traffic, save_traffic, load_filter
-from client import Client
+from packet_device import create_packet_device, DEVICE_TAP_WINDOWS
+from config_helper import load_filter
+from traffic_store import open_traffic_store
+from client import Client, STAGE_SECONDS, STAGE_SECONDS_HELP
+from cipher import CIPHER_CHACHA20
+from async_engine import (EventLoopThread, AsyncClient, AsyncDNSServer, DeviceAdapter,
+                          ENGINE_THREAD, ENGINE_ASYNCIO)
 from filter_rule import FilterRule, FILTER_BLACK, FILTER_WHITE
 from dns_server import DNSServer
-from dns_utils import is_dns_packet, get_dns_qnames
+from dns_utils import parse_dns_packet
+from tcp_mss import clamp_mss, mss_for_mtu
+from packet_trace import TRACER, STAGE_DEVICE_READ, STAGE_DEVICE_WRITE, STAGE_DNS_RESOLVE
+from metrics import REGISTRY, MetricsServer
 from logger import LOGGER
 
 
+TX_TOTAL_SECONDS = REGISTRY.histogram(STAGE_SECONDS, STAGE_SECONDS_HELP, {'stage': 'tx_total'})
+RX_DEVICE_WRITE_SECONDS = REGISTRY.histogram(STAGE_SECONDS, STAGE_SECONDS_HELP, {'stage': 'rx_device_write'})
+
+
 class MainControl:
-    def __init__(self):
+    def __init__(self, device_type=DEVICE_TAP_WINDOWS, device_options=None):
         LOGGER.debug("MainControl init")
-        self.tuntap = None
+        self.device = create_packet_device(device_type, **(device_options or {}))
         self.client = None
-        self.tap_control = None
-        self.sys_hper = SysHelper()
+        self.loop_thread = None
+        self.device_adapter = None
+        self.sys_hper = self.device.create_sys_helper()
         self.running = False
         self.main_thread = None
         self.stop_thread = None
@@ -29,18 +38,15 @@ class MainControl:
         self.tuntapset_cb = None
         self.tapcontrolset_cb = None
         self.stop_cb = None
-        # traffic init
-        traffic = load_traffic()
-        if traffic:
-            self.rx_total_init = traffic.get('rx', 0)
-            self.tx_total_init = traffic.get('tx', 0)
-        else:
-            self.rx_total_init = 0
-            self.tx_total_init = 0
+        # traffic history, shared with the client
+        self.traffic_store = open_traffic_store()
         # filter
         self.filter = FilterRule(self.sys_hper)
         # direct dns
-        self.dns_server = DNSServer(self.filter, self.dns_recv_callback)
+        self.dns_server = None
+        # metrics
+        self.metrics_server = None
+        self.register_metrics()
 
     def set_connect_cb(self, callback):
         self.connect_cb = callback
@@ -67,34 +73,115 @@ class MainControl:
             return 0
 
     def get_rx_total(self):
-        if self.client:
-            self.rx_total_init = self.client.rx_total
-            return self.client.rx_total
-        else:
-            return self.rx_total_init
+        return self.traffic_store.rx_total
 
     def get_tx_total(self):
-        if self.client:
-            self.tx_total_init = self.client.tx_total
-            return self.client.tx_total
-        else:
-            return self.tx_total_init
+        return self.traffic_store.tx_total
+
+    def get_traffic_history(self, period='day'):
+        '''[(day or month, rx, tx)] oldest first'''
+        return self.traffic_store.history(period)
+
+    def get_write_stats(self):
+        return self.device.write_stats()
+
+    def get_write_stat(self, name):
+        stats = self.get_write_stats()
+        return stats.get(name) if stats else None
+
+    def get_client_counter(self, name):
+        counter = getattr(self.client, name, None)
+        return counter.value() if counter is not None else None
+
+    def get_compression_saved(self, direction):
+        compressor = getattr(self.client, 'compressor', None)
+        if compressor is None:
+            return None
+        return compressor.saved() if direction == 'tx' else compressor.inflated
+
+    def get_crypto_offload_dropped(self):
+        crypto_offload = getattr(self.client, 'crypto_offload', None)
+        return crypto_offload.dropped() if crypto_offload is not None else None
+
+    def get_dns_cache_stat(self, name):
+        cache = getattr(self.dns_server, 'cache', None)
+        return getattr(cache, name) if cache is not None else None
+
+    def get_dns_queue_depth(self):
+        packet_queue = getattr(self.dns_server, 'packet_queue', None)
+        return packet_queue.qsize() if packet_queue is not None else None
+
+    def register_metrics(self):
+        '''values read from whatever client and device are current at scrape time'''
+        for name in ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets'):
+            REGISTRY.counter_callback('outernet_client_%s_total' % name, 'tunnel %s of the current connection' % name.replace('_', ' '),
+                                      lambda name=name: self.get_client_counter(name))
+        REGISTRY.counter_callback('outernet_client_tx_dropped_total', 'datagrams dropped on a full socket buffer',
+                                  lambda: self.get_client_counter('tx_dropped'))
+        REGISTRY.gauge('outernet_rx_rate_bytes', 'received bytes in the last second', self.get_rx_rate)
+        REGISTRY.gauge('outernet_tx_rate_bytes', 'sent bytes in the last second', self.get_tx_rate)
+        REGISTRY.gauge('outernet_device_write_queue_depth', 'packets waiting to be written to the device',
+                       lambda: self.get_write_stat('depth'))
+        REGISTRY.gauge('outernet_device_write_queue_max_depth', 'highest device write queue depth',
+                       lambda: self.get_write_stat('max_depth'))
+        REGISTRY.counter_callback('outernet_device_write_dropped_total', 'packets dropped by the device write queue',
+                                  lambda: self.get_write_stat('dropped'))
+        for direction in ('rx', 'tx'):
+            REGISTRY.counter_callback('outernet_compression_saved_bytes_total', 'tunnel bytes saved by compression',
+                                      lambda direction=direction: self.get_compression_saved(direction),
+                                      {'direction': direction})
+        REGISTRY.counter_callback('outernet_crypto_offload_dropped_total', 'packets too large for a crypto offload slot',
+                                  self.get_crypto_offload_dropped)
+        REGISTRY.gauge('outernet_dns_queue_depth', 'dns queries waiting to be resolved', self.get_dns_queue_depth)
+        for name in ('hits', 'misses'):
+            REGISTRY.counter_callback('outernet_dns_cache_%s_total' % name, 'dns answer cache %s' % name,
+                                      lambda name=name: self.get_dns_cache_stat(name))
+
+    def start_metrics(self, port):
+        '''serve metrics on localhost, returns the bound port'''
+        if self.metrics_server is None:
+            self.metrics_server = MetricsServer(port)
+            self.metrics_server.run()
+        return self.metrics_server.addr[1]
+
+    def stop_metrics(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
 
     def clear_traffic(self):
         if self.client:
             self.client.clear_traffic()
         else:
-            traffic = {}
-            traffic['rx'] = 0
-            traffic['tx'] = 0
-            save_traffic(traffic)
-        self.rx_total_init = 0
-        self.tx_total_init = 0
-
-    def run(self, server_ip, server_port, username, secret):
+            self.traffic_store.clear()
+
+    def run(self, server_ip, server_port, username, secret, cipher_mode=CIPHER_CHACHA20, batch_io=False,
+            engine=ENGINE_THREAD, crypto_workers=0, sockets=1, metrics_port=None, pmtu=False,
+            aggregate_window=0, compression=None, mss_clamp=True):
         LOGGER.debug("MainControl run")
+        if engine == ENGINE_ASYNCIO:
+            # the asyncio client sends through loop transports, none of these run there
+            unsupported = [name for name, value in (('batch_io', batch_io), ('crypto_workers', crypto_workers),
+                                                    ('aggregate_window', aggregate_window)) if value]
+            if unsupported:
+                LOGGER.warning("MainControl %s not supported by the asyncio engine, ignored" % ', '.join(unsupported))
+            batch_io = False
+            crypto_workers = 0
+            aggregate_window = 0
         self.server_ip = server_ip
         self.server_port = server_port
+        self.cipher_mode = cipher_mode
+        self.batch_io = batch_io
+        self.engine = engine
+        self.crypto_workers = crypto_workers
+        self.sockets = sockets
+        # path mtu probes use commands older servers drop, so probing is opt-in
+        self.pmtu = pmtu
+        self.aggregate_window = aggregate_window
+        self.compression = compression
+        self.mss_clamp = mss_clamp
+        if metrics_port is not None:
+            self.start_metrics(metrics_port)
         identification_raw = username.encode('utf-8')
         self.identification = hashlib.sha256(identification_raw).digest()
         self.secret = secret.encode('utf-8')
@@ -110,11 +197,25 @@ class MainControl:
     def handle_start(self):
         LOGGER.debug("MainControl handle_start")
         LOGGER.info("MainControl start connecting")
-        self.client = Client(self.server_ip, self.server_port, self.identification, self.secret, self.client_recv_cb, self.client_handshake_cb)
+        if self.engine == ENGINE_ASYNCIO:
+            # client, dns and device hand-off share one event loop
+            self.loop_thread = EventLoopThread()
+            self.loop_thread.run()
+            self.client = AsyncClient(self.loop_thread, self.server_ip, self.server_port, self.identification, self.secret,
+                                      self.client_recv_cb, self.client_handshake_cb, cipher_mode=self.cipher_mode,
+                                      sockets=self.sockets, mtu_callback=self.client_mtu_cb if self.pmtu else None,
+                                      compression=self.compression)
+            self.dns_server = AsyncDNSServer(self.loop_thread, self.filter, self.dns_recv_callback)
+        else:
+            self.client = Client(self.server_ip, self.server_port, self.identification, self.secret, self.client_recv_cb, self.client_handshake_cb,
+                                 cipher_mode=self.cipher_mode, batch_io=self.batch_io, crypto_workers=self.crypto_workers,
+                                 sockets=self.sockets, mtu_callback=self.client_mtu_cb if self.pmtu else None,
+                                 aggregate_window=self.aggregate_window, compression=self.compression)
+            self.dns_server = DNSServer(self.filter, self.dns_recv_callback)
         self.client.run()
 
         # waiting for client connecting to server
-        while not self.tuntap:
+        while not self.device.opened:
             time.sleep(0.1)
             if not self.running:
                 return
@@ -124,9 +225,12 @@ class MainControl:
         # dns
         self.dns_server.run()
 
-        self.tap_control = TAPControl(self.tuntap)
-        self.tap_control.read_callback = self.tap_read_cb
-        self.tap_control.run()
+        if self.loop_thread is not None:
+            self.device_adapter = DeviceAdapter(self.loop_thread, self.device, self.tap_read_cb)
+        else:
+            self.device.read_callback = self.tap_read_cb
+            self.device.flush_callback = self.client.flush
+        self.device.run()
         if self.tapcontrolset_cb is not None:
             self.tapcontrolset_cb()
 
@@ -134,17 +238,18 @@ class MainControl:
         LOGGER.debug("MainControl handle_stop")
         LOGGER.info("MainControl stop")
         self.running = False
-        if self.tap_control is not None:
-            self.tap_control.close()
+        self.device.close()
         if self.client is not None:
             self.client.stop()
-        if self.tuntap is not None:
-            close_tun_tap(self.tuntap)
         if self.dns_server is not None:
             self.dns_server.stop()
+        if self.loop_thread is not None:
+            self.loop_thread.stop()
         self.filter.uninit_filter()
-        self.tap_control = None
-        self.tuntap = None
+        self.stop_metrics()
+        self.loop_thread = None
+        self.device_adapter = None
+        self.dns_server = None
         self.client = None
         self.sys_hper.uninit_network(self.server_ip)
         LOGGER.info("MainControl stopped")
@@ -163,8 +268,8 @@ class MainControl:
         ipv4_network = [10, 0, 0, 0]
         ipv4_netmask = [255, 255, 255, 0]
         LOGGER.info("MainControl handshake success with interface ip: %s, gateway ip: %s" % (ipv4_addr, ipv4_gateway))
-        self.sys_hper.init_network(self.server_ip, ipv4_addr, ipv4_gateway, ipv4_network, ipv4_netmask)
-        self.tuntap = open_tun_tap(ipv4_addr, ipv4_network, ipv4_netmask)
+        self.sys_hper.init_network(self.server_ip, ipv4_addr, ipv4_gateway, ipv4_network, ipv4_netmask, self.device.mtu)
+        self.device.open(ipv4_addr, ipv4_network, ipv4_netmask)
 
         # filter
         ffilter = load_filter()
@@ -184,32 +289,67 @@ class MainControl:
         LOGGER.info("MainControl filter domains:\n%s\nfilter ips:\n%s" % (filter_domains, filter_ips))
         self.filter.init_filter(filter_type, filter_domains, filter_ips)
 
+    def client_mtu_cb(self, mtu):
+        LOGGER.info("MainControl tunnel mtu: %d" % mtu)
+        self.device.set_mtu(mtu)
+        self.sys_hper.set_mtu(mtu)
+
     def client_recv_cb(self, data):
-        LOGGER.debug("MainControl client_recv_cb")
-        self.tap_control.write(data)
+        if self.mss_clamp:
+            data = clamp_mss(data, mss_for_mtu(self.device.mtu))
+        if TRACER.enabled:
+            TRACER.record(STAGE_DEVICE_WRITE, data)
+        start = time.perf_counter()
+        self.device.write(data)
+        RX_DEVICE_WRITE_SECONDS.observe(time.perf_counter() - start)
 
     def tap_read_cb(self, data):
-        LOGGER.debug("MainControl tap_read_cb")
-
-        # dns filter
-        if is_dns_packet(data):
+        if TRACER.enabled:
+            TRACER.record(STAGE_DEVICE_READ, data)
+        start = time.perf_counter()
+        if self.mss_clamp:
+            # the mtu follows path mtu discovery
+            data = clamp_mss(data, mss_for_mtu(self.device.mtu))
+
+        # dns filter, the packet is parsed once and the context goes along
+        context = parse_dns_packet(data)
+        if context is not None:
             LOGGER.debug("MainControl read dns packet")
-            qnames = get_dns_qnames(data)
-            for qname in qnames:
+            for qname in context.qnames():
                 LOGGER.info("MainControl dns query: %s" % qname)
                 if self.filter.match_domain(qname.decode()):
                     LOGGER.info("DNSServer domain matched: %s" % qname)
-                    self.dns_server.resolve(data)
+                    if TRACER.enabled:
+                        TRACER.record(STAGE_DNS_RESOLVE, data)
+                    self.dns_server.resolve(data, context)
                     return
 
         self.client.send(data)
+        TX_TOTAL_SECONDS.observe(time.perf_counter() - start)
 
     def dns_recv_callback(self, data):
         LOGGER.debug("MainControl dns_recv_callback")
-        self.tap_control.write(data)
+        if TRACER.enabled:
+            TRACER.record(STAGE_DEVICE_WRITE, data)
+        self.device.write(data)
+
+    def start_trace(self, sample=1):
+        '''trace one packet out of every sample per thread, dumped on thread errors'''
+        TRACER.enable(sample)
+
+    def stop_trace(self):
+        TRACER.disable()
+
+    def dump_trace(self):
+        '''returns the path of the written trace'''
+        return TRACER.dump()
 
 
 if __name__ == '__main__':
+    import ctypes
+    from sys_helper import SysHelper
+    from iface_helper import get_tap_iface
+
     # check privilige
     if not ctypes.windll.shell32.IsUserAnAdmin():
         print('please run this as administrator')
@@ -1,5 +1,6 @@
 import sys
 import ctypes
+import multiprocessing
 import time
 import traceback
 
@@ -432,6 +433,8 @@ class FrontWindow(QMainWindow):
 MAIN_WINDOW = None
 
 if __name__ == '__main__':
+    # crypto offload workers are spawned from the frozen executable
+    multiprocessing.freeze_support()
     try:
         sys.stderr = open('error.log', 'w+')
         LOGGER.info("start app, version: %s" % VERSION_CODE)
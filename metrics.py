@@ -0,0 +1,261 @@
+'''
+process wide metrics with a prometheus text endpoint on localhost
+
+counters and histograms keep one cell per thread which only that thread
+writes, scrapes sum the cells, so the data path never takes a lock and no
+increment is lost. gauges and externally kept values are read through
+callbacks at scrape time.
+
+    curl http://127.0.0.1:9101/metrics
+'''
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import LOGGER
+
+TYPE_COUNTER = 'counter'
+TYPE_GAUGE = 'gauge'
+TYPE_HISTOGRAM = 'histogram'
+
+# seconds, from a fast cipher call up to a stalled device write
+LATENCY_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+DEFAULT_METRICS_HOST = '127.0.0.1'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class PerThreadCells:
+    '''cells created on first use by each thread, summed by readers'''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = threading.local()
+        self.cells = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        cell = getattr(self.local, 'cell', None)
+        if cell is None:
+            cell = self.factory()
+            self.local.cell = cell
+            with self.lock:
+                self.cells.append(cell)
+        return cell
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.cells)
+
+
+class Counter:
+    type = TYPE_COUNTER
+
+    def __init__(self, name='', help='', labels=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(sorted((labels or {}).items()))
+        self.cells = PerThreadCells(lambda: [0])
+
+    def inc(self, value=1):
+        self.cells.get()[0] += value
+
+    def value(self):
+        return sum(cell[0] for cell in self.cells.snapshot())
+
+    def samples(self):
+        yield self.name, self.labels, self.value()
+
+
+class Histogram:
+    type = TYPE_HISTOGRAM
+
+    def __init__(self, name='', help='', labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(sorted((labels or {}).items()))
+        self.bounds = list(buckets)
+        # bucket counts, sum, count
+        self.cells = PerThreadCells(lambda: [[0] * (len(self.bounds) + 1), 0.0, 0])
+
+    def observe(self, value):
+        cell = self.cells.get()
+        cell[0][bisect.bisect_left(self.bounds, value)] += 1
+        cell[1] += value
+        cell[2] += 1
+
+    def value(self):
+        '''cumulative bucket counts, sum and count'''
+        counts = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        count = 0
+        for cell in self.cells.snapshot():
+            for i, bucket in enumerate(cell[0]):
+                counts[i] += bucket
+            total += cell[1]
+            count += cell[2]
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return counts, total, count
+
+    def samples(self):
+        counts, total, count = self.value()
+        for bound, bucket in zip(self.bounds + [float('inf')], counts):
+            yield self.name + '_bucket', self.labels + (('le', format_value(float(bound))),), bucket
+        yield self.name + '_sum', self.labels, total
+        yield self.name + '_count', self.labels, count
+
+
+class CallbackMetric:
+    '''value read at scrape time, the callback returns None when unavailable'''
+
+    def __init__(self, name, help, type, callback, labels=None):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = tuple(sorted((labels or {}).items()))
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if value is not None:
+            yield self.name, self.labels, value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_add(self, metric):
+        key = (metric.name, metric.labels)
+        with self.lock:
+            existing = self.metrics.get(key)
+            if existing is not None and not isinstance(metric, CallbackMetric):
+                return existing
+            self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self.get_or_add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self.get_or_add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, callback, labels=None):
+        return self.get_or_add(CallbackMetric(name, help, TYPE_GAUGE, callback, labels))
+
+    def counter_callback(self, name, help, callback, labels=None):
+        '''for monotonic totals kept elsewhere'''
+        return self.get_or_add(CallbackMetric(name, help, TYPE_COUNTER, callback, labels))
+
+    def render(self):
+        '''prometheus text exposition format'''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        families = {}
+        for metric in metrics:
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, family in families.items():
+            lines.append('# HELP %s %s' % (name, family[0].help))
+            lines.append('# TYPE %s %s' % (name, family[0].type))
+            for metric in family:
+                try:
+                    for sample_name, labels, value in metric.samples():
+                        lines.append('%s%s %s' % (sample_name, format_labels(labels), format_value(value)))
+                except Exception as err:
+                    LOGGER.warning("MetricsRegistry %s failed: %s" % (name, err))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug("MetricsServer %s" % (format % args))
+
+
+class MetricsServer:
+    '''serves a registry on localhost only'''
+
+    def __init__(self, port, registry=REGISTRY, host=DEFAULT_METRICS_HOST):
+        LOGGER.debug("MetricsServer init")
+        self.httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.addr = self.httpd.server_address
+        self.serve_thread = None
+
+    def run(self):
+        LOGGER.info("MetricsServer serving on %s:%d" % self.addr)
+        self.serve_thread = threading.Thread(target=self.httpd.serve_forever, args=(0.5,))
+        self.serve_thread.start()
+
+    def stop(self):
+        LOGGER.info("MetricsServer stop")
+        if self.serve_thread is not None:
+            self.httpd.shutdown()
+            self.serve_thread.join()
+            self.serve_thread = None
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    from urllib.request import urlopen
+
+    registry = MetricsRegistry()
+    counter = registry.counter('test_packets_total', 'packets')
+    assert registry.counter('test_packets_total', 'packets') is counter
+    threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(10000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value() == 40000
+
+    histogram = registry.histogram('test_stage_seconds', 'stage latency', {'stage': 'a'}, buckets=(0.001, 0.01))
+    for value in (0.0005, 0.005, 0.005, 1):
+        histogram.observe(value)
+    assert histogram.value()[0] == [1, 3, 4]
+    registry.gauge('test_depth', 'queue depth', lambda: 7)
+    registry.gauge('test_missing', 'unavailable', lambda: None)
+
+    server = MetricsServer(0, registry)
+    server.run()
+    text = urlopen('http://127.0.0.1:%d/metrics' % server.addr[1]).read().decode('utf-8')
+    server.stop()
+    print(text)
+    assert 'test_packets_total 40000' in text
+    assert 'test_stage_seconds_bucket{stage="a",le="0.01"} 3' in text
+    assert 'test_stage_seconds_bucket{stage="a",le="+Inf"} 4' in text
+    assert 'test_depth 7' in text
+    assert '\ntest_missing ' not in text
+    print('test ok')
@@ -0,0 +1,125 @@
+from logger import LOGGER
+
+DEVICE_TAP_WINDOWS = 'tap-windows'
+DEVICE_LINUX_TUN = 'linux-tun'
+DEVICE_LOOPBACK = 'loopback'
+
+DEFAULT_MTU = 1300
+
+
+class NullSysHelper:
+    '''SysHelper stand-in for devices whose routes are managed outside the app'''
+
+    def init_network(self, server_addr, ipv4_addr, ipv4_gateway, ipv4_network, ipv4_netmask, mtu=DEFAULT_MTU):
+        pass
+
+    def uninit_network(self, server_addr):
+        pass
+
+    def set_mtu(self, mtu):
+        pass
+
+    def add_route_white(self, ip):
+        pass
+
+    def del_route_white(self, ip):
+        pass
+
+    def add_route_black(self, ip):
+        pass
+
+    def del_route_black(self, ip):
+        pass
+
+
+class PacketDevice:
+    '''
+    layer 3 packet device used by MainControl. read_callback gets every
+    packet read from the device, flush_callback is called when the device
+    has nothing more to read for now. run() starts reading, write() may be
+    called from any thread.
+    '''
+
+    def __init__(self, mtu=DEFAULT_MTU):
+        self.mtu = mtu
+        self.read_callback = None
+        self.flush_callback = None
+        self.opened = False
+
+    def create_sys_helper(self):
+        return NullSysHelper()
+
+    def open(self, ipv4_addr, ipv4_network, ipv4_netmask):
+        raise NotImplementedError
+
+    def run(self):
+        raise NotImplementedError
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def set_mtu(self, mtu):
+        '''adopt a new mtu while running, e.g. from path mtu discovery'''
+        self.mtu = mtu
+
+    def write_stats(self):
+        '''write queue depth and drop counters, None for unqueued devices'''
+        return None
+
+    def close(self):
+        raise NotImplementedError
+
+
+class LoopbackDevice(PacketDevice):
+    '''
+    in memory device for tests and benchmarks, inject() stands in for the
+    system sending packets into the tunnel and packets written by the
+    tunnel go to write_callback
+    '''
+
+    def __init__(self, mtu=DEFAULT_MTU):
+        super().__init__(mtu)
+        self.write_callback = None
+        self.running = False
+        self.ipv4_addr = None
+
+    def open(self, ipv4_addr, ipv4_network, ipv4_netmask):
+        LOGGER.debug("LoopbackDevice open")
+        self.ipv4_addr = ipv4_addr
+        self.opened = True
+
+    def run(self):
+        LOGGER.debug("LoopbackDevice run")
+        self.running = True
+
+    def inject(self, packets):
+        '''deliver packets as if they were read from the device'''
+        if not self.running or not self.read_callback:
+            return
+        for data in packets:
+            self.read_callback(data)
+        if self.flush_callback:
+            self.flush_callback()
+
+    def write(self, data):
+        if self.running and self.write_callback:
+            self.write_callback(data)
+
+    def close(self):
+        LOGGER.info("LoopbackDevice close")
+        self.running = False
+        self.opened = False
+
+
+def create_packet_device(device_type, **kwargs):
+    '''kwargs go to the backend, e.g. mtu, or write_capacity and write_policy for tap'''
+    # platform backends import their system modules lazily
+    if device_type == DEVICE_TAP_WINDOWS:
+        from tap_control import TAPWindowsDevice
+        return TAPWindowsDevice(**kwargs)
+    elif device_type == DEVICE_LINUX_TUN:
+        from tun_linux import LinuxTunDevice
+        return LinuxTunDevice(**kwargs)
+    elif device_type == DEVICE_LOOPBACK:
+        return LoopbackDevice(**kwargs)
+    raise ValueError('unknown packet device: %s' % device_type)
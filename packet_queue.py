@@ -0,0 +1,183 @@
+import math
+import threading
+import time
+
+from collections import deque
+
+POLICY_TAIL_DROP = 'tail-drop'
+POLICY_HEAD_DROP = 'head-drop'
+POLICY_CODEL = 'codel'
+
+DEFAULT_CAPACITY = 1024
+# codel defaults from rfc 8289
+CODEL_TARGET = 0.005
+CODEL_INTERVAL = 0.1
+
+
+class BoundedPacketQueue:
+    '''
+    bounded packet queue between a producer and a blocking consumer.
+    when full, tail drop refuses the new packet and head drop discards the
+    oldest one. codel additionally drops at dequeue once packets have been
+    waiting longer than target for a whole interval (rfc 8289).
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, policy=POLICY_TAIL_DROP, target=CODEL_TARGET, interval=CODEL_INTERVAL):
+        if policy not in (POLICY_TAIL_DROP, POLICY_HEAD_DROP, POLICY_CODEL):
+            raise ValueError('unknown queue policy: %s' % policy)
+        self.capacity = capacity
+        self.policy = policy
+        self.target = target
+        self.interval = interval
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        # stats
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # codel state
+        self.first_above_time = 0
+        self.dropping = False
+        self.drop_next = 0
+        self.count = 0
+        self.lastcount = 0
+
+    def put(self, data):
+        '''returns False if the packet was dropped'''
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.capacity:
+                self.dropped += 1
+                if self.policy == POLICY_HEAD_DROP:
+                    self.items.popleft()
+                else:
+                    return False
+            self.items.append((time.monotonic(), data))
+            self.enqueued += 1
+            if len(self.items) > self.max_depth:
+                self.max_depth = len(self.items)
+            self.cond.notify()
+        return True
+
+    def get_batch(self, max_items, timeout=None):
+        '''
+        blocks until packets are available and returns up to max_items of them,
+        an empty list means timeout or close
+        '''
+        with self.cond:
+            while not self.items:
+                if self.closed or not self.cond.wait(timeout):
+                    return []
+            batch = []
+            now = time.monotonic()
+            while self.items and len(batch) < max_items:
+                if self.policy == POLICY_CODEL:
+                    item = self.codel_dequeue(now)
+                    if item is None:
+                        break
+                else:
+                    item = self.items.popleft()
+                batch.append(item[1])
+            self.dequeued += len(batch)
+            return batch
+
+    def codel_should_drop(self, item, now):
+        if item is None:
+            self.first_above_time = 0
+            return False
+        sojourn = now - item[0]
+        if sojourn < self.target or not self.items:
+            # below target, or this was the last packet queued
+            self.first_above_time = 0
+            return False
+        if self.first_above_time == 0:
+            self.first_above_time = now + self.interval
+            return False
+        return now >= self.first_above_time
+
+    def codel_control_law(self, t):
+        return t + self.interval / math.sqrt(self.count)
+
+    def codel_pop(self):
+        return self.items.popleft() if self.items else None
+
+    def codel_dequeue(self, now):
+        item = self.codel_pop()
+        ok_to_drop = self.codel_should_drop(item, now)
+        if self.dropping:
+            if not ok_to_drop:
+                self.dropping = False
+            while self.dropping and now >= self.drop_next:
+                self.dropped += 1
+                self.count += 1
+                item = self.codel_pop()
+                if not self.codel_should_drop(item, now):
+                    self.dropping = False
+                else:
+                    self.drop_next = self.codel_control_law(self.drop_next)
+        elif ok_to_drop:
+            self.dropped += 1
+            item = self.codel_pop()
+            self.codel_should_drop(item, now)
+            self.dropping = True
+            delta = self.count - self.lastcount
+            if delta > 1 and now - self.drop_next < 16 * self.interval:
+                self.count = delta
+            else:
+                self.count = 1
+            self.drop_next = self.codel_control_law(now)
+            self.lastcount = self.count
+        return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def depth(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'depth': len(self.items),
+            'max_depth': self.max_depth,
+            'capacity': self.capacity,
+            'enqueued': self.enqueued,
+            'dequeued': self.dequeued,
+            'dropped': self.dropped,
+        }
+
+
+if __name__ == "__main__":
+    # tail drop keeps the oldest packets
+    queue = BoundedPacketQueue(4, POLICY_TAIL_DROP)
+    for i in range(6):
+        queue.put(i)
+    assert queue.get_batch(10) == [0, 1, 2, 3]
+    assert queue.dropped == 2
+
+    # head drop keeps the newest packets
+    queue = BoundedPacketQueue(4, POLICY_HEAD_DROP)
+    for i in range(6):
+        queue.put(i)
+    assert queue.get_batch(10) == [2, 3, 4, 5]
+
+    # codel drops once packets stand in the queue for a whole interval
+    queue = BoundedPacketQueue(1000, POLICY_CODEL, target=0.001, interval=0.01)
+    for i in range(100):
+        queue.put(i)
+    time.sleep(0.002)
+    assert len(queue.get_batch(1)) == 1
+    time.sleep(0.02)
+    assert len(queue.get_batch(1)) == 1
+    assert queue.dropped > 0
+
+    # close wakes up a blocked consumer
+    queue = BoundedPacketQueue()
+    threading.Timer(0.05, queue.close).start()
+    assert queue.get_batch(10) == []
+
+    print('test ok')
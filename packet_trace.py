@@ -0,0 +1,193 @@
+'''
+low overhead packet tracing
+
+every thread records into its own ring of fixed size binary records, so
+tracing takes no lock and never formats a packet on the hot path. the
+rings are only decoded when dumped, on demand or when a thread dies with
+an exception. callers guard with the enabled flag so a disabled tracer
+costs one attribute lookup:
+
+    if TRACER.enabled:
+        TRACER.record(STAGE_CLIENT_SEND, data)
+'''
+import os
+import struct
+import threading
+import time
+
+from datetime import datetime
+from logger import LOGGER
+
+STAGE_DEVICE_READ = 1
+STAGE_CLIENT_SEND = 2
+STAGE_CLIENT_RECV = 3
+STAGE_DEVICE_WRITE = 4
+STAGE_DNS_RESOLVE = 5
+
+STAGE_NAMES = {
+    STAGE_DEVICE_READ: 'device-read',
+    STAGE_CLIENT_SEND: 'client-send',
+    STAGE_CLIENT_RECV: 'client-recv',
+    STAGE_DEVICE_WRITE: 'device-write',
+    STAGE_DNS_RESOLVE: 'dns-resolve',
+}
+
+DEFAULT_CAPACITY = 4096
+# timestamp, stage, ip protocol, length, src ip, dst ip, src port, dst port
+RECORD = struct.Struct('=dBBHIIHH')
+IPV4_ADDRS = struct.Struct('!II')
+PORTS = struct.Struct('!HH')
+
+
+class TraceRing:
+    '''records of one thread, only that thread writes to it'''
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.pos = 0
+        self.count = 0
+        self.skip = 0
+
+    def records(self):
+        '''oldest first'''
+        start = self.pos if self.count >= self.capacity else 0
+        for i in range(min(self.count, self.capacity)):
+            yield RECORD.unpack_from(self.buffer, ((start + i) % self.capacity) * RECORD.size)
+
+
+class PacketTracer:
+    def __init__(self):
+        self.enabled = False
+        self.capacity = DEFAULT_CAPACITY
+        self.sample = 1
+        self.local = threading.local()
+        self.rings = []
+        self.rings_lock = threading.Lock()
+        self.dump_dir = 'log'
+        self.prev_excepthook = None
+
+    def enable(self, sample=1, capacity=DEFAULT_CAPACITY, dump_on_error=True):
+        '''trace one packet out of every sample, per thread'''
+        LOGGER.info("PacketTracer enable sample: %d, capacity: %d" % (sample, capacity))
+        self.sample = max(1, sample)
+        self.capacity = capacity
+        with self.rings_lock:
+            self.rings = []
+        self.local = threading.local()
+        if dump_on_error and self.prev_excepthook is None:
+            self.prev_excepthook = threading.excepthook
+            threading.excepthook = self.handle_thread_exception
+        self.enabled = True
+
+    def disable(self):
+        LOGGER.info("PacketTracer disable")
+        self.enabled = False
+        if self.prev_excepthook is not None:
+            threading.excepthook = self.prev_excepthook
+            self.prev_excepthook = None
+
+    def get_ring(self):
+        ring = TraceRing(threading.current_thread().name, self.capacity)
+        self.local.ring = ring
+        with self.rings_lock:
+            self.rings.append(ring)
+        return ring
+
+    def record(self, stage, data):
+        ring = getattr(self.local, 'ring', None)
+        if ring is None:
+            ring = self.get_ring()
+        if ring.skip > 0:
+            ring.skip -= 1
+            return
+        ring.skip = self.sample - 1
+
+        proto = src = dst = sport = dport = 0
+        if len(data) >= 20 and data[0] & 0xf0 == 0x40:
+            proto = data[9]
+            src, dst = IPV4_ADDRS.unpack_from(data, 12)
+            header_len = (data[0] & 0x0f) * 4
+            if proto in (6, 17) and len(data) >= header_len + 4:
+                sport, dport = PORTS.unpack_from(data, header_len)
+        RECORD.pack_into(ring.buffer, ring.pos * RECORD.size, time.time(), stage, proto, min(len(data), 0xffff),
+                         src, dst, sport, dport)
+        ring.pos = (ring.pos + 1) % ring.capacity
+        ring.count += 1
+
+    def records(self):
+        '''decoded records of all threads merged by time'''
+        with self.rings_lock:
+            rings = list(self.rings)
+        records = []
+        for ring in rings:
+            for record in ring.records():
+                records.append((ring.name,) + record)
+        records.sort(key=lambda item: item[1])
+        return records
+
+    def dump(self, reason='on demand'):
+        '''writes the rings as text to the log directory, returns the file path'''
+        if not os.path.exists(self.dump_dir):
+            os.makedirs(self.dump_dir)
+        path = os.path.join(self.dump_dir, 'trace_%s.log' % datetime.now().strftime("%Y-%m-%d_%H-%M-%S_%f"))
+        records = self.records()
+        with open(path, 'w') as f:
+            f.write('# packet trace %s, sample 1/%d, %d records\n' % (reason, self.sample, len(records)))
+            for name, ts, stage, proto, length, src, dst, sport, dport in records:
+                f.write('%s %-12s %-12s proto %3d len %5d %s:%d -> %s:%d\n' % (
+                    datetime.fromtimestamp(ts).strftime('%H:%M:%S.%f'), name, STAGE_NAMES.get(stage, stage),
+                    proto, length, format_ip(src), sport, format_ip(dst), dport))
+        LOGGER.info("PacketTracer dumped %d records to %s" % (len(records), path))
+        return path
+
+    def handle_thread_exception(self, args):
+        if self.enabled:
+            try:
+                self.dump('after %s in thread %s' % (args.exc_type.__name__, args.thread.name if args.thread else None))
+            except Exception as err:
+                LOGGER.error("PacketTracer dump failed: %s" % err)
+        self.prev_excepthook(args)
+
+
+def format_ip(value):
+    return '%d.%d.%d.%d' % (value >> 24, (value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+
+
+TRACER = PacketTracer()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    tracer = PacketTracer()
+    tracer.dump_dir = tempfile.mkdtemp()
+    packet = struct.pack('!BBHHHBBH4s4sHHHH', 0x45, 0, 28, 0, 0, 64, 17, 0,
+                         bytes([10, 0, 0, 2]), bytes([8, 8, 8, 8]), 5353, 53, 8, 0)
+
+    # ring keeps the newest records
+    tracer.enable(capacity=4)
+    for _ in range(10):
+        tracer.record(STAGE_CLIENT_SEND, memoryview(packet))
+    records = tracer.records()
+    assert len(records) == 4
+    assert records[0][2:] == (STAGE_CLIENT_SEND, 17, 28, 0x0a000002, 0x08080808, 5353, 53)
+
+    # sampling and per thread rings
+    tracer.enable(sample=3)
+    thread = threading.Thread(target=lambda: [tracer.record(STAGE_DEVICE_READ, packet) for _ in range(9)])
+    thread.start()
+    thread.join()
+    tracer.record(STAGE_DEVICE_WRITE, b'\x60' + bytes(39))
+    assert len(tracer.rings) == 2
+    assert len(tracer.records()) == 4
+
+    # dump on a thread exception
+    thread = threading.Thread(target=lambda: 1 / 0)
+    thread.start()
+    thread.join()
+    assert len(os.listdir(tracer.dump_dir)) == 1
+    tracer.disable()
+    print(open(tracer.dump(), 'r').read())
+    print('test ok')
@@ -0,0 +1,225 @@
+'''
+path mtu discovery over the tunnel
+
+probes are encrypted CMD_CLIENT_PMTU_PROBE datagrams padded to a candidate
+link mtu and sent with the don't fragment bit set from a socket of their
+own, the server answers each one it receives with CMD_SERVER_PMTU_REPLY.
+a binary search finds the largest link mtu that gets through, the tunnel
+mtu is what is left of it after ip, udp, cipher and protocol overhead.
+'''
+import errno
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from protocol import (Protocol, PMTU_PROBE_HEADER, PMTU_REPLY, CLIENT_DATA_HEADER_LEN,
+                      CMD_CLIENT_PMTU_PROBE, CMD_SERVER_PMTU_REPLY)
+from logger import LOGGER
+
+IP_UDP_HEADER_LEN = 28
+PMTU_MAX_LINK = 1500
+# windows refuses ipv4 interface mtus below 576
+MIN_TUNNEL_MTU = 576
+PROBE_TRIES = 3
+PROBE_TIMEOUT = 1.0
+PMTU_REPROBE_INTERVAL = 600
+
+# see ip(7) and the winsock ipproto_ip options
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_PROBE = 3
+IP_DONTFRAGMENT = 14
+
+
+def set_dont_fragment(sock):
+    '''returns False where probes could be fragmented on the way'''
+    try:
+        if sys.platform.startswith('linux'):
+            # set DF but ignore the kernel's cached path mtu, we measure it
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+        elif sys.platform == 'win32':
+            sock.setsockopt(socket.IPPROTO_IP, IP_DONTFRAGMENT, 1)
+        else:
+            return False
+    except OSError as err:
+        LOGGER.warning("PMTUProber can not set don't fragment: %s" % err)
+        return False
+    return True
+
+
+def tunnel_mtu(link_mtu, overhead):
+    '''largest inner packet fitting a datagram of link_mtu'''
+    return link_mtu - IP_UDP_HEADER_LEN - overhead - CLIENT_DATA_HEADER_LEN
+
+
+class PMTUProber:
+    '''
+    probes after start and every interval seconds, callback gets the tunnel
+    mtu whenever it changes. a server without probe support never answers,
+    then the configured mtu is kept.
+    '''
+
+    def __init__(self, server_addr, identification, cipher, callback,
+                 max_link_mtu=PMTU_MAX_LINK, interval=PMTU_REPROBE_INTERVAL):
+        '''cipher is the client's, probes and replies belong to its session'''
+        LOGGER.debug("PMTUProber init")
+        self.server_addr = server_addr
+        self.identification = identification
+        self.cipher = cipher
+        self.callback = callback
+        self.max_link_mtu = max_link_mtu
+        self.interval = interval
+        self.sock = None
+        self.probe_id = 0
+        self.mtu = None
+        self.running = False
+        self.probe_thread = None
+
+    def run(self):
+        LOGGER.debug("PMTUProber run")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        if not set_dont_fragment(self.sock):
+            LOGGER.warning("PMTUProber disabled on this platform")
+            self.sock.close()
+            self.sock = None
+            return
+        self.running = True
+        self.probe_thread = threading.Thread(target=self.handle_probe)
+        self.probe_thread.start()
+
+    def stop(self):
+        LOGGER.info("PMTUProber stop")
+        self.running = False
+        if self.probe_thread is not None:
+            while self.probe_thread.is_alive():
+                time.sleep(0.1)
+            self.probe_thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def handle_probe(self):
+        LOGGER.debug("PMTUProber handle_probe")
+        while self.running:
+            mtu = self.discover()
+            if mtu is not None and mtu != self.mtu and self.running:
+                LOGGER.info("PMTUProber tunnel mtu %s -> %d" % (self.mtu, mtu))
+                self.mtu = mtu
+                self.callback(mtu)
+            deadline = time.time() + self.interval
+            while self.running and time.time() < deadline:
+                time.sleep(0.1)
+
+    def discover(self):
+        '''binary search over link mtus, returns the tunnel mtu or None'''
+        overhead = self.cipher.overhead
+        low = MIN_TUNNEL_MTU + IP_UDP_HEADER_LEN + overhead + CLIENT_DATA_HEADER_LEN
+        high = self.max_link_mtu
+        # clean paths pass the first probe
+        if self.probe(high):
+            return tunnel_mtu(high, overhead)
+        if not self.running or not self.probe(low):
+            LOGGER.warning("PMTUProber no probe answered, keeping the configured mtu")
+            return None
+        # low always passes, high always fails
+        while high - low > 1 and self.running:
+            middle = (low + high) // 2
+            if self.probe(middle):
+                low = middle
+            else:
+                high = middle
+        return tunnel_mtu(low, overhead)
+
+    def probe(self, link_mtu):
+        '''True if a datagram of link_mtu bytes, ip header included, gets through'''
+        size = link_mtu - IP_UDP_HEADER_LEN - self.cipher.overhead
+        for _ in range(PROBE_TRIES):
+            if not self.running:
+                return False
+            self.probe_id = (self.probe_id + 1) & 0xffff
+            plain = PMTU_PROBE_HEADER.pack(CMD_CLIENT_PMTU_PROBE, self.identification, self.probe_id)
+            plain += bytes(size - len(plain))
+            try:
+                self.sock.sendto(self.cipher.encrypt(plain), self.server_addr)
+            except OSError as err:
+                if err.errno == errno.EMSGSIZE or getattr(err, 'winerror', None) == 10040:
+                    # larger than the local interface allows
+                    return False
+                LOGGER.warning("PMTUProber send failed: %s" % err)
+                continue
+            if self.wait_reply(self.probe_id, size):
+                return True
+        return False
+
+    def wait_reply(self, probe_id, size):
+        deadline = time.time() + PROBE_TIMEOUT
+        while self.running:
+            wait = deadline - time.time()
+            if wait <= 0:
+                return False
+            readable, _, _ = select.select([self.sock, ], [], [], min(wait, 0.1))
+            if not readable:
+                continue
+            try:
+                data, _ = self.sock.recvfrom(2048)
+            except OSError:
+                continue
+            data = self.cipher.decrypt(data)
+            if data is None or len(data) < PMTU_REPLY.size:
+                continue
+            cmd, reply_id, length = PMTU_REPLY.unpack_from(data)
+            if cmd == CMD_SERVER_PMTU_REPLY and reply_id == probe_id and length == size:
+                return True
+        return False
+
+
+def pmtu_reply(protocol):
+    '''server side answer to a parsed CMD_CLIENT_PMTU_PROBE'''
+    if len(protocol.data) < 2:
+        return None
+    probe_id = 256 * protocol.data[0] + protocol.data[1]
+    return PMTU_REPLY.pack(CMD_SERVER_PMTU_REPLY, probe_id, 1 + len(protocol.identification) + len(protocol.data))
+
+
+if __name__ == "__main__":
+    from cipher import new_cipher, CIPHER_CHACHA20_POLY1305
+
+    # a stand-in server dropping everything above a 1400 bytes link mtu
+    secret = os.urandom(16)
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(0.1)
+    client_cipher = new_cipher(CIPHER_CHACHA20_POLY1305, secret)
+    server_cipher = new_cipher(CIPHER_CHACHA20_POLY1305, secret, True)
+    server_cipher.decrypt_handshake(client_cipher.encrypt_handshake(b''))
+    client_cipher.decrypt_handshake(server_cipher.encrypt_handshake(b''))
+    server_running = True
+
+    def serve():
+        while server_running:
+            try:
+                data, addr = server.recvfrom(4096)
+            except socket.timeout:
+                continue
+            if len(data) + IP_UDP_HEADER_LEN > 1400:
+                continue
+            protocol = Protocol()
+            protocol.parse(server_cipher.decrypt(data))
+            server.sendto(server_cipher.encrypt(pmtu_reply(protocol)), addr)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    results = []
+    prober = PMTUProber(server.getsockname(), b'i' * 32, client_cipher, results.append)
+    prober.run()
+    while not results:
+        time.sleep(0.1)
+    prober.stop()
+    server_running = False
+    thread.join()
+    assert results == [tunnel_mtu(1400, 28)], results
+    print('tunnel mtu %d' % results[0])
+    print('test ok')
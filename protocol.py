@@ -1,8 +1,23 @@
+import struct
+
 CMD_UNKNOWN = 0x00
 CMD_CLIENT_HANDSHAKE = 0x01
 CMD_SERVER_HANDSHAKE = 0x02
 CMD_CLIENT_DATA = 0x03
 CMD_SERVER_DATA = 0x04
+# path mtu probe, identification + probe id + padding, answered with
+# probe id + received length
+CMD_CLIENT_PMTU_PROBE = 0x05
+CMD_SERVER_PMTU_REPLY = 0x06
+# several ip packets in one datagram, each prefixed by a 2 bytes length,
+# client side after the identification
+CMD_CLIENT_AGGREGATE_DATA = 0x07
+CMD_SERVER_AGGREGATE_DATA = 0x08
+# one ip packet compressed with the algorithm picked at handshake, the
+# client offers algorithms in a capability byte after its identification
+# and the server answers with its pick after the addresses
+CMD_CLIENT_COMPRESSED_DATA = 0x09
+CMD_SERVER_COMPRESSED_DATA = 0x0A
 
 
 class Protocol:
@@ -11,6 +26,7 @@ class Protocol:
         self.identification = b''  # 32 bytes user id
         self.tun_ip_raw = b''  # 4 bytes big endian
         self.dst_ip_raw = b''  # 4 bytes big endian
+        self.capabilities = 0  # optional handshake byte
         self.data = b''
 
     def parse(self, data):
@@ -23,9 +39,9 @@ class Protocol:
             parsed += self.parse_client_handshake(data[1:])
         elif self.cmd == CMD_SERVER_HANDSHAKE:
             parsed += self.parse_server_handshake(data[1:])
-        elif self.cmd == CMD_CLIENT_DATA:
+        elif self.cmd in (CMD_CLIENT_DATA, CMD_CLIENT_PMTU_PROBE, CMD_CLIENT_AGGREGATE_DATA, CMD_CLIENT_COMPRESSED_DATA):
             parsed += self.parse_client_data(data[1:])
-        elif self.cmd == CMD_SERVER_DATA:
+        elif self.cmd in (CMD_SERVER_DATA, CMD_SERVER_PMTU_REPLY, CMD_SERVER_AGGREGATE_DATA, CMD_SERVER_COMPRESSED_DATA):
             parsed += self.parse_server_data(data[1:])
         return parsed
 
@@ -33,6 +49,9 @@ class Protocol:
         if len(data) < 32:
             return 0
         self.identification = data[:32]
+        if len(data) > 32:
+            self.capabilities = data[32]
+            return 33
         return 32
 
     def parse_server_handshake(self, data):
@@ -40,6 +59,9 @@ class Protocol:
             return 0
         self.tun_ip_raw = data[:4]
         self.dst_ip_raw = data[4:8]
+        if len(data) > 8:
+            self.capabilities = data[8]
+            return 9
         return 8
 
     def parse_client_data(self, data):
@@ -59,16 +81,20 @@ class Protocol:
             data += self.get_bytes_client_handshake()
         elif self.cmd == CMD_SERVER_HANDSHAKE:
             data += self.get_bytes_server_handshake()
-        elif self.cmd == CMD_CLIENT_DATA:
+        elif self.cmd in (CMD_CLIENT_DATA, CMD_CLIENT_PMTU_PROBE, CMD_CLIENT_AGGREGATE_DATA, CMD_CLIENT_COMPRESSED_DATA):
             data += self.get_bytes_client_data()
-        elif self.cmd == CMD_SERVER_DATA:
+        elif self.cmd in (CMD_SERVER_DATA, CMD_SERVER_PMTU_REPLY, CMD_SERVER_AGGREGATE_DATA, CMD_SERVER_COMPRESSED_DATA):
             data += self.get_bytes_server_data()
         return data
 
     def get_bytes_client_handshake(self):
+        if self.capabilities:
+            return self.identification + bytes([self.capabilities])
         return self.identification
 
     def get_bytes_server_handshake(self):
+        if self.capabilities:
+            return self.tun_ip_raw + self.dst_ip_raw + bytes([self.capabilities])
         return self.tun_ip_raw + self.dst_ip_raw
 
     def get_bytes_client_data(self):
@@ -76,3 +102,105 @@ class Protocol:
 
     def get_bytes_server_data(self):
         return self.data
+
+
+IDENTIFICATION_LEN = 32
+CLIENT_HANDSHAKE_LEN = 1 + IDENTIFICATION_LEN
+CLIENT_DATA_HEADER_LEN = 1 + IDENTIFICATION_LEN
+
+CLIENT_DATA_HEADER = struct.Struct('!B%ds' % IDENTIFICATION_LEN)
+SERVER_HANDSHAKE_LEN = 1 + 8
+
+PMTU_PROBE_HEADER = struct.Struct('!B%dsH' % IDENTIFICATION_LEN)
+PMTU_REPLY = struct.Struct('!BHH')
+AGGREGATE_LEN = struct.Struct('!H')
+
+
+class PacketHeader:
+    '''
+    Allocation-free counterpart of Protocol. parse() keeps memoryview
+    slices into the source buffer instead of copying the fields out, so
+    the parsed data is only valid as long as that buffer is.
+    '''
+    __slots__ = ('cmd', 'identification', 'tun_ip_raw', 'dst_ip_raw', 'data')
+
+    def __init__(self):
+        self.cmd = CMD_UNKNOWN
+        self.identification = None
+        self.tun_ip_raw = None
+        self.dst_ip_raw = None
+        self.data = None
+
+    def parse(self, data):
+        '''same return value as Protocol.parse'''
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        length = len(view)
+        if length < 1:
+            return 0
+        cmd = view[0]
+        self.cmd = cmd
+        if cmd == CMD_SERVER_DATA or cmd == CMD_SERVER_AGGREGATE_DATA or cmd == CMD_SERVER_COMPRESSED_DATA:
+            self.data = view[1:]
+            return length
+        elif cmd == CMD_CLIENT_DATA or cmd == CMD_CLIENT_AGGREGATE_DATA or cmd == CMD_CLIENT_COMPRESSED_DATA:
+            if length < CLIENT_DATA_HEADER_LEN:
+                return 1
+            self.identification = view[1:CLIENT_DATA_HEADER_LEN]
+            self.data = view[CLIENT_DATA_HEADER_LEN:]
+            return length
+        elif cmd == CMD_CLIENT_HANDSHAKE:
+            if length < CLIENT_HANDSHAKE_LEN:
+                return 1
+            self.identification = view[1:CLIENT_HANDSHAKE_LEN]
+            return CLIENT_HANDSHAKE_LEN
+        elif cmd == CMD_SERVER_HANDSHAKE:
+            if length < SERVER_HANDSHAKE_LEN:
+                return 1
+            self.tun_ip_raw = view[1:5]
+            self.dst_ip_raw = view[5:9]
+            return SERVER_HANDSHAKE_LEN
+        return 1
+
+
+def pack_client_data(buf, identification, data, cmd=CMD_CLIENT_DATA):
+    '''
+    write a CMD_CLIENT_DATA, or CMD_CLIENT_COMPRESSED_DATA, datagram into
+    the preallocated buffer
+    returns the number of bytes written
+    '''
+    CLIENT_DATA_HEADER.pack_into(buf, 0, cmd, identification)
+    end = CLIENT_DATA_HEADER_LEN + len(data)
+    buf[CLIENT_DATA_HEADER_LEN:end] = data
+    return end
+
+
+def pack_client_aggregate(buf, identification, packets):
+    '''
+    write a CMD_CLIENT_AGGREGATE_DATA datagram into the preallocated buffer
+    returns the number of bytes written
+    '''
+    CLIENT_DATA_HEADER.pack_into(buf, 0, CMD_CLIENT_AGGREGATE_DATA, identification)
+    return pack_aggregate(buf, CLIENT_DATA_HEADER_LEN, packets)
+
+
+def pack_aggregate(buf, offset, packets):
+    for packet in packets:
+        AGGREGATE_LEN.pack_into(buf, offset, len(packet))
+        offset += AGGREGATE_LEN.size
+        end = offset + len(packet)
+        buf[offset:end] = packet
+        offset = end
+    return offset
+
+
+def split_aggregate(view):
+    '''yields the packets of an aggregate payload, stops at a truncated one'''
+    offset = 0
+    end = len(view)
+    while end - offset >= AGGREGATE_LEN.size:
+        length = AGGREGATE_LEN.unpack_from(view, offset)[0]
+        offset += AGGREGATE_LEN.size
+        if offset + length > end:
+            return
+        yield view[offset:offset + length]
+        offset += length
@@ -2,6 +2,7 @@ import os
 import sys
 import subprocess
 
+from packet_device import DEFAULT_MTU
 from iface_helper import get_default_iface, get_iface_gateway_ipv4, get_iface_name, get_tap_iface
 from logger import LOGGER
 
@@ -25,7 +26,7 @@ class SysHelper:
         self.ipv4_network = None
         self.ipv4_netmask = None
 
-    def init_network(self, server_addr, ipv4_addr, ipv4_gateway, ipv4_network, ipv4_netmask):
+    def init_network(self, server_addr, ipv4_addr, ipv4_gateway, ipv4_network, ipv4_netmask, mtu=DEFAULT_MTU):
         self.ipv4_addr = '.'.join([str(item) for item in ipv4_addr])
         self.ipv4_gateway = '.'.join([str(item) for item in ipv4_gateway])
         self.ipv4_network = '.'.join([str(item) for item in ipv4_network])
@@ -37,7 +38,7 @@ class SysHelper:
         # setup interface
         execute("netsh interface ip set address %s static %s %s" % (self.tap_ifname, self.ipv4_addr, self.ipv4_netmask))
         execute("netsh interface ipv4 add address name=%s address=%s mask=%s" % (self.tap_ifname, self.ipv4_addr, self.ipv4_netmask))
-        execute("netsh interface ipv4 set interface interface=%s forwarding=enable metric=0 mtu=1300" % (self.tap_ifname,))
+        execute("netsh interface ipv4 set interface interface=%s forwarding=enable metric=0 mtu=%d" % (self.tap_ifname, mtu))
 
         # add server address
         execute("netsh interface ipv4 add route %s/32 %s %s metric=0" % (server_addr, self.default_ifname, self.default_ifgateway))
@@ -46,6 +47,9 @@ class SysHelper:
         execute("netsh interface ipv4 set dns name=%s static 8.8.8.8" % (self.tap_ifname,))
         execute("netsh interface ipv4 set dns name=%s static 8.8.4.4 index=2" % (self.tap_ifname,))
 
+    def set_mtu(self, mtu):
+        execute("netsh interface ipv4 set subinterface %s mtu=%d store=active" % (self.tap_ifname, mtu))
+
     def uninit_network(self, server_addr):
         # recover interface metric
         execute("netsh interface ipv4 set interface interface=%s metric=256" % (self.tap_ifname,))
@@ -6,8 +6,10 @@ import pywintypes
 import threading
 import time
 
-from queue import Queue
 from constants import REG_CONTROL_CLASS, TAP_COMPONENT_ID
+from packet_device import PacketDevice, DEFAULT_MTU
+from packet_queue import BoundedPacketQueue, DEFAULT_CAPACITY, POLICY_TAIL_DROP
+from sys_helper import SysHelper
 from logger import LOGGER
 
 
@@ -38,6 +40,14 @@ def TAP_CONTROL_CODE(request, method):
 TAP_IOCTL_SET_MEDIA_STATUS        = TAP_CONTROL_CODE( 6, 0)
 TAP_IOCTL_CONFIG_TUN              = TAP_CONTROL_CODE(10, 0)
 
+READ_RING_SIZE = 8
+WRITE_BATCH_SIZE = 32
+# a read that could not be issued is retried after a growing pause, the
+# ring stops after this many failures in a row
+READ_RETRY_DELAY = 0.01
+READ_RETRY_MAX_DELAY = 1.0
+READ_MAX_FAILURES = 20
+
 
 def open_tun_tap(ipv4_addr, ipv4_network, ipv4_netmask):
     '''
@@ -99,21 +109,55 @@ def close_tun_tap(tuntap):
     win32file.CloseHandle(tuntap)
 
 
+def split_packets(view):
+    '''yields every complete ipv4 packet of a read as a memoryview slice'''
+    offset = 0
+    end = len(view)
+    while end - offset >= 20:
+        version = view[offset] & 0xf0
+        if version == 0x40:  # ipv4
+            total_length = 256 * view[offset + 2] + view[offset + 3]
+        elif version == 0x60 and end - offset >= 40:  # todo: ipv6
+            total_length = 256 * view[offset + 4] + view[offset + 5] + 40
+        else:
+            return
+        if total_length < 20 or offset + total_length > end:
+            return
+        if version == 0x40:
+            yield view[offset:offset + total_length]
+        offset += total_length
+
+
+class ReadSlot:
+    '''a read buffer with its own overlapped structure'''
+
+    def __init__(self, size):
+        self.buffer = win32file.AllocateReadBuffer(size)
+        self.view = memoryview(self.buffer)
+        self.overlapped = pywintypes.OVERLAPPED()
+        self.overlapped.hEvent = win32event.CreateEvent(None, 0, 0, None)
+        # the driver owns buffer and overlapped while a read is in flight
+        self.pending = False
+
+
 class TAPControl:
-    def __init__(self, tuntap):
+    '''
+    packets are handed to read_callback as memoryviews into a pooled read
+    buffer, which is reused once the callback returns
+    '''
+
+    def __init__(self, tuntap, write_capacity=DEFAULT_CAPACITY, write_policy=POLICY_TAIL_DROP):
         LOGGER.debug("TAPControl init")
         # store params
         self.tuntap = tuntap
         # local variables
-        self.mtu = 1300
-        self.overlappedRx = pywintypes.OVERLAPPED()
-        self.overlappedRx.hEvent = win32event.CreateEvent(None, 0, 0, None)
-        self.rxOffset = self.overlappedRx.Offset
+        self.mtu = DEFAULT_MTU
         self.overlappedTx = pywintypes.OVERLAPPED()
         self.overlappedTx.hEvent = win32event.CreateEvent(None, 0, 0, None)
         self.txOffset = self.overlappedTx.Offset
         self.read_callback = None
-        self.write_queue = Queue()
+        self.flush_callback = None
+        self.write_queue = BoundedPacketQueue(write_capacity, write_policy)
         self.timeout = 100  # 0.1s
         self.goOn = False
         self.read_thread = None
@@ -129,75 +173,175 @@ class TAPControl:
 
     def handle_read(self):
         LOGGER.debug("TAPControl handle_read")
-        rxbuffer = win32file.AllocateReadBuffer(self.mtu)
+        # several overlapped reads stay in flight, each on its own buffer
+        slots = [ReadSlot(self.mtu) for _ in range(READ_RING_SIZE)]
+        try:
+            self.read_ring(slots)
+        finally:
+            self.cancel_reads(slots)
 
-        # read
-        ret = None
-        p = None
-        data = None
+    def read_ring(self, slots):
+        for slot in slots:
+            self.issue_read(slot)
+
+        head = 0
+        failures = 0
         while self.goOn:
-            try:
-                # wait for data
-                ret, p = win32file.ReadFile(self.tuntap, rxbuffer, self.overlappedRx)
-                while win32event.WaitForSingleObject(self.overlappedRx.hEvent, self.timeout) == win32event.WAIT_TIMEOUT:
-                    if not self.goOn:
+            # reads complete in issue order, always take the oldest one
+            slot = slots[head]
+            length = 0
+            if slot.pending:
+                try:
+                    if win32event.WaitForSingleObject(slot.overlapped.hEvent, 0) == win32event.WAIT_TIMEOUT:
+                        # nothing more to read right now, let the consumer flush its batch
+                        if self.flush_callback:
+                            self.flush_callback()
+                        while win32event.WaitForSingleObject(slot.overlapped.hEvent, self.timeout) == win32event.WAIT_TIMEOUT:
+                            if not self.goOn:
+                                return
+                    slot.pending = False
+                    length = win32file.GetOverlappedResult(self.tuntap, slot.overlapped, False)
+                except Exception as err:
+                    if slot.pending:
+                        # could not wait for the read, it may still be in flight
+                        LOGGER.error("TAPControl read wait failed: %s" % err)
                         return
-                self.rxOffset = self.rxOffset + len(p)
-                self.overlappedRx.Offset = self.rxOffset & 0xffffffff
-                self.overlappedRx.OffsetHigh = self.rxOffset >> 32
-                data = bytes(p.obj)
-            except Exception:
-                continue
-
-            LOGGER.debug("TAPControl read packet %s" % data)
-
-            send_data = None
-            if data[0] & 0xf0 == 0x40:  # ipv4
-                # get length
-                total_length = 256 * data[2] + data[3]
-                # ready to handle
-                send_data = data[:total_length]
-                data = data[total_length:]
-            elif data[0] & 0xf0 == 0x60:  # todo: ipv6
-                # get length
-                total_length = 256 * data[4] + data[5] + 40
-                # ready to handle
-                data = data[total_length:]
-
-            if send_data and self.read_callback:
-                self.read_callback(send_data)
+                    length = 0
+            else:
+                # the read could not be issued, do not spin on a failing driver
+                failures += 1
+                if failures >= READ_MAX_FAILURES:
+                    LOGGER.error("TAPControl read failed %d times in a row, stop reading" % failures)
+                    return
+                time.sleep(min(READ_RETRY_MAX_DELAY, READ_RETRY_DELAY * 2 ** failures))
+
+            if length:
+                if self.read_callback:
+                    for packet in split_packets(slot.view[:length]):
+                        self.read_callback(packet)
+
+            # the callback is done with the buffer, hand it back to the driver
+            if len(slot.buffer) < self.mtu:
+                # mtu grew, replace the buffer while it is not in flight
+                slot = slots[head] = ReadSlot(self.mtu)
+            if self.issue_read(slot):
+                failures = 0
+            head = (head + 1) % READ_RING_SIZE
+
+    def issue_read(self, slot):
+        '''False if the read could not be issued, the slot is retried on its next turn'''
+        try:
+            win32file.ReadFile(self.tuntap, slot.buffer, slot.overlapped)
+        except Exception as err:
+            LOGGER.warning("TAPControl read failed: %s" % err)
+            return False
+        slot.pending = True
+        return True
+
+    def cancel_reads(self, slots):
+        '''
+        the buffers and overlapped structures go away with the slots, wait
+        until the driver completed or aborted every read still in flight
+        '''
+        if not any(slot.pending for slot in slots):
+            return
+        try:
+            # cancels the reads this thread issued
+            win32file.CancelIo(self.tuntap)
+        except Exception as err:
+            LOGGER.warning("TAPControl cancel reads failed: %s" % err)
+        for slot in slots:
+            if slot.pending:
+                try:
+                    win32file.GetOverlappedResult(self.tuntap, slot.overlapped, True)
+                except Exception:
+                    # aborted
+                    pass
+                slot.pending = False
 
     def write(self, data):
-        LOGGER.debug("TAPControl write packet %s" % data)
         if not self.goOn:
             return
         self.write_queue.put(data)
 
     def handle_write(self):
         while self.goOn:
-            try:
-                data = self.write_queue.get(timeout=0.001)
-            except Exception:
-                continue
-
-            try:
-                # write over tuntap interface
-                win32file.WriteFile(self.tuntap, data, self.overlappedTx)
-                while win32event.WaitForSingleObject(self.overlappedTx.hEvent, self.timeout) == win32event.WAIT_TIMEOUT:
-                    if not self.goOn:
-                        return
-                self.txOffset = self.txOffset + len(data)
-                self.overlappedTx.Offset = self.txOffset & 0xffffffff
-                self.overlappedTx.OffsetHigh = self.txOffset >> 32
-            except Exception:
-                continue
+            # blocks until packets arrive, then writes them all in one wakeup
+            batch = self.write_queue.get_batch(WRITE_BATCH_SIZE, self.timeout / 1000)
+            for data in batch:
+                try:
+                    # write over tuntap interface
+                    win32file.WriteFile(self.tuntap, data, self.overlappedTx)
+                    while win32event.WaitForSingleObject(self.overlappedTx.hEvent, self.timeout) == win32event.WAIT_TIMEOUT:
+                        if not self.goOn:
+                            # data has to outlive the write, abort and wait for it
+                            win32file.CancelIo(self.tuntap)
+                            try:
+                                win32file.GetOverlappedResult(self.tuntap, self.overlappedTx, True)
+                            except Exception:
+                                pass
+                            return
+                    self.txOffset = self.txOffset + len(data)
+                    self.overlappedTx.Offset = self.txOffset & 0xffffffff
+                    self.overlappedTx.OffsetHigh = self.txOffset >> 32
+                except Exception:
+                    continue
 
     def close(self):
         LOGGER.info("TAPControl close")
         self.goOn = False
+        self.write_queue.close()
         if self.read_thread is not None:
             while self.read_thread.is_alive():
                 time.sleep(0.1)
         if self.write_thread is not None:
             while self.write_thread.is_alive():
                 time.sleep(0.1)
+
+
+class TAPWindowsDevice(PacketDevice):
+    '''TAP-Windows driver backend'''
+
+    def __init__(self, mtu=DEFAULT_MTU, write_capacity=DEFAULT_CAPACITY, write_policy=POLICY_TAIL_DROP):
+        super().__init__(mtu)
+        self.write_capacity = write_capacity
+        self.write_policy = write_policy
+        self.tuntap = None
+        self.tap_control = None
+
+    def create_sys_helper(self):
+        return SysHelper()
+
+    def open(self, ipv4_addr, ipv4_network, ipv4_netmask):
+        self.tuntap = open_tun_tap(ipv4_addr, ipv4_network, ipv4_netmask)
+        self.opened = True
+
+    def run(self):
+        self.tap_control = TAPControl(self.tuntap, self.write_capacity, self.write_policy)
+        self.tap_control.mtu = self.mtu
+        self.tap_control.read_callback = self.read_callback
+        self.tap_control.flush_callback = self.flush_callback
+        self.tap_control.run()
+
+    def set_mtu(self, mtu):
+        super().set_mtu(mtu)
+        if self.tap_control is not None:
+            self.tap_control.mtu = mtu
+
+    def write(self, data):
+        if self.tap_control is not None:
+            self.tap_control.write(data)
+
+    def write_stats(self):
+        if self.tap_control is None:
+            return None
+        return self.tap_control.write_queue.stats()
+
+    def close(self):
+        if self.tap_control is not None:
+            self.tap_control.close()
+            self.tap_control = None
+        if self.tuntap is not None:
+            close_tun_tap(self.tuntap)
+            self.tuntap = None
+        self.opened = False
@@ -0,0 +1,101 @@
+'''
+tcp mss clamping
+
+hosts advertise an mss derived from their own interface mtu in syn and
+syn-ack segments, so a peer behind a 1500 bytes link sends segments the
+tunnel has to fragment or drops on a black holed path. the option is
+lowered to what fits the tunnel mtu on the way through, and the tcp
+checksum is adjusted incrementally instead of being recomputed.
+'''
+from dns_utils import checksum_update
+
+IP_TCP_HEADER_LEN = 40
+TCP_FLAG_SYN = 0x02
+TCP_OPTION_END = 0
+TCP_OPTION_NOP = 1
+TCP_OPTION_MSS = 2
+
+
+def mss_for_mtu(mtu):
+    '''largest mss fitting mtu with option-less ipv4 and tcp headers'''
+    return mtu - IP_TCP_HEADER_LEN
+
+
+def clamp_mss(data, mss):
+    '''
+    returns data unchanged, or for a syn segment advertising more than mss
+    a copy with the mss option lowered to it
+    '''
+    if len(data) < IP_TCP_HEADER_LEN or data[9] != 6 or data[0] & 0xf0 != 0x40:
+        return data
+    # later fragments carry no tcp header
+    if (data[6] & 0x1f) or data[7]:
+        return data
+    header_len = (data[0] & 0x0f) * 4
+    if len(data) < header_len + 20 or not data[header_len + 13] & TCP_FLAG_SYN:
+        return data
+    end = min(header_len + (data[header_len + 12] >> 4) * 4, len(data))
+    i = header_len + 20
+    while i < end:
+        kind = data[i]
+        if kind == TCP_OPTION_END:
+            break
+        if kind == TCP_OPTION_NOP:
+            i += 1
+            continue
+        if i + 1 >= end or data[i + 1] < 2:
+            break
+        if kind == TCP_OPTION_MSS and data[i + 1] == 4 and i + 4 <= end:
+            if (data[i + 2] << 8 | data[i + 3]) <= mss:
+                return data
+            packet = bytearray(data)
+            # the checksum sums 16 bit words, cover the value with aligned ones
+            start = (i + 2) & ~1
+            stop = (i + 5) & ~1
+            old = bytes(packet[start:stop])
+            packet[i + 2] = mss >> 8
+            packet[i + 3] = mss & 0xff
+            offset = header_len + 16
+            chksum = checksum_update(packet[offset] << 8 | packet[offset + 1], old, packet[start:stop])
+            packet[offset] = chksum >> 8
+            packet[offset + 1] = chksum & 0xff
+            return packet
+        i += data[i + 1]
+    return data
+
+
+if __name__ == "__main__":
+    import struct
+
+    from dns_utils import checksum
+
+    def tcp_packet(flags, options, payload=b''):
+        tcp_len = 20 + len(options)
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + tcp_len + len(payload), 1, 0, 64, 6, 0,
+                         bytes([10, 0, 0, 2]), bytes([93, 184, 216, 34]))
+        tcp = struct.pack('!HHIIBBHHH', 40000, 80, 1, 0, (tcp_len // 4) << 4, flags, 65535, 0, 0) + options
+        pseudo = ip[12:20] + struct.pack('!BBH', 0, 6, tcp_len + len(payload))
+        chksum = checksum(pseudo + tcp + payload)
+        return ip + tcp[:16] + struct.pack('!H', chksum) + tcp[18:] + payload
+
+    def tcp_valid(packet):
+        pseudo = bytes(packet[12:20]) + struct.pack('!BBH', 0, 6, len(packet) - 20)
+        return checksum(pseudo + bytes(packet[20:])) == 0
+
+    mss = mss_for_mtu(1300)
+    # aligned and unaligned mss options are both fixed up
+    for options in (b'\x02\x04\x05\xb4\x01\x03\x03\x08', b'\x01\x02\x04\x05\xb4\x03\x03\x08',
+                    b'\x01\x01\x08\x0a\x00\x00\x00\x01\x00\x00\x00\x00\x01\x02\x04\x05\xb4\x00\x00\x00'):
+        syn = tcp_packet(TCP_FLAG_SYN, options)
+        assert tcp_valid(syn)
+        clamped = clamp_mss(memoryview(syn), mss)
+        assert clamped is not syn and tcp_valid(clamped)
+        assert struct.pack('!BBH', 2, 4, mss) in clamped
+    # smaller mss, no syn, no option pass through untouched
+    syn = tcp_packet(TCP_FLAG_SYN | 0x10, b'\x02\x04\x04\x00')
+    assert clamp_mss(syn, mss) is syn
+    data = tcp_packet(0x10, b'', b'\x02\x04\x05\xb4')
+    assert clamp_mss(data, mss) is data
+    syn = tcp_packet(TCP_FLAG_SYN, b'')
+    assert clamp_mss(syn, mss) is syn
+    print('test ok')
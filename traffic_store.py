@@ -0,0 +1,279 @@
+'''
+append only traffic history
+
+every line of the file is one json bucket:
+
+    {"ts":1700000040,"span":60,"rx":1200,"tx":800,"rx_total":52000,"tx_total":31000}
+
+rx/tx are the bytes counted in the bucket starting at ts, rx_total/tx_total
+the running totals after it, so loading only needs the last line which is
+read by seeking to the tail. the current minute is appended every few
+seconds, so a crash loses at most one flush interval. compaction merges
+the lines of a minute and rolls old minutes into local day buckets.
+'''
+import json
+import os
+import threading
+import time
+
+import yaml
+
+from config_helper import TRAFFIC_FILE
+from logger import LOGGER
+
+TRAFFIC_STORE_FILE = 'traffic.jsonl'
+MINUTE = 60
+DAY = 86400
+# keep per minute buckets this long, older ones become day buckets
+MINUTE_RETENTION = 2 * DAY
+# lines appended between compactions, about four hours of 10s flushes
+COMPACT_LINES = 1440
+TAIL_READ_SIZE = 4096
+
+
+def day_start(ts):
+    local = time.localtime(ts)
+    return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+
+class TrafficStore:
+    def __init__(self, path=TRAFFIC_STORE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rx_total = 0
+        self.tx_total = 0
+        # bucket being filled
+        self.bucket_ts = None
+        self.bucket_rx = 0
+        self.bucket_tx = 0
+        self.appended = 0
+        # a crash may have left the last line unterminated
+        self.torn = False
+        if os.path.exists(path):
+            self.load_tail()
+        else:
+            self.migrate()
+
+    def load_tail(self):
+        '''totals from the last complete line'''
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(0, size - TAIL_READ_SIZE))
+                tail = f.read()
+        except OSError as err:
+            LOGGER.warning("TrafficStore load failed: %s" % err)
+            return
+        self.torn = bool(tail) and not tail.endswith(b'\n')
+        lines = tail.split(b'\n')
+        # the first line may be cut by the seek and the last one by a crash
+        for line in reversed(lines):
+            try:
+                bucket = json.loads(line)
+                self.rx_total = bucket['rx_total']
+                self.tx_total = bucket['tx_total']
+                return
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def migrate(self):
+        '''carry the totals of the old yaml file over'''
+        if not os.path.exists(TRAFFIC_FILE):
+            return
+        try:
+            with open(TRAFFIC_FILE) as f:
+                traffic = yaml.safe_load(f)
+        except Exception as err:
+            LOGGER.warning("TrafficStore migrate failed: %s" % err)
+            return
+        if not isinstance(traffic, dict):
+            return
+        self.rx_total = traffic.get('rx', 0)
+        self.tx_total = traffic.get('tx', 0)
+        LOGGER.info("TrafficStore migrated %s rx: %d, tx: %d" % (TRAFFIC_FILE, self.rx_total, self.tx_total))
+        self.append([self.make_bucket(int(time.time()) // MINUTE * MINUTE, 0, 0, 0)])
+
+    def make_bucket(self, ts, span, rx, tx):
+        return {'ts': ts, 'span': span, 'rx': rx, 'tx': tx, 'rx_total': self.rx_total, 'tx_total': self.tx_total}
+
+    def add(self, rx, tx, now=None):
+        '''count bytes, called about once a second'''
+        ts = int(now if now is not None else time.time()) // MINUTE * MINUTE
+        with self.lock:
+            if self.bucket_ts is not None and ts != self.bucket_ts:
+                self.flush_locked()
+            self.bucket_ts = ts
+            self.bucket_rx += rx
+            self.bucket_tx += tx
+            self.rx_total += rx
+            self.tx_total += tx
+
+    def totals(self):
+        return self.rx_total, self.tx_total
+
+    def flush(self):
+        '''append the bucket being filled'''
+        with self.lock:
+            self.flush_locked()
+            if self.appended >= COMPACT_LINES:
+                self.compact_locked()
+
+    def flush_locked(self):
+        if self.bucket_ts is None or (self.bucket_rx == 0 and self.bucket_tx == 0):
+            return
+        bucket = self.make_bucket(self.bucket_ts, MINUTE, self.bucket_rx, self.bucket_tx)
+        self.bucket_rx = 0
+        self.bucket_tx = 0
+        self.append([bucket])
+
+    def append(self, buckets):
+        try:
+            with open(self.path, 'a') as f:
+                if self.torn:
+                    f.write('\n')
+                    self.torn = False
+                for bucket in buckets:
+                    f.write(json.dumps(bucket, separators=(',', ':')) + '\n')
+            self.appended += len(buckets)
+        except OSError as err:
+            LOGGER.warning("TrafficStore append failed: %s" % err)
+
+    def clear(self):
+        LOGGER.info("TrafficStore clear")
+        with self.lock:
+            self.flush_locked()
+            self.rx_total = 0
+            self.tx_total = 0
+            self.append([self.make_bucket(int(time.time()) // MINUTE * MINUTE, 0, 0, 0)])
+
+    def read_buckets(self):
+        buckets = []
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        buckets.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return buckets
+
+    def compact(self):
+        with self.lock:
+            self.flush_locked()
+            self.compact_locked()
+
+    def compact_locked(self, now=None):
+        '''
+        merge lines of the same bucket and roll old minutes into days. a
+        merged bucket is written where its last line was, so the line with
+        the latest totals stays last even across a clear
+        '''
+        now = now if now is not None else time.time()
+        merged = {}
+        for bucket in self.read_buckets():
+            ts = bucket['ts']
+            span = bucket['span']
+            if span == MINUTE and ts < now - MINUTE_RETENTION:
+                ts = day_start(ts)
+                span = DAY
+            key = (ts, span)
+            current = merged.pop(key, None)
+            if current is None:
+                current = dict(bucket, ts=ts, span=span)
+            else:
+                current['rx'] += bucket['rx']
+                current['tx'] += bucket['tx']
+                current['rx_total'] = bucket['rx_total']
+                current['tx_total'] = bucket['tx_total']
+            merged[key] = current
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                for bucket in merged.values():
+                    f.write(json.dumps(bucket, separators=(',', ':')) + '\n')
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            LOGGER.warning("TrafficStore compact failed: %s" % err)
+            return
+        LOGGER.info("TrafficStore compacted to %d buckets" % len(merged))
+        self.appended = 0
+
+    def history(self, period='day'):
+        '''[(period, rx, tx)] per local day or month, oldest first'''
+        fmt = '%Y-%m' if period == 'month' else '%Y-%m-%d'
+        with self.lock:
+            self.flush_locked()
+            buckets = self.read_buckets()
+        usage = {}
+        for bucket in buckets:
+            key = time.strftime(fmt, time.localtime(bucket['ts']))
+            rx, tx = usage.get(key, (0, 0))
+            usage[key] = (rx + bucket['rx'], tx + bucket['tx'])
+        return [(key, rx, tx) for key, (rx, tx) in sorted(usage.items())]
+
+
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+
+def open_traffic_store(path=TRAFFIC_STORE_FILE):
+    '''one store per file and process, so the file is only loaded once'''
+    path = os.path.abspath(path)
+    with STORES_LOCK:
+        store = STORES.get(path)
+        if store is None:
+            store = TrafficStore(path)
+            STORES[path] = store
+        return store
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    os.chdir(tempfile.mkdtemp())
+    with open(TRAFFIC_FILE, 'w') as f:
+        f.write('rx: 1000\ntx: 500\n')
+
+    # migrated from yaml, then minutes are appended and survive a reload
+    store = TrafficStore()
+    assert store.totals() == (1000, 500)
+    start = day_start(time.time()) - 3 * DAY
+    for i in range(180):
+        store.add(10, 20, start + i)
+    store.flush()
+    assert store.totals() == (2800, 4100)
+    assert TrafficStore().totals() == (2800, 4100)
+
+    # a torn last line after a crash falls back to the line before
+    with open(TRAFFIC_STORE_FILE, 'a') as f:
+        f.write('{"ts":1,"span"')
+    store = TrafficStore()
+    assert store.totals() == (2800, 4100)
+
+    # old minutes roll into one day, history keeps the usage
+    store.add(5, 5)
+    store.compact()
+    buckets = store.read_buckets()
+    assert [bucket['span'] for bucket in buckets] == [0, DAY, MINUTE]
+    assert store.history()[0][1:] == (1800, 3600)
+    assert TrafficStore().totals() == (2805, 4105)
+
+    store.clear()
+    assert TrafficStore().totals() == (0, 0)
+
+    # traffic after a clear in the same minute keeps its totals through compaction
+    now = time.time()
+    store.add(7, 3, now)
+    store.flush()
+    store.clear()
+    store.add(2, 1, now)
+    store.flush()
+    store.compact()
+    assert TrafficStore().totals() == (2, 1)
+    store.clear()
+    store.compact()
+    assert TrafficStore().totals() == (0, 0)
+    print('test ok')
@@ -0,0 +1,99 @@
+import fcntl
+import os
+import select
+import struct
+import subprocess
+import threading
+import time
+
+from packet_device import PacketDevice, DEFAULT_MTU
+from logger import LOGGER
+
+TUN_DEVICE = '/dev/net/tun'
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+DEFAULT_IFNAME = 'outernet0'
+
+
+def execute(cmd):
+    ret = subprocess.call(cmd)
+    LOGGER.info("system execute '%s' ret: %d" % (' '.join(cmd), ret))
+
+
+def netmask_prefix(ipv4_netmask):
+    return sum(bin(item).count('1') for item in ipv4_netmask)
+
+
+class LinuxTunDevice(PacketDevice):
+    '''/dev/net/tun backend, only the interface address is configured here'''
+
+    def __init__(self, mtu=DEFAULT_MTU, ifname=DEFAULT_IFNAME):
+        super().__init__(mtu)
+        self.ifname = ifname
+        self.fd = None
+        self.running = False
+        self.read_thread = None
+
+    def open(self, ipv4_addr, ipv4_network, ipv4_netmask):
+        LOGGER.debug("LinuxTunDevice open")
+        self.fd = os.open(TUN_DEVICE, os.O_RDWR)
+        ifr = struct.pack('16sH', self.ifname.encode(), IFF_TUN | IFF_NO_PI)
+        fcntl.ioctl(self.fd, TUNSETIFF, ifr)
+        addr = '.'.join([str(item) for item in ipv4_addr])
+        execute(['ip', 'addr', 'add', '%s/%d' % (addr, netmask_prefix(ipv4_netmask)), 'dev', self.ifname])
+        execute(['ip', 'link', 'set', 'dev', self.ifname, 'up', 'mtu', str(self.mtu)])
+        self.opened = True
+
+    def run(self):
+        LOGGER.debug("LinuxTunDevice run")
+        self.running = True
+        self.read_thread = threading.Thread(target=self.handle_read)
+        self.read_thread.start()
+
+    def handle_read(self):
+        LOGGER.debug("LinuxTunDevice handle_read")
+        rxbuffer = bytearray(self.mtu)
+        rxview = memoryview(rxbuffer)
+        while self.running:
+            readable, _, _ = select.select([self.fd], [], [], 0.1)
+            if not readable:
+                continue
+            if len(rxbuffer) < self.mtu:
+                # mtu grew, the callback is done with the old buffer
+                rxbuffer = bytearray(self.mtu)
+                rxview = memoryview(rxbuffer)
+            try:
+                length = os.readv(self.fd, [rxbuffer])
+            except OSError:
+                continue
+            # tun hands out exactly one packet per read
+            if length and self.read_callback:
+                self.read_callback(rxview[:length])
+            if self.flush_callback and not select.select([self.fd], [], [], 0)[0]:
+                self.flush_callback()
+
+    def set_mtu(self, mtu):
+        super().set_mtu(mtu)
+        if self.opened:
+            execute(['ip', 'link', 'set', 'dev', self.ifname, 'mtu', str(mtu)])
+
+    def write(self, data):
+        if not self.running:
+            return
+        try:
+            os.write(self.fd, data)
+        except OSError as err:
+            LOGGER.warning("LinuxTunDevice write failed: %s" % err)
+
+    def close(self):
+        LOGGER.info("LinuxTunDevice close")
+        self.running = False
+        if self.read_thread is not None:
+            while self.read_thread.is_alive():
+                time.sleep(0.1)
+            self.read_thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.opened = False
@@ -0,0 +1,144 @@
+import errno
+import select
+import struct
+import sys
+import time
+
+from metrics import Counter
+from logger import LOGGER
+
+# linux udp generic segmentation offload, see udp(7)
+SOL_UDP = 17
+UDP_SEGMENT = 103
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_SIZE = 65000
+# a full socket buffer is waited on once for this long before dropping
+SEND_RETRY_TIMEOUT = 0.002
+
+
+def recv_batch(sock, bufs):
+    '''
+    drain ready datagrams of a non-blocking socket into the preallocated
+    buffers, returns the list of received lengths, the i-th one is the
+    datagram in bufs[i]
+    '''
+    lengths = []
+    count = len(bufs)
+    while len(lengths) < count:
+        try:
+            length, _ = sock.recvfrom_into(bufs[len(lengths)])
+        except (BlockingIOError, InterruptedError):
+            break
+        except ConnectionResetError:
+            # icmp port unreachable reported on windows, nothing was
+            # received so the same buffer takes the next datagram
+            continue
+        lengths.append(length)
+    return lengths
+
+
+class UDPBatchSender:
+    '''
+    queues datagrams to one peer and sends them in bursts, on linux runs of
+    same sized datagrams go out in a single syscall with UDP_SEGMENT.
+    only datagrams handed to the kernel are counted in tx_bytes and
+    tx_packets, the ones dropped on a full socket buffer in dropped
+    '''
+
+    def __init__(self, sock, addr, batch_size, tx_bytes=None, tx_packets=None, dropped=None):
+        self.sock = sock
+        self.addr = addr
+        self.batch_size = batch_size
+        self.queue = []
+        self.gso = sys.platform.startswith('linux')
+        self.tx_bytes = tx_bytes or Counter()
+        self.tx_packets = tx_packets or Counter()
+        self.dropped = dropped or Counter()
+
+    def send(self, data):
+        self.queue.append(data)
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        queue = self.queue
+        if not queue:
+            return
+        self.queue = []
+        if self.gso:
+            self.flush_gso(queue)
+        else:
+            self.flush_plain(queue)
+
+    def flush_plain(self, queue):
+        for data in queue:
+            self.sendto(data)
+
+    def flush_gso(self, queue):
+        i = 0
+        count = len(queue)
+        while i < count:
+            # a gso run is same sized segments, only the last may be shorter
+            size = len(queue[i])
+            end = i + 1
+            total = size
+            while end < count and end - i < GSO_MAX_SEGMENTS and total + size <= GSO_MAX_SIZE:
+                cur = len(queue[end])
+                if cur > size:
+                    break
+                total += cur
+                end += 1
+                if cur < size:
+                    break
+            if end - i == 1:
+                self.sendto(queue[i])
+            elif not self.sendmsg_gso(queue[i:end], size):
+                self.flush_plain(queue[i:])
+                return
+            i = end
+
+    def sendmsg_gso(self, segments, size):
+        ancdata = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', size))]
+        try:
+            sent = self.send_retry(self.sock.sendmsg, segments, ancdata, 0, self.addr)
+        except OSError as err:
+            LOGGER.warning("UDPBatchSender gso unavailable, fallback: %s" % err)
+            self.gso = False
+            return False
+        if sent:
+            self.tx_bytes.inc(sum(len(segment) for segment in segments))
+            self.tx_packets.inc(len(segments))
+        else:
+            self.dropped.inc(len(segments))
+        return True
+
+    def sendto(self, data):
+        if self.send_retry(self.sock.sendto, data, self.addr):
+            self.tx_bytes.inc(len(data))
+            self.tx_packets.inc()
+        else:
+            self.dropped.inc()
+
+    def send_retry(self, send, *args):
+        '''
+        on a full socket buffer wait for it to drain and send once more,
+        returns False when the datagram had to be dropped
+        '''
+        for retry in (False, True):
+            try:
+                send(*args)
+                return True
+            except InterruptedError:
+                pass
+            except BlockingIOError:
+                if retry:
+                    break
+                select.select([], [self.sock], [], SEND_RETRY_TIMEOUT)
+            except OSError as err:
+                if err.errno != errno.ENOBUFS:
+                    raise
+                if retry:
+                    break
+                # nothing to wait on, give the device queue a moment to drain
+                time.sleep(SEND_RETRY_TIMEOUT)
+        return False